@@ -0,0 +1,91 @@
+import os
+from collections import OrderedDict
+
+from options import HEX_SIZE
+
+#pygame is only imported here once a render mode needs an image, so the simulation runs without it
+IMAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "images")
+
+_images = {}
+
+def load_image(name, rotation=0):
+    #loads images/<name> relative to this file the first time it's asked for
+    key = (name, rotation)
+    if key not in _images:
+        import pygame
+        image = pygame.image.load(os.path.join(IMAGE_DIR, name))
+        if rotation:
+            image = pygame.transform.rotate(image, rotation)
+        _images[key] = image
+    return _images[key]
+
+
+#name and rotation of the hex sized tile images and the smaller ones drawn in the middle of a tile
+TILE_IMAGES = (('hexagon.png', 90), ('water.png', 90), ('overlay_move.png', 90), ('overlay_attack.png', 90))
+FEATURE_IMAGES = ('forest.png', 'hills.png', 'mountain.png')
+UNIT_IMAGES = ('warrior.png', 'archer.png', 'city_center.png')
+
+
+class ZoomAssets:
+    """Everything the renderer draws at one zoom level: scaled images, the font and rendered text"""
+
+    def __init__(self, zoom):
+        import pygame
+        self.zoom = zoom
+        tile_size = HEX_SIZE * zoom
+        feature_size = int(tile_size * 2/3)
+        unit_size = HEX_SIZE / 2 * zoom
+        self.images = {}
+        for name, rotation in TILE_IMAGES:
+            self.images[name] = pygame.transform.scale(load_image(name, rotation), (tile_size, tile_size))
+        #overlay images are a little smaller so they fit in the tiles
+        for name in FEATURE_IMAGES:
+            self.images[name] = pygame.transform.scale(load_image(name), (feature_size, feature_size))
+        for name in UNIT_IMAGES:
+            self.images[name] = pygame.transform.scale(load_image(name), (unit_size, unit_size))
+        self.font = pygame.font.Font(None, int(HEX_SIZE/5 * zoom))
+        self._texts = {}
+
+    def text(self, text, color):
+        #numbers shown on units repeat all the time, so they are only rendered once per zoom level
+        key = (text, color)
+        surface = self._texts.get(key)
+        if surface is None:
+            surface = self._texts[key] = self.font.render(text, True, color)
+        return surface
+
+
+class RenderCache:
+    """ZoomAssets for the most recently used zoom levels, zoom is rounded to zoom_step"""
+
+    def __init__(self, max_zoom_levels=8, zoom_step=0.01):
+        self.max_zoom_levels = max_zoom_levels
+        self.zoom_step = zoom_step
+        self._levels = OrderedDict()
+        self._fonts = {}
+
+    def get(self, scale):
+        key = round(scale.x / self.zoom_step)
+        assets = self._levels.get(key)
+        if assets is None:
+            assets = self._levels[key] = ZoomAssets(key * self.zoom_step)
+            if len(self._levels) > self.max_zoom_levels:
+                self._levels.popitem(last=False)
+        else:
+            self._levels.move_to_end(key)
+        return assets
+
+    def font(self, size):
+        #fonts that don't depend on the zoom, like the game info text
+        if size not in self._fonts:
+            import pygame
+            self._fonts[size] = pygame.font.Font(None, size)
+        return self._fonts[size]
+
+    def clear(self):
+        #fonts and surfaces are invalid once pygame quits, a later window loads them again
+        self._levels.clear()
+        self._fonts.clear()
+
+
+render_cache = RenderCache()
@@ -0,0 +1,267 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+from itertools import product
+
+import numpy as np
+import gymnasium as gym
+
+from env import Civ6CombatEnv
+
+#Benchmarks of the single game engine, run with `python benchmark.py run --output results.json` and check
+#changes with `python benchmark.py compare baseline.json results.json`. Every config is seeded, so two runs
+#play the same games and only the timings differ.
+SCHEMA_VERSION = 1
+
+#metrics where a bigger number is better, every other metric is a latency
+THROUGHPUT_METRICS = ("steps_per_sec", "resets_per_sec")
+LATENCY_METRICS = ("get_obs_us", "get_reachable_pos_us", "bot_turn_us", "render_frame_us")
+
+
+def metadata(args):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    try:
+        import pygame
+        pygame_version = pygame.version.ver
+    except ImportError:
+        pygame_version = None
+    return {
+        "schema": SCHEMA_VERSION,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "gymnasium": gym.__version__,
+        "pygame": pygame_version,
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "args": vars(args),
+    }
+
+
+def latency(samples):
+    #nanosecond samples -> microsecond summary
+    samples = np.asarray(samples, dtype=np.float64) / 1000
+    if len(samples) == 0:
+        return None
+    return {"mean": float(samples.mean()), "median": float(np.median(samples)),
+            "p95": float(np.percentile(samples, 95)), "count": len(samples)}
+
+
+class ResetError(RuntimeError):
+    #no starting position could be generated for the config, the only failure a run reports instead of raising
+    pass
+
+
+def safe_reset(env, errors, seed=None):
+    #the engine can still fail to place cities on crowded boards, those resets are retried with the next random state
+    for _ in range(100):
+        try:
+            return env.reset(seed=seed)
+        except RuntimeError:
+            errors["reset"] += 1
+            seed = None
+    raise ResetError("Couldn't reset the env in 100 tries")
+
+
+def bench_config(rows, bots, start_troops, args):
+    errors = {"reset": 0}
+    env = Civ6CombatEnv(rows, rows, max_steps=args.max_steps, bots=bots, start_troops=start_troops)
+    env.action_space.seed(args.seed)
+    safe_reset(env, errors, args.seed)
+    actions = [env.action_space.sample() for _ in range(args.steps)]
+
+    #steps with random actions, finished games are reset inside the timing like in training
+    start = time.perf_counter_ns()
+    for action in actions:
+        _, _, terminated, truncated, _ = env.step(action)
+        if terminated or truncated:
+            safe_reset(env, errors)
+    steps_per_sec = args.steps / ((time.perf_counter_ns() - start) / 1e9)
+
+    start = time.perf_counter_ns()
+    for _ in range(args.resets):
+        safe_reset(env, errors)
+    resets_per_sec = args.resets / ((time.perf_counter_ns() - start) / 1e9)
+
+    #latencies are measured on fresh positions, the state is restored before every sample
+    obs_samples, reach_samples, bot_samples = [], [], []
+    for _ in range(args.positions):
+        safe_reset(env, errors)
+        state = env.get_state()
+        legal = np.flatnonzero(env.action_masks().reshape(-1))
+        for _ in range(args.repeat):
+            #observations are built incrementally, so the sample is the update after one player action
+            env.set_state(state)
+            env.terrain.action(env.decode_action(env.np_random.choice(legal)), env.player.id)
+            start = time.perf_counter_ns()
+            env._get_obs()
+            obs_samples.append(time.perf_counter_ns() - start)
+        for troop in env.player.troops:
+            for _ in range(args.repeat):
+                #a new board version so the reachability cache doesn't answer
+                env.terrain.version += 1
+                start = time.perf_counter_ns()
+                troop.get_reachable_pos(env.terrain)
+                reach_samples.append(time.perf_counter_ns() - start)
+        for _ in range(args.repeat):
+            env.set_state(state)
+            bot = env.bots[0]
+            start = time.perf_counter_ns()
+            env._ai_sim(bot)
+            bot_samples.append(time.perf_counter_ns() - start)
+    env.close()
+
+    metrics = {
+        "steps_per_sec": steps_per_sec,
+        "resets_per_sec": resets_per_sec,
+        "get_obs_us": latency(obs_samples),
+        "get_reachable_pos_us": latency(reach_samples),
+        "bot_turn_us": latency(bot_samples),
+        "render_frame_us": bench_render(rows, bots, start_troops, args, errors) if args.render else None,
+        "errors": errors,
+    }
+    return metrics
+
+
+def bench_render(rows, bots, start_troops, args, errors):
+    #a frame after every step, fps is raised so the clock doesn't sleep
+    env = Civ6CombatEnv(rows, rows, max_steps=args.max_steps, render_mode="human", bots=bots, start_troops=start_troops, fps=1_000_000)
+    env.action_space.seed(args.seed)
+    safe_reset(env, errors, args.seed)
+    samples = []
+    for _ in range(args.frames):
+        _, _, terminated, truncated, _ = env.step(env.action_space.sample())
+        if terminated or truncated:
+            safe_reset(env, errors)
+        start = time.perf_counter_ns()
+        env._render_frame()
+        samples.append(time.perf_counter_ns() - start)
+    env.close()
+    return latency(samples)
+
+
+def config_key(config):
+    return f"{config['rows']}x{config['rows']} bots={config['bots']} start_troops={config['start_troops']}"
+
+
+def run(args):
+    if args.render and args.headless:
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    results = []
+    for rows, bots, start_troops in product(args.sizes, args.bots, args.start_troops):
+        config = {"rows": rows, "bots": bots, "start_troops": start_troops}
+        try:
+            metrics = bench_config(rows, bots, start_troops, args)
+        except ResetError as e:
+            #boards too small for the players are reported, not fatal, anything else the engine raises fails the run
+            metrics = {"error": str(e)}
+        results.append({"config": config, "metrics": metrics})
+        print(format_result(config, metrics), flush=True)
+
+    report = {"metadata": metadata(args), "results": results}
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            return print_comparison(json.load(file), report, args.threshold)
+    return 0
+
+
+def format_result(config, metrics):
+    if "error" in metrics:
+        return f"{config_key(config)}: {metrics['error']}"
+    parts = [f"{metrics[name]:.0f} {name}" for name in THROUGHPUT_METRICS]
+    parts += [f"{name} {metrics[name]['median']:.1f}" for name in LATENCY_METRICS if metrics.get(name)]
+    return f"{config_key(config)}: " + ", ".join(parts)
+
+
+def metric_value(metrics, name):
+    value = metrics.get(name)
+    if isinstance(value, dict):
+        #latencies are compared by their median, it's the least noisy
+        return value["median"]
+    return value
+
+
+def compare(baseline, current, threshold):
+    """
+    Returns (config, metric, baseline value, current value, relative change, regressed) for every metric
+    both reports have. The change is positive when the current run is better, a regression is a change
+    worse than -threshold.
+    """
+    baseline_results = {config_key(result["config"]): result["metrics"] for result in baseline["results"]}
+    rows = []
+    for result in current["results"]:
+        key = config_key(result["config"])
+        if key not in baseline_results:
+            continue
+        for name in THROUGHPUT_METRICS + LATENCY_METRICS:
+            old = metric_value(baseline_results[key], name)
+            new = metric_value(result["metrics"], name)
+            if not old or not new:
+                continue
+            change = new / old - 1 if name in THROUGHPUT_METRICS else old / new - 1
+            rows.append((key, name, old, new, change, change < -threshold))
+    return rows
+
+
+def print_comparison(baseline, current, threshold):
+    #exit code 1 if anything regressed, so it can gate a change
+    rows = compare(baseline, current, threshold)
+    for key, name, old, new, change, regressed in rows:
+        flag = "REGRESSION" if regressed else ""
+        print(f"{key:<32} {name:<22} {old:>12.1f} -> {new:>12.1f} {change:+8.1%} {flag}")
+    regressions = sum(row[5] for row in rows)
+    print(f"{regressions} regressions over {threshold:.0%} in {len(rows)} metrics")
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Civ6CombatEnv benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("--sizes", type=int, nargs="+", default=[6, 8, 10], help="board sizes, boards are square")
+    run_parser.add_argument("--bots", type=int, nargs="+", default=[1, 2])
+    run_parser.add_argument("--start-troops", type=int, nargs="+", default=[1, 2])
+    run_parser.add_argument("--steps", type=int, default=2000)
+    run_parser.add_argument("--resets", type=int, default=200)
+    run_parser.add_argument("--positions", type=int, default=20, help="positions the latencies are measured on")
+    run_parser.add_argument("--repeat", type=int, default=5, help="samples per position")
+    run_parser.add_argument("--frames", type=int, default=100)
+    run_parser.add_argument("--max-steps", type=int, default=100)
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--no-render", dest="render", action="store_false", help="skip the render benchmark")
+    run_parser.add_argument("--headless", action="store_true", help="render with SDL's dummy video driver")
+    run_parser.add_argument("--output", help="json file for the results")
+    run_parser.add_argument("--baseline", help="json results to compare against")
+    run_parser.add_argument("--threshold", type=float, default=0.1, help="relative slowdown counted as a regression")
+
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.1)
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        return run(args)
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    with open(args.current) as file:
+        current = json.load(file)
+    return print_comparison(baseline, current, args.threshold)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,118 @@
+from abc import ABC, abstractmethod
+from collections import deque
+
+import numpy as np
+
+from hex_geometry import hex_distance, flat_index
+from kernels import heuristic_targets
+
+#Enemy troops this many hexes away or closer make a heuristic bot fortify instead of advancing
+THREAT_DISTANCE = 2
+
+
+class BotPolicy(ABC):
+    """
+    Plays a whole turn for a bot, Civ6CombatEnv calls play_turn once per turn with the bot's units.
+    Actions go through env.bot_action so rewards and rendering work the same for every policy.
+    """
+
+    @abstractmethod
+    def play_turn(self, env, bot):
+        """
+        Moves the bot's troops until it is done, returns the summed reward of attacks on the player
+        """
+
+
+class RandomBot(BotPolicy):
+    #random troop order and random legal targets, the original bot
+    def play_turn(self, env, bot):
+        reward = 0
+        troops = deque(env.terrain.registry.movable(bot.id))
+        while troops:
+            troop = troops.popleft()
+            possible_moves = troop.get_reachable_pos(env.terrain)
+            indices = np.where((possible_moves > 0) | (possible_moves == -2))
+            random_index = env.np_random.integers(len(indices[0]))
+
+            # Get the row and column of a random valid action
+            target_row = indices[0][random_index]
+            target_col = indices[1][random_index]
+
+            reward += env.bot_action(((troop.row, troop.col), (target_row, target_col)), bot)
+            #if still has moves, put it back
+            if troop.moves > 0:
+                troops.append(troop)
+        return reward
+
+
+class HeuristicBot(BotPolicy):
+    """
+    Attacks the weakest enemy in range, fortifies when enemy troops are close, otherwise advances on the
+    nearest enemy city. Decisions of all units are made together with kernels.heuristic_targets.
+    """
+
+    def play_turn(self, env, bot):
+        reward = 0
+        terrain = env.terrain
+        #every pass uses up moves of every unit, a unit that can't get closer fortifies
+        while True:
+            troops = terrain.registry.movable(bot.id)
+            if not troops:
+                return reward
+            targets = self.targets(terrain, bot.id, troops)
+            for troop, target in zip(troops, targets):
+                if troop.health <= 0 or troop.moves <= 0:
+                    continue
+                #earlier units may have changed the board, fortify if the target isn't valid anymore
+                row, col = divmod(int(target), terrain.column_count)
+                possible_moves = troop.get_reachable_pos(terrain)
+                if not (possible_moves[row, col] > 0 or possible_moves[row, col] == -2):
+                    row, col = troop.row, troop.col
+                reward += env.bot_action(((troop.row, troop.col), (row, col)), bot)
+
+    @staticmethod
+    def targets(terrain, player_id, troops):
+        cols = terrain.column_count
+        tiles = terrain.row_count * cols
+        reach = terrain.reachability(player_id, troops)
+        sources = np.array([flat_index(troop.row, troop.col, cols) for troop in troops])
+
+        #what an attack on each tile would hit, the building if there is one, like in Terrain.action
+        enemy_health = np.full(tiles, np.inf)
+        enemy_troop = np.zeros(tiles, dtype=bool)
+        enemy_city = np.zeros(tiles, dtype=bool)
+        for tile in np.flatnonzero((terrain.troop_ids.reshape(-1) >= 0) | (terrain.building_ids.reshape(-1) >= 0)):
+            row, col = divmod(int(tile), cols)
+            troop = terrain.get_troop(row, col)
+            building = terrain.get_building(row, col)
+            if troop and troop.player_id != player_id:
+                enemy_health[tile] = troop.health
+                enemy_troop[tile] = True
+            if building and building.player_id != player_id:
+                enemy_health[tile] = building.health
+                enemy_city[tile] = True
+
+        city_distance = hex_distance(terrain.row_count, cols, np.arange(tiles)[:, None], np.flatnonzero(enemy_city)[None])
+        city_distance = city_distance.min(axis=1, initial=tiles).astype(float)
+        threatened = (hex_distance(terrain.row_count, cols, sources[:, None], np.flatnonzero(enemy_troop)[None]) <= THREAT_DISTANCE).any(axis=1)
+        batch = (len(troops), tiles)
+        return heuristic_targets(reach, sources, np.broadcast_to(enemy_health, batch),
+                                 np.broadcast_to(city_distance, batch), threatened)
+
+
+#policies that can be given by name, the same names as the rules of Civ6CombatVectorEnv(bot_policy=...)
+BOT_POLICIES = {"random": RandomBot, "heuristic": HeuristicBot}
+
+
+class MCTSBot(BotPolicy):
+    #asks an mcts.MCTSPlanner for every action of the turn
+    def __init__(self, planner):
+        self.planner = planner
+
+    def play_turn(self, env, bot):
+        reward = 0
+        while True:
+            action = self.planner.plan(env, bot)
+            if action is None:
+                return reward
+            reward += env.bot_action(action, bot)
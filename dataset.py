@@ -0,0 +1,200 @@
+import os
+import json
+
+import numpy as np
+import gymnasium as gym
+
+from observation import format_space, decode_observations
+from options import CnnChannels
+
+#An offline dataset is a directory of fixed size shards, every field of a shard is its own .npy file so readers can
+#memory map it, and manifest.json lists the shards and how many transitions each holds. Action masks are bit packed,
+#observations are stored in the observation format of the env, see observation.encode_observations.
+MANIFEST = "manifest.json"
+DATASET_VERSION = 1
+
+
+def dataset_fields(rows, columns, observation_format="float32"):
+    #field -> (shape of one transition, dtype)
+    tiles = rows * columns
+    observation_space = format_space(observation_format, rows, columns)
+    return {
+        "observations": (observation_space.shape, observation_space.dtype), #the observation the action was taken in
+        "actions": ((4,), np.int16),                                     #from_row, from_col, to_row, to_col
+        "rewards": ((), np.float32),
+        "terminated": ((), bool),
+        "truncated": ((), bool),
+        "episode_starts": ((), bool),                                    #first transition of an episode
+        "action_masks": (((tiles * tiles + 7) // 8,), np.uint8),         #np.packbits of Civ6CombatEnv.action_masks
+    }
+
+
+class DatasetWriter:
+    """
+    Streams transitions into shards of shard_size transitions, a shard is written to disk as soon as it is full.
+    The manifest is rewritten after every shard, so a dataset stays readable if writing stops early.
+    """
+
+    def __init__(self, path, rows, columns, shard_size=65536, observation_format="float32"):
+        self.path = path
+        self.row_count = rows
+        self.col_count = columns
+        self.shard_size = shard_size
+        self.observation_format = observation_format
+        self.fields = dataset_fields(rows, columns, observation_format)
+        os.makedirs(path, exist_ok=True)
+        self.shards = []
+        self._arrays = None
+        self._count = 0
+        self._episode_start = True
+
+    def add(self, observation, action, reward, terminated, truncated, action_masks):
+        if self._arrays is None:
+            self._open_shard()
+        i = self._count
+        arrays = self._arrays
+        (from_row, from_col), (to_row, to_col) = action
+        arrays["observations"][i] = observation
+        arrays["actions"][i] = (from_row, from_col, to_row, to_col)
+        arrays["rewards"][i] = reward
+        arrays["terminated"][i] = terminated
+        arrays["truncated"][i] = truncated
+        arrays["episode_starts"][i] = self._episode_start
+        arrays["action_masks"][i] = np.packbits(action_masks)
+        self._episode_start = terminated or truncated
+        self._count += 1
+        if self._count == self.shard_size:
+            self._close_shard()
+
+    def end_episode(self):
+        #for episodes that stop without terminated or truncated, the next transition starts a new one
+        self._episode_start = True
+
+    def close(self):
+        if self._arrays is not None:
+            self._close_shard()
+
+    def _open_shard(self):
+        index = len(self.shards)
+        self._arrays = {field: np.lib.format.open_memmap(self._file(field, index), mode="w+", dtype=dtype, shape=(self.shard_size, *shape))
+                        for field, (shape, dtype) in self.fields.items()}
+        self._count = 0
+
+    def _close_shard(self):
+        for array in self._arrays.values():
+            array.flush()
+        self._arrays = None
+        self.shards.append(self._count)
+        self._write_manifest()
+
+    def _file(self, field, index):
+        return os.path.join(self.path, f"{field}_{index:05d}.npy")
+
+    def _write_manifest(self):
+        manifest = {
+            "version": DATASET_VERSION,
+            "rows": self.row_count,
+            "columns": self.col_count,
+            "channels": [channel.name for channel in CnnChannels],
+            "observation_format": self.observation_format,
+            "shard_size": self.shard_size,
+            "shards": self.shards,
+            "count": sum(self.shards),
+        }
+        #written next to the old one and swapped in, a reader never sees half a manifest
+        temporary = os.path.join(self.path, MANIFEST + ".tmp")
+        with open(temporary, "w") as file:
+            json.dump(manifest, file, indent=2)
+        os.replace(temporary, os.path.join(self.path, MANIFEST))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class DatasetRecorder(gym.Wrapper):
+    #writes every transition of a Civ6CombatEnv into a DatasetWriter, with the action masks of the observation
+    def __init__(self, env, writer):
+        super().__init__(env)
+        if writer.observation_format != env.unwrapped.observation_format:
+            raise ValueError(f"The env gives {env.unwrapped.observation_format} observations but the writer stores {writer.observation_format}")
+        self.writer = writer
+        self._observation = None
+
+    def reset(self, **kwargs):
+        self.writer.end_episode()
+        self._observation, info = self.env.reset(**kwargs)
+        return self._observation, info
+
+    def step(self, action):
+        masks = self.env.unwrapped.action_masks()
+        observation, reward, terminated, truncated, info = self.env.step(action)
+        self.writer.add(self._observation, action, reward, terminated, truncated, masks)
+        self._observation = observation
+        return observation, reward, terminated, truncated, info
+
+    def close(self):
+        self.writer.close()
+        super().close()
+
+
+class DatasetReader:
+    """
+    Random minibatches straight from the memory mapped shards, only the sampled transitions are read from disk.
+    The next observation of a transition is the observation of the following one unless the episode ended.
+    Compact observations are decoded to float32 per batch, decode=False keeps them as they were stored.
+    """
+
+    def __init__(self, path, decode=True):
+        self.path = path
+        with open(os.path.join(path, MANIFEST)) as file:
+            self.manifest = json.load(file)
+        if self.manifest["version"] != DATASET_VERSION:
+            raise ValueError(f"Dataset version {self.manifest['version']} is not supported, expected {DATASET_VERSION}")
+        self.row_count = self.manifest["rows"]
+        self.col_count = self.manifest["columns"]
+        if self.manifest["channels"] != [channel.name for channel in CnnChannels]:
+            raise ValueError(f"Dataset {path} was written with different observation channels")
+        #datasets written before observation formats only hold float32 observations
+        self.observation_format = self.manifest.get("observation_format", "float32")
+        self.decode = decode
+        self.fields = dataset_fields(self.row_count, self.col_count, self.observation_format)
+        self.shards = [{field: np.load(os.path.join(path, f"{field}_{index:05d}.npy"), mmap_mode="r") for field in self.fields}
+                       for index in range(len(self.manifest["shards"]))]
+        #first global index of every shard
+        self.offsets = np.concatenate([[0], np.cumsum(self.manifest["shards"])])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def get(self, indices):
+        #transitions at global indices as a dict of arrays, action masks unpacked to (batch, tiles, tiles)
+        indices = np.asarray(indices)
+        shards = np.searchsorted(self.offsets, indices, side="right") - 1
+        batch = {field: np.empty((len(indices), *shape), dtype=dtype) for field, (shape, dtype) in self.fields.items()}
+        for shard in np.unique(shards):
+            selected = np.flatnonzero(shards == shard)
+            rows = indices[selected] - self.offsets[shard]
+            #sorted rows read the memory map front to back
+            order = np.argsort(rows)
+            for field, array in self.shards[shard].items():
+                batch[field][selected[order]] = array[rows[order]]
+        tiles = self.row_count * self.col_count
+        batch["action_masks"] = np.unpackbits(batch["action_masks"], axis=1, count=tiles * tiles).astype(bool).reshape(-1, tiles, tiles)
+        if self.decode:
+            batch["observations"] = decode_observations(batch["observations"], self.observation_format, self.row_count, self.col_count)
+        return batch
+
+    def sample(self, batch_size, np_random=None):
+        np_random = np_random if np_random is not None else np.random.default_rng()
+        return self.get(np_random.integers(len(self), size=batch_size))
+
+    def batches(self, batch_size, np_random=None, shuffle=True):
+        #one pass over the dataset
+        indices = np.arange(len(self))
+        if shuffle:
+            (np_random if np_random is not None else np.random.default_rng()).shuffle(indices)
+        for start in range(0, len(indices), batch_size):
+            yield self.get(indices[start:start + batch_size])
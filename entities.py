@@ -1,39 +1,34 @@
-import pygame
-from pygame.math import Vector2
 from abc import ABC, abstractmethod
-import random
 import math
-from collections import deque
+import heapq
 import numpy as np
 
+from assets import render_cache
+from hex_geometry import neighbor_lists, flat_index
+from kernels import combat_damage
 from options import Colors, FortifiedBonus, PLAYER_COLOR, BOT_COLORS, MARGIN, Rewards, \
-                    DIRECTIONS_ODD, DIRECTIONS_EVEN, HEX_SIZE, worldToScreen, \
-                    draw_centered
+                    HEX_SIZE, worldToScreen, draw_centered
 
 class Player:
-    __id_counter = 0
-    def __init__(self, name):
-        self.id = Player.__id_counter
-        Player.__id_counter += 1
+    #ids are given by the environment and go from 0 to the number of players, they are stored in int16 grids
+    #troops and buildings are kept by the terrain's EntityRegistry, the lists here are built from it in id order
+    def __init__(self, name, id, registry):
+        self.id = id
         self.name = name
-        self.troops = []
-        self.buildings = []
+        self.registry = registry
 
-class Entity(ABC):
-    BASE_WARRIOR_IMAGE = pygame.image.load('./images/warrior.png')
-    BASE_ARCHER_IMAGE = pygame.image.load('./images/archer.png')
-    BASE_CITY_CENTER_IMAGE = pygame.image.load('./images/city_center.png')
-    WARRIOR_IMAGE = pygame.transform.scale(BASE_WARRIOR_IMAGE, (HEX_SIZE / 2, HEX_SIZE / 2))
-    ARCHER_IMAGE = pygame.transform.scale(BASE_ARCHER_IMAGE, (HEX_SIZE / 2, HEX_SIZE / 2))
-    CITY_CENTER_IMAGE = pygame.transform.scale(BASE_CITY_CENTER_IMAGE, (HEX_SIZE / 2, HEX_SIZE / 2))
-
-    def update_images(self, scale):
-        new_size = HEX_SIZE / 2 * scale.x
-        Entity.WARRIOR_IMAGE = pygame.transform.scale(Entity.BASE_WARRIOR_IMAGE, (new_size, new_size))
-        Entity.ARCHER_IMAGE = pygame.transform.scale(Entity.BASE_ARCHER_IMAGE, (new_size, new_size))
-        Entity.CITY_CENTER_IMAGE = pygame.transform.scale(Entity.BASE_CITY_CENTER_IMAGE, (new_size, new_size))
+    @property
+    def troops(self):
+        return self.registry.troops(self.id)
+
+    @property
+    def buildings(self):
+        return self.registry.buildings(self.id)
 
+class Entity(ABC):
     def __init__(self, health, max_health, power, player_id, row, col, hp_power_loss, attack_range):
+        #set by Terrain.add_entity
+        self.id = None
         self.health = health
         self.max_health = max_health
         self.power = power
@@ -43,6 +38,9 @@ class Entity(ABC):
         self.hp_power_loss = hp_power_loss
         self.attack_range = attack_range
     def draw(self, window, player_id, image, offset, scale):
+        import pygame
+        from pygame.math import Vector2
+        image = render_cache.get(scale).images[image]
         x = (HEX_SIZE * self.col + (HEX_SIZE / 2 * (self.row % 2))) + HEX_SIZE / 2 + MARGIN
         y = (HEX_SIZE * 0.75 * self.row) + HEX_SIZE / 2 + MARGIN
 
@@ -64,24 +62,26 @@ class Entity(ABC):
             pygame.draw.circle(window, PLAYER_COLOR, pos, circle_radius, circle_width)
 
     @abstractmethod
-    def kill(self, tiles):
+    def kill(self, terrain):
         """
         What happens when this Entity is killed, rewards and other things.
         """
 
     @abstractmethod
-    def remove_from_tiles(self, tiles):
+    def remove_from_tiles(self, terrain):
         """
-        removes the entity from tiles array
+        removes the entity from the terrain id grid
         """
 
     @abstractmethod
-    def add_to_tiles(self, tiles):
+    def add_to_tiles(self, terrain, row, col):
         """
-        adds the entity to tiles array
+        adds the entity to the terrain id grid
         """
     
     def _draw_attributes(self, window, x, y, offset, scale):
+        import pygame
+        from pygame.math import Vector2
         health_bar_width = HEX_SIZE / 2
         health = self.health / self.max_health
         green_width = int(health * health_bar_width * scale.x) 
@@ -97,8 +97,7 @@ class Entity(ABC):
         pygame.draw.rect(window, Colors.HEALTH_LOST.value, (pos.x + green_width, pos.y, red_width, health_bar_height))  # Red part
 
         # Power number
-        font = pygame.font.Font(None, int(HEX_SIZE/5 * scale.x))  
-        power_text = font.render(str(self.power), True, Colors.BLACK.value) 
+        power_text = render_cache.get(scale).text(str(self.power), Colors.BLACK.value)
         power_y = y-HEX_SIZE/3
         power_pos = worldToScreen(Vector2(x,power_y), offset, scale)
         draw_centered(window, power_text, power_pos)
@@ -109,11 +108,27 @@ class Troop(Entity, ABC):
 
     def __init__(self, moves, max_moves, health, max_health, power, player_id, row, col, fortified, hp_power_loss, attack_range):
         super().__init__(health, max_health, power, player_id, row, col, hp_power_loss, attack_range)
+        #set by EntityRegistry.add, which keeps a has moves flag per troop
+        self.registry = None
         self.moves = moves
         self.max_moves = max_moves
         self.fortified = fortified
+        self._reachable_key = None
+        self._reachable = None
+
+    @property
+    def moves(self):
+        return self._moves
+
+    @moves.setter
+    def moves(self, moves):
+        self._moves = moves
+        if self.registry is not None:
+            self.registry.has_moves[self.id] = moves > 0
 
     def _draw_attributes(self, window, x, y, offset, scale):
+        import pygame
+        from pygame.math import Vector2
 
         health_bar_width = HEX_SIZE / 2
         health = self.health / self.max_health
@@ -136,16 +151,14 @@ class Troop(Entity, ABC):
         pygame.draw.rect(window, Colors.HEALTH_LOST.value, (pos.x + green_width, pos.y, red_width, health_bar_height))  # Red part
 
         # Movement points
-        font = pygame.font.Font(None, int(HEX_SIZE/5*scale.x))
-        movement_text = font.render(f"{self.moves}/{self.max_moves}", True, Colors.BLACK.value)
+        movement_text = render_cache.get(scale).text(f"{self.moves}/{self.max_moves}", Colors.BLACK.value)
         movement_x = health_bar_x+health_bar_width/2
         movement_y = health_bar_y+HEX_SIZE/30
         move_pos = worldToScreen(Vector2(movement_x, movement_y), offset, scale)
         draw_centered(window, movement_text, move_pos)
 
         # Power number
-        font = pygame.font.Font(None, int(HEX_SIZE/5 * scale.x))  
-        power_text = font.render(str(self.power), True, Colors.BLACK.value) 
+        power_text = render_cache.get(scale).text(str(self.power), Colors.BLACK.value)
         power_y = y-HEX_SIZE/3
         power_pos = worldToScreen(Vector2(x,power_y), offset, scale)
         draw_centered(window, power_text, power_pos)
@@ -164,70 +177,100 @@ class Troop(Entity, ABC):
         self.moves = 0
         return Rewards.DEFAULT.value
 
-    def move(self, new_row, new_col, moves, tiles):
+    def move(self, new_row, new_col, moves, terrain):
         self._remove_fortify_bonus()
-        self.remove_from_tiles(tiles)
-        self.add_to_tiles(tiles, new_row, new_col)
+        self.remove_from_tiles(terrain)
+        self.add_to_tiles(terrain, new_row, new_col)
 
         self.moves -= moves
         self.row = new_row
         self.col = new_col        
         return Rewards.DEFAULT.value
     
-    def remove_from_tiles(self, tiles):
-        tiles[self.row, self.col].troop = None
+    def remove_from_tiles(self, terrain):
+        terrain.set_troop(self.row, self.col, -1)
     
-    def add_to_tiles(self, tiles, row, col):
-        tiles[row, col].troop = self
+    def add_to_tiles(self, terrain, row, col):
+        terrain.set_troop(row, col, self.id)
 
-    def kill(self, tiles):
+    def kill(self, terrain):
         self.health = 0
-        self.remove_from_tiles(tiles)
+        self.remove_from_tiles(terrain)
+        terrain.registry.alive[self.id] = False
+        if terrain.profiler is not None:
+            terrain.profiler.count("kills")
         return Rewards.KILL_TROOP.value
 
     @abstractmethod
-    def attack(self, defender, tiles):
+    def attack(self, defender, terrain):
         """
         Implement seperate attack method for each Troop type to deal the damage
         """
-    #can pass through team and enemy troops
-    def get_reachable_pos(self, tiles):
-        observation = np.full((len(tiles), len(tiles[0])), -1.0)
-        queue = deque([(self.row, self.col, 0, 0)])
-        max_moves = self.moves
-
-        def is_valid_tile(x, y):
-            return 0 <= x < len(tiles) and 0 <= y < len(tiles[0])
-
-        while queue:
-            curr_x, curr_y, moves, attack_moves = queue.popleft()
-
-            curr_tile = tiles[curr_x, curr_y]
-            curr_obs = observation[curr_x, curr_y]
-
-            if (curr_obs >= 0 and curr_obs < moves) or curr_obs == -2 or curr_obs == 0 or curr_tile.obstacle:
+    #blocked by team troops, enemies can be attacked if they are within attack_range hexes of walkable tiles
+    #results are cached until the board changes or the troop's moves change
+    def get_reachable_pos(self, terrain):
+        key = (terrain.version, self.moves)
+        if self._reachable_key == key:
+            return self._reachable
+        if terrain.profiler is not None:
+            terrain.profiler.count("bfs")
+        cols = terrain.column_count
+        neighbors = neighbor_lists(terrain.row_count, cols)
+        move_cost = terrain.move_cost.reshape(-1)
+        obstacle = terrain.obstacle.reshape(-1)
+        troop_ids = terrain.troop_ids.reshape(-1)
+        building_ids = terrain.building_ids.reshape(-1)
+        start = flat_index(self.row, self.col, cols)
+
+        def is_walkable(tile):
+            if obstacle[tile] or troop_ids[tile] >= 0:
+                return False
+            return building_ids[tile] < 0 or terrain.entities[building_ids[tile]].player_id == self.player_id
+
+        #cheapest cost with a priority queue, only tiles cheaper than the remaining moves expand
+        costs = {start: 0}
+        heap = [(0, start)]
+        while heap:
+            cost, tile = heapq.heappop(heap)
+            if cost > costs[tile] or cost >= self.moves:
                 continue
-
-            tile_troop = curr_tile.troop
-            tile_building = curr_tile.building
-
-            if tile_troop and tile_troop.player_id == self.player_id and (curr_x, curr_y) != (self.row, self.col):
-                observation[curr_x, curr_y] = 0
+            for neighbor in neighbors[tile]:
+                new_cost = cost + move_cost[neighbor]
+                if new_cost <= self.moves and new_cost < costs.get(neighbor, math.inf) and is_walkable(neighbor):
+                    costs[neighbor] = new_cost
+                    heapq.heappush(heap, (new_cost, neighbor))
+
+        #fewest hexes, only needed up to the attack range
+        hops = {start: 0}
+        frontier = [start]
+        for hop in range(1, self.attack_range):
+            frontier = [neighbor for tile in frontier for neighbor in neighbors[tile] if neighbor not in hops and is_walkable(neighbor)]
+            hops.update((tile, hop) for tile in frontier)
+
+        observation = np.full(terrain.row_count * cols, -1.0)
+        for tile, cost in costs.items():
+            observation[tile] = cost
+
+        #occupied tiles next to expanding tiles are attack targets or blocked
+        for tile in costs.keys() | hops.keys():
+            hop = hops.get(tile, self.attack_range)
+            if not (costs.get(tile, math.inf) < self.moves or hop < self.attack_range or tile == start):
                 continue
-            elif (tile_troop and tile_troop.player_id != self.player_id) or (tile_building and tile_building.player_id != self.player_id):
-                observation[curr_x, curr_y] = -2 if attack_moves <= self.attack_range else 0
-                continue
-            elif moves <= self.moves:
-                observation[curr_x, curr_y] = moves
-
-            if moves < max_moves or attack_moves < self.attack_range:
-                directions = DIRECTIONS_EVEN if curr_x % 2 == 0 else DIRECTIONS_ODD
-                for dx, dy in directions:
-                    nx, ny = curr_x + dx, curr_y + dy
-                    if is_valid_tile(nx, ny):
-                        queue.append((nx, ny, moves + tiles[nx, ny].move_cost, attack_moves+1))
-
-        observation[self.row, self.col] = self.max_moves
+            for neighbor in neighbors[tile]:
+                if obstacle[neighbor] or observation[neighbor] == -2 or neighbor == start:
+                    continue
+                troop = terrain.entities[troop_ids[neighbor]] if troop_ids[neighbor] >= 0 else None
+                building = terrain.entities[building_ids[neighbor]] if building_ids[neighbor] >= 0 else None
+                if troop and troop.player_id == self.player_id:
+                    observation[neighbor] = 0
+                elif (troop and troop.player_id != self.player_id) or (building and building.player_id != self.player_id):
+                    observation[neighbor] = -2 if hop < self.attack_range else 0
+
+        observation[start] = self.max_moves
+        observation = observation.reshape(terrain.row_count, cols)
+        observation.flags.writeable = False
+        self._reachable_key = key
+        self._reachable = observation
         return observation
     
     def _remove_fortify_bonus(self):
@@ -240,7 +283,7 @@ class Troop(Entity, ABC):
         self.power -= self.hp_power_loss
 
     @abstractmethod
-    def _handle_attack_result(self, defender, tiles):
+    def _handle_attack_result(self, defender, terrain):
         """
         Implement method that handles the result of the fight after each troop has taken damage"""
 
@@ -250,20 +293,19 @@ class Warrior(Troop):
         super().__init__(moves, max_moves, health, max_health, power, player_id, row, col, fortified, hp_power_loss, attack_range)
 
     def draw(self, window, player_id, offset, scale):
-        self.update_images(scale)
-        super().draw(window, player_id, Entity.WARRIOR_IMAGE, offset, scale)
+        super().draw(window, player_id, 'warrior.png', offset, scale)
 
-    def attack(self, defender, tiles):
+    def attack(self, defender, terrain):
         self.moves = 0
         self._remove_fortify_bonus()
        
         def_power = defender.power 
         attack_power = self.power
 
-        #formula: Damage(HP)=30*e^{0.04*StrengthDifference}*randomBetween(0.8-1.2)}
-        rand = random.uniform(0.8, 1.2)
-        damage_to_defender = 30*math.exp(0.04 * (attack_power-def_power)) * rand
-        damage_to_attacker = 30*math.exp(0.04 * (def_power-attack_power)) * rand
+        #formula: Damage(HP)=30*e^{0.04*StrengthDifference}*randomBetween(0.8-1.2)}, the exponential is looked up
+        rand = terrain.np_random.uniform(0.8, 1.2)
+        damage_to_defender = combat_damage(attack_power-def_power) * rand
+        damage_to_attacker = combat_damage(def_power-attack_power) * rand
         defender.health -= damage_to_defender
         self.health -= damage_to_attacker
         
@@ -271,11 +313,11 @@ class Warrior(Troop):
         if isinstance(defender, Troop):
             defender._update_hp_power_loss()
 
-        reward = self._handle_attack_result(defender, tiles)
+        reward = self._handle_attack_result(defender, terrain)
 
         return reward
     
-    def _handle_attack_result(self, defender, tiles):
+    def _handle_attack_result(self, defender, terrain):
         reward = Rewards.ATTACK.value
 
         # Determine the unit to kill and potentially revive.
@@ -288,12 +330,12 @@ class Warrior(Troop):
                 # Only one unit is dead.
                 survivor, victim = (self, defender) if defender.health <= 0 else (defender, self)
 
-            kill_reward = victim.kill(tiles)
+            kill_reward = victim.kill(terrain)
 
             # Handle rewards and movement if applicable.
             reward += kill_reward if survivor == self else -kill_reward
             if survivor == self:
-                self.move(defender.row, defender.col, 0, tiles)
+                self.move(defender.row, defender.col, 0, terrain)
 
         return reward
 
@@ -303,34 +345,33 @@ class Archer(Troop):
         super().__init__(moves, max_moves, health, max_health, power, player_id, row, col, fortified, hp_power_loss, attack_range)
 
     def draw(self, window, player_id, offset, scale):
-        self.update_images(scale)
-        super().draw(window, player_id, Entity.ARCHER_IMAGE, offset, scale)
+        super().draw(window, player_id, 'archer.png', offset, scale)
 
-    def attack(self, defender, tiles):
+    def attack(self, defender, terrain):
         self.moves = 0
         self._remove_fortify_bonus()
         #get the defending and attacking troops power
         def_power = defender.power 
         attack_power = self.power
 
-        #formula: Damage(HP)=30*e^{0.04*StrengthDifference}*randomBetween(0.8-1.2)}
-        rand = random.uniform(0.8, 1.2)
-        damage_to_defender = 30*math.exp(0.04 * (attack_power-def_power)) * rand
+        #formula: Damage(HP)=30*e^{0.04*StrengthDifference}*randomBetween(0.8-1.2)}, the exponential is looked up
+        rand = terrain.np_random.uniform(0.8, 1.2)
+        damage_to_defender = combat_damage(attack_power-def_power) * rand
 
         defender.health -= damage_to_defender
         
         if isinstance(defender, Troop):
             defender._update_hp_power_loss()
 
-        reward = self._handle_attack_result(defender, tiles)
+        reward = self._handle_attack_result(defender, terrain)
 
         return reward
     
-    def _handle_attack_result(self, defender, tiles):
+    def _handle_attack_result(self, defender, terrain):
         reward = Rewards.ATTACK.value
 
         if defender.health <= 0:
-            reward += defender.kill(tiles)
+            reward += defender.kill(terrain)
 
         return reward
 
@@ -339,16 +380,18 @@ class Center(Entity):
         super().__init__(health, max_health, power, player_id, row, col, hp_power_loss, attack_range)
 
     def draw(self, window, player_id, offset, scale):
-        self.update_images(scale)
-        super().draw(window, player_id, Entity.CITY_CENTER_IMAGE, offset, scale)
+        super().draw(window, player_id, 'city_center.png', offset, scale)
 
-    def kill(self, tiles):
+    def kill(self, terrain):
         self.health = 0
-        self.remove_from_tiles(tiles)
+        self.remove_from_tiles(terrain)
+        terrain.registry.alive[self.id] = False
+        if terrain.profiler is not None:
+            terrain.profiler.count("kills")
         return Rewards.KILL_CITY.value
     
-    def remove_from_tiles(self, tiles):
-        tiles[self.row, self.col].building = None
+    def remove_from_tiles(self, terrain):
+        terrain.set_building(self.row, self.col, -1)
 
-    def add_to_tiles(self, tiles, row, col):
-        tiles[row, col].building = self
\ No newline at end of file
+    def add_to_tiles(self, terrain, row, col):
+        terrain.set_building(row, col, self.id)
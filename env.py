@@ -1,21 +1,25 @@
-import pygame
 import gymnasium as gym
 import numpy as np
-import random
-from pygame.math import Vector2
-from collections import deque
 
+from assets import render_cache
+from renderer import BoardRenderer
+from map_bank import MapBank
+from state import GameState, entities_to_array
+from bots import BotPolicy, BOT_POLICIES
+from profiling import StepProfiler
 from terrain import Terrain
+from observation import ObservationBuilder, egocentric_windows, egocentric_space, OBSERVATION_FORMATS, format_space, encode_observations
 from entities import Warrior, Archer, Center, Player
-from options import CnnChannels, DIRECTIONS_EVEN, DIRECTIONS_ODD, Rewards, \
-     MARGIN, Colors, HEX_SIZE, screenToWorld
+from hex_geometry import within_range, bfs_order, flat_index
+from options import Rewards, MARGIN, Colors, HEX_SIZE, screenToWorld
 
 class Civ6CombatEnv(gym.Env):
     """Custom Environment that follows gym interface."""
 
     metadata = {"render_modes": ["human", "interactable"], "render_fps": 2}
 
-    def __init__(self, rows=6, columns=6, max_steps=100, render_mode=None, bots=1, start_troops=2, fps=None):
+    def __init__(self, rows=6, columns=6, max_steps=100, render_mode=None, bots=1, start_troops=2, fps=None, map_bank=None, bot_policy="random", profile=False,
+                 observation_mode="board", window_size=9, max_windows=16, observation_format="float32"):
         super().__init__()
         if fps:
             self.metadata["render_fps"] = fps
@@ -26,6 +30,21 @@ class Civ6CombatEnv(gym.Env):
         self.start_troop_count = start_troops
         self.bots = []
 
+        #starting positions are sampled from the bank instead of generated, MapBank or its path
+        if isinstance(map_bank, str):
+            map_bank = MapBank(map_bank)
+        if map_bank is not None:
+            map_bank.check(rows, columns, bots, start_troops)
+        self.map_bank = map_bank
+        #plays the bots' turns, a BotPolicy or the name of one like in Civ6CombatVectorEnv, see bots.py
+        if isinstance(bot_policy, str):
+            assert bot_policy in BOT_POLICIES, f"Invalid bot policy {bot_policy}, available policies are {list(BOT_POLICIES)}"
+            bot_policy = BOT_POLICIES[bot_policy]()
+        assert isinstance(bot_policy, BotPolicy), f"Invalid bot policy {bot_policy}"
+        self.bot_policy = bot_policy
+        #per phase timings and counters in info["profile"], None when off so the hot paths only check for None
+        self.profiler = StepProfiler() if profile else None
+
         #Game stats
         self.last_game_won = None
         self.score = 0
@@ -33,14 +52,15 @@ class Civ6CombatEnv(gym.Env):
         self.wins = 0
         self.losses = 0
 
-        #pygame variables (declared in reset)
+        #pygame variables (declared in reset), pygame is only imported when a render mode is used
         self.window = None
         self.clock = None
         self.screen_height = None
         self.screen_width = None
-        #set offset to margin later, then remove margin from all other places
-        self.offset = pygame.math.Vector2(0, 0)
-        self.scale = pygame.math.Vector2(1, 1)
+        self.offset = None
+        self.scale = None
+        self.renderer = None
+        self.observation_builder = None
 
         self.action_space = gym.spaces.Tuple((
             gym.spaces.Tuple((gym.spaces.Discrete(rows), gym.spaces.Discrete(columns))), # Tuple for 'what to move'
@@ -48,7 +68,22 @@ class Civ6CombatEnv(gym.Env):
         ))
         
         #this will change, I have no idea what should the observations be
-        self.observation_space = gym.spaces.Box(low=-1, high=1, shape=(len(CnnChannels), self.col_count, self.row_count,), dtype=np.float32)
+        #"egocentric" gives max_windows window_size x window_size crops around the player's troops then cities instead of the
+        #whole board, so the observation doesn't grow with the map, see observation.egocentric_windows
+        assert observation_mode in ["board", "egocentric"], f"Invalid observation mode {observation_mode}"
+        self.observation_mode = observation_mode
+        self.window_size = window_size
+        self.max_windows = max_windows
+        self.window_centers = None
+        #"int8" and "packed" are smaller encodings of the board observation, observation.decode_observations
+        #turns them back into float32 for the learner
+        assert observation_format in OBSERVATION_FORMATS, f"Invalid observation format {observation_format}"
+        assert observation_format == "float32" or observation_mode == "board", "Compact observation formats only support the board observation"
+        self.observation_format = observation_format
+        if observation_mode == "egocentric":
+            self.observation_space = egocentric_space(window_size, max_windows)
+        else:
+            self.observation_space = format_space(observation_format, self.row_count, self.col_count)
         
         #check if render_mode is valid
         assert render_mode is None or render_mode in self.metadata["render_modes"], f"Invalid render mode, available render modes are {self.metadata['render_modes']}"
@@ -58,20 +93,88 @@ class Civ6CombatEnv(gym.Env):
 
 
     def _get_obs(self):
-        observation = self.terrain.get_obs(self.player)
-        return observation
+        #the crops and compact formats are new arrays anyway, only the float32 board needs its own copy
+        copy = self.observation_mode == "board" and self.observation_format == "float32"
+        observation = self._observations().get(copy)
+        if self.observation_mode == "egocentric":
+            registry = self.terrain.registry
+            ids = np.concatenate([registry.troop_ids(self.player.id), registry.building_ids(self.player.id)])[:self.max_windows]
+            #(row, col) of the unit or city every window is centered on, -1 for unused windows, returned in info
+            self.window_centers = np.full((self.max_windows, 2), -1, dtype=np.int32)
+            for window, entity_id in enumerate(ids.tolist()):
+                self.window_centers[window] = registry.entities[entity_id].row, registry.entities[entity_id].col
+            observation = egocentric_windows(observation, self.window_centers[:len(ids)], self.window_size, self.max_windows)
+        return encode_observations(observation, self.observation_format)
     
+    def _observations(self):
+        #the builder is skipped by set_state(observe=False), it's built on the first observation after that
+        if self.observation_builder is None:
+            self.observation_builder = ObservationBuilder(self.terrain, self.player)
+            self.terrain.add_observer(self.observation_builder)
+        return self.observation_builder
+
     def _get_info(self):
-        return {}
+        info = {}
+        if self.window_centers is not None:
+            info["window_centers"] = self.window_centers
+        if self.profiler is not None:
+            info["profile"] = self.profiler.finish()
+        return info
+
+    def _lap(self, phase):
+        if self.profiler is not None:
+            self.profiler.lap(phase)
+
+    def get_state(self):
+        """Snapshot of the current game as a GameState, the env's random generator state included"""
+        terrain = self.terrain
+        return GameState(terrain.tile_type.copy(), terrain.owner.copy(), terrain.troop_ids.copy(), terrain.building_ids.copy(),
+                         entities_to_array(terrain.registry), len(self.bots) + 1,
+                         self.curr_steps, self.score, self.np_random.bit_generator.state)
+
+    def set_state(self, state : GameState, restore_rng=True, observe=True):
+        #continues the game from state, the same state can be restored any number of times
+        #observe=False leaves the observation planes until they are asked for, for simulators that never read them
+        draw = self.render_mode in ["human", "interactable"]
+        self.terrain, players = state.to_game(draw, self.np_random)
+        self.terrain.profiler = self.profiler
+        self.player, self.bots = players[0], players[1:]
+        self.curr_steps = state.curr_steps
+        self.score = state.score
+        if restore_rng and state.rng_state is not None:
+            self.np_random.bit_generator.state = state.rng_state
+
+        self.observation_builder = None
+        if observe:
+            self._observations()
+        if draw:
+            self.renderer = BoardRenderer(self.terrain, self.player.id)
+
+    def action_masks(self):
+        """
+        Legal actions of the player for the current turn, (rows*cols, rows*cols) bool with [from tile, to tile].
+        Tiles are flat indices row*columns + col, a flat policy over rows*cols*rows*cols actions can use
+        action_masks().reshape(-1) and turn its choice back into an action with decode_action.
+        """
+        return self.terrain.action_masks(self.player.id)
+
+    def decode_action(self, index):
+        #flat index of action_masks().reshape(-1) -> ((from_row, from_col), (to_row, to_col))
+        from_tile, to_tile = divmod(int(index), self.row_count * self.col_count)
+        return divmod(from_tile, self.col_count), divmod(to_tile, self.col_count)
 
     def step(self, action):
+        if self.profiler is not None:
+            self.profiler.start()
         #do the action
-        reward = self.terrain.action(action, self.player.troops)
+        reward = self.terrain.action(action, self.player.id)
+        self._lap("action")
 
         second_reward, terminated, truncated = self._after_step()
         reward += second_reward
         
         observation = self._get_obs()
+        self._lap("get_obs")
         info = self._get_info()
 
         #doesn't update instantly, only shows the scores updated in the last step
@@ -87,12 +190,15 @@ class Civ6CombatEnv(gym.Env):
         reward -= self._cleanup(self.player)
         for bot in self.bots:
             reward += self._cleanup(bot)
+        self._lap("cleanup")
 
         if self.render_mode in ["human", "interactable"]:
             self._render_frame()
+            self._lap("render")
 
         #do ai move, reset player moves
-        ai_turn = all([troop.moves<=0 for troop in self.player.troops])
+        registry = self.terrain.registry
+        ai_turn = registry.turn_over(self.player.id)
         if ai_turn:
             self._reset_moves(self.player)
             for bot in self.bots:
@@ -101,21 +207,23 @@ class Civ6CombatEnv(gym.Env):
                 #Need to clear all bots, because he could have killed any of them. Need to do this better.
                 for cleanup_bot in self.bots:
                     self._cleanup(cleanup_bot)
+            self._lap("ai_sim")
 
             reward -= self._cleanup(self.player)
+            self._lap("cleanup")
 
         self.curr_steps += 1
         truncated = self.curr_steps >= self.max_steps
 
         #check if player lost
-        if len(self.player.troops) == 0 or len(self.player.buildings) == 0 or truncated:
+        if registry.troop_count(self.player.id) == 0 or registry.building_count(self.player.id) == 0 or truncated:
             terminated = True
             reward -= Rewards.WIN_GAME.value
             self.last_game_won = False
             self.losses += 1
 
         #check if player won
-        if all([len(bot.buildings)==0 for bot in self.bots]):
+        if all([registry.building_count(bot.id)==0 for bot in self.bots]):
             terminated = True
             reward += Rewards.WIN_GAME.value
             self.last_game_won = True
@@ -124,103 +232,118 @@ class Civ6CombatEnv(gym.Env):
         return reward, terminated, truncated
     
     def _ai_sim(self, bot : Player):
+        return self.bot_policy.play_turn(self, bot)
+
+    def bot_action(self, action, bot : Player):
+        #applies one action of a bot for a BotPolicy, returns the reward if it attacked the player
+        (_, _), (target_row, target_col) = action
+        target_troop = self.terrain.get_troop(target_row, target_col)
+        target_building = self.terrain.get_building(target_row, target_col)
+
         reward = 0
-        troops = deque([troop for troop in bot.troops if troop.moves > 0])
-        while troops:
-            troop = troops.popleft()
-            possible_moves = troop.get_reachable_pos(self.terrain.tiles)
-            indices = np.where((possible_moves > 0) | (possible_moves == -2))
-            random_index = np.random.choice(range(len(indices[0])))
-
-            # Get the row and column of a random valid action
-            target_row = indices[0][random_index]
-            target_col = indices[1][random_index]
-
-            target_troop = self.terrain.tiles[target_row, target_col].troop
-            target_building = self.terrain.tiles[target_row, target_col].building
-
-            curr_reward = self.terrain.action(((troop.row, troop.col), (target_row, target_col)), troops)
-            #We only care about rewards when the AI attacks the player
-            if (target_troop and target_troop.player_id == self.player.id or \
-                target_building and target_building.player_id == self.player.id):
-                reward += curr_reward
-
-            if self.render_mode in ["human", "interactable"]:
-                self._render_frame()
-            #if still has moves, put it back
-            if troop.moves > 0:
-                troops.append(troop)
+        #an invalid action becomes a random move, its penalty is the bot's own and not the player's gain
+        valid = self.terrain.is_valid_action(action, bot.id)
+        curr_reward = self.terrain.action(action, bot.id)
+        #We only care about rewards when the AI attacks the player
+        if valid and (target_troop and target_troop.player_id == self.player.id or \
+            target_building and target_building.player_id == self.player.id):
+            reward += curr_reward
+
+        if self.render_mode in ["human", "interactable"]:
+            self._render_frame()
         return reward
     
     #removes dead troops and buildings from players
     def _cleanup(self, player : Player):
         reward = 0
+        registry = self.terrain.registry
         #don't count reward for regular removals, reward already counted before this
-        for building in player.buildings:
-            if building.health <= 0:
-                player.buildings.remove(building)
+        registry.remove_dead(player.id)
         #if eliminating a CIV you also kill all the troops so bonus reward
-        if len(player.buildings) == 0:
-            self.terrain._cleanup(player.troops)
-            for troop in player.troops:
-                reward += troop.kill(self.terrain.tiles)
-            player.troops = []
-        else: 
+        if registry.building_count(player.id) == 0:
             for troop in player.troops:
-                if troop.health <= 0:
-                    player.troops.remove(troop)
+                reward += troop.kill(self.terrain)
+            registry.clear_troops(player.id)
         return reward 
 
 
 
     def reset(self, seed=None, options=None):
         super().reset(seed=seed)
+        if self.profiler is not None:
+            self.profiler.start()
 
         if self.render_mode in ["human", "interactable"] and self.window == None and self.clock == None:
+            import pygame
             pygame.init()
             pygame.display.init()
             infoObject = pygame.display.Info()
             self.screen_width, self.screen_height = infoObject.current_w, infoObject.current_h
             self.window = pygame.display.set_mode((self.screen_width, self.screen_height), pygame.RESIZABLE)
             self.clock = pygame.time.Clock()
+            #set offset to margin later, then remove margin from all other places
+            self.offset = pygame.math.Vector2(0, 0)
+            self.scale = pygame.math.Vector2(1, 1)
 
         self.all_scores += self.score
         self.score = 0
 
         self.curr_steps = 0
 
+        #options={"map_index": i} picks a fixed position from the map bank, e.g. for evaluation
+        tile_type = None
+        if self.map_bank is not None:
+            if options and "map_index" in options:
+                map_index = options["map_index"]
+            else:
+                map_index = self.map_bank.sample(self.np_random)
+            tile_type = self.map_bank.tile_type[map_index]
+
         if self.render_mode in ["human", "interactable"]:
-            self.terrain = Terrain(self.row_count, self.col_count, True)
+            self.terrain = Terrain(self.row_count, self.col_count, True, self.np_random, tile_type)
         else:
-            self.terrain = Terrain(self.row_count, self.col_count)
+            self.terrain = Terrain(self.row_count, self.col_count, np_random=self.np_random, tile_type=tile_type)
+        self.terrain.profiler = self.profiler
 
-        self.player = Player("Hero")
+        self.player = Player("Hero", 0, self.terrain.registry)
         self.bots = []
         for i in range(self.bot_count):
-            self.bots.append(Player(f"{i}"))
+            self.bots.append(Player(f"{i}", i+1, self.terrain.registry))
 
-        
-        self._civ_generator(self.player, self.start_troop_count)
-        for bot in self.bots:
-            self._civ_generator(bot, self.start_troop_count)
+        if self.map_bank is not None:
+            self._load_position(map_index)
+        else:
+            self._civ_generator(self.player, self.start_troop_count)
+            for bot in self.bots:
+                self._civ_generator(bot, self.start_troop_count)
+
+        #full rebuild only here, afterwards the builder follows the changed tiles
+        self.observation_builder = ObservationBuilder(self.terrain, self.player)
+        self.terrain.add_observer(self.observation_builder)
+
+        if self.render_mode in ["human", "interactable"]:
+            self.renderer = BoardRenderer(self.terrain, self.player.id)
+        self._lap("reset")
        
         observation = self._get_obs()
-        info = self._get_info()
+        self._lap("get_obs")
 
         if self.render_mode in ["human", "interactable"]:
             self._render_frame()
+            self._lap("render")
 
+        info = self._get_info()
         return observation, info
     
     def _civ_generator(self, player, troop_amount):
         #Generate a city in a random place
         max_attempts = self.row_count*self.col_count*5
 
-        row = random.randrange(self.row_count)
-        col = random.randrange(self.col_count)
-        while (self.terrain[row, col].owner is not None or self.terrain[row, col].obstacle) and max_attempts > 0:
-            row = random.randrange(self.row_count)
-            col = random.randrange(self.col_count)
+        row = int(self.np_random.integers(self.row_count))
+        col = int(self.np_random.integers(self.col_count))
+        while (self.terrain.owner[row, col] >= 0 or self.terrain.obstacle[row, col]) and max_attempts > 0:
+            row = int(self.np_random.integers(self.row_count))
+            col = int(self.np_random.integers(self.col_count))
             max_attempts -= 1
         if max_attempts == 0:
             #This would be stupid to happen during training because sometimes it finds sometimes not, how to fix this
@@ -238,106 +361,90 @@ class Civ6CombatEnv(gym.Env):
                 self._create_archer(player, 3, 3, 100, 100, 55, troop_row, troop_col)
                 
 
+    def _load_position(self, map_index):
+        #same cities and troops as _civ_generator would make, at the positions stored in the bank
+        self.terrain.owner[:] = self.map_bank.owner[map_index]
+        players = [self.player] + self.bots
+        for player, city, troops in zip(players, self.map_bank.cities[map_index], self.map_bank.units[map_index]):
+            self._create_center(player, 200, 200, 50, *divmod(int(city), self.col_count))
+            for i, tile in enumerate(troops):
+                if tile < 0:
+                    continue
+                row, col = divmod(int(tile), self.col_count)
+                if i < self.start_troop_count:
+                    self._create_warrior(player, 3, 3, 100, 100, 55, row, col)
+                else:
+                    self._create_archer(player, 3, 3, 100, 100, 55, row, col)
+
     def close(self):
         if self.window is not None:
+            import pygame
+            render_cache.clear()
             pygame.display.quit()
             pygame.quit()
 
     def _render_frame(self):
-        self.window.fill((0, 0, 0))  # clear the screen before drawing
-        self.terrain.draw(self.window, self.player.id, self.offset, self.scale)
-        self._render_game_info()
+        import pygame
+        #only the tiles that changed since the last frame are redrawn, the terrain itself is cached in the renderer
+        rects = self.renderer.draw(self.window, self.offset, self.scale)
+        rects.append(self._render_game_info())
 
         pygame.event.pump()
-        pygame.display.update()  
+        pygame.display.update(rects)
         self.clock.tick(self.metadata["render_fps"])
     
     def _render_game_info(self):
         x = MARGIN
         y = HEX_SIZE * 0.75 * (self.row_count+1) + MARGIN
         font_size = int(HEX_SIZE/5)
-        font = pygame.font.Font(None, font_size)
+        font = render_cache.font(font_size)
         average_score = self.all_scores / (self.wins+self.losses) if self.wins+self.losses != 0 else 0
         scores_text = font.render(f"Last Game Won: {self.last_game_won} | Score: {self.score} | Average Score: {average_score:.2f}", True, Colors.WHITE.value)
         ratio = self.wins*100 / (self.wins+self.losses) if self.wins+self.losses != 0 else 0
         win_losses_text = font.render(f"Wins: {self.wins} | Losses: {self.losses} | Win Ratio: {ratio:.2f}%", True, Colors.WHITE.value)
+        #the text is drawn over the board, so the board under it is redrawn first, returns the changed rect
+        info_rect = self.window.get_rect().clip((x, y, self.window.get_width() - x, font_size * 2))
+        self.renderer.clear(self.window, info_rect, self.offset, self.scale)
         self.window.blit(scores_text, (x, y))
         y += font_size
         self.window.blit(win_losses_text, (x, y))
+        return info_rect
         
      
     def _create_warrior(self, player : Player, moves, max_moves, health, max_health, power, row, col):
-        self.terrain[row][col].troop = Warrior(moves, max_moves, health, max_health, power,  player.id, row, col)
-        player.troops.append(self.terrain[row][col].troop)
+        troop = Warrior(moves, max_moves, health, max_health, power,  player.id, row, col)
+        self.terrain.add_entity(troop)
     
     def _create_archer(self, player : Player, moves, max_moves, health, max_health, power, row, col):
-        self.terrain[row][col].troop = Archer(moves, max_moves, health, max_health, power,  player.id, row, col)
-        player.troops.append(self.terrain[row][col].troop)
+        troop = Archer(moves, max_moves, health, max_health, power,  player.id, row, col)
+        self.terrain.add_entity(troop)
 
     def _create_center(self, player : Player, health, max_health, power, row, col):
-        self.terrain[row][col].building = Center(health, max_health, power, player.id, row, col)
-        player.buildings.append(self.terrain[row][col].building)
+        building = Center(health, max_health, power, player.id, row, col)
+        self.terrain.add_entity(building)
         self._update_ownership(row, col, player.id, 3)
 
     def _update_ownership(self, row, col, new_owner, distance=3):
-        visited = set()
-
-        # Use a queue to perform a breadth-first search
-        queue = deque([(row, col, 0)])
-
-        while queue:
-            curr_row, curr_col, d = queue.popleft()
-
-            if (curr_row, curr_col) in visited or d > distance:
-                continue
-
-            visited.add((curr_row, curr_col))
-
-            # Only update the ownership if current owner is None
-            if self.terrain[curr_row, curr_col].owner is None:
-                self.terrain[curr_row, curr_col].owner = new_owner
-
-            # Add neighbors to the queue
-            directions = DIRECTIONS_EVEN if curr_row % 2 == 0 else DIRECTIONS_ODD
-            for dr, dc in directions:
-                nr, nc = curr_row + dr, curr_col + dc
-                if 0 <= nr < self.row_count and 0 <= nc < self.col_count:
-                    queue.append((nr, nc, d + 1))
+        in_range = within_range(self.row_count, self.col_count, flat_index(row, col, self.col_count), distance)
+        # Only update the ownership if current owner is None
+        owner = self.terrain.owner.reshape(-1)
+        owner[in_range & (owner < 0)] = new_owner
 
     def _get_troop_positions(self, start_row, start_col, position_count):
-        visited = set()
-        queue = deque([(start_row, start_col)])
-        free_positions = []
-
-        while queue and len(free_positions) < position_count:
-            curr_x, curr_y = queue.popleft()
-            if (curr_x, curr_y) in visited:
-                continue
-
-            visited.add((curr_x, curr_y))
-
-            # Check the tile's troop and building
-            tile = self.terrain[curr_x, curr_y]
-            if tile.troop is None and tile.building is None and not tile.obstacle:
-                free_positions.append((curr_x, curr_y))
-                if len(free_positions) == position_count:
-                    break
-
-            # Add neighboring tiles to queue
-            directions = DIRECTIONS_EVEN if curr_x % 2 == 0 else DIRECTIONS_ODD
-            for dx, dy in directions:
-                nx, ny = curr_x + dx, curr_y + dy
-                if 0 <= nx < self.row_count and 0 <= ny < self.col_count:
-                    queue.append((nx, ny))
-        return free_positions
+        #closest free tiles in breadth first order
+        order = bfs_order(self.row_count, self.col_count, flat_index(start_row, start_col, self.col_count))
+        free = (self.terrain.troop_ids.reshape(-1) < 0) & (self.terrain.building_ids.reshape(-1) < 0) & ~self.terrain.obstacle.reshape(-1)
+        positions = order[free[order]][:position_count]
+        return [divmod(int(position), self.col_count) for position in positions]
         
     def _reset_moves(self, player : Player):
-        for troop in player.troops:
-            troop.moves = troop.max_moves
+        self.terrain.registry.reset_moves(player.id)
 
     def start_interactable(self):
         if self.render_mode != "interactable":
             raise RuntimeError("Render mode is not in interactable mode")
+        import pygame
+        from pygame.math import Vector2
 
         self.reset()
 
@@ -390,17 +497,11 @@ class Civ6CombatEnv(gym.Env):
                         tile = self.terrain[row, col]
                         if troop_to_move:
                             #Move the troop to the tile if he can move there
-                            if tile.highlight_move or tile.highlight_attack:
-                                for tile_row in range(self.row_count):
-                                    for tile_col in range(self.col_count):
-                                        self.terrain[tile_row, tile_col].highlight_move = False
-                                        self.terrain[tile_row, tile_col].highlight_attack = False
+                            highlighted = tile.highlight_move or tile.highlight_attack
+                            self.terrain.highlight_move[:] = False
+                            self.terrain.highlight_attack[:] = False
+                            if highlighted:
                                 _, _, terminated, truncated, _ = self.step(((troop_to_move.row, troop_to_move.col), (row, col)))
-                            else:
-                                for tile_row in range(self.row_count):
-                                    for tile_col in range(self.col_count):
-                                        self.terrain[tile_row, tile_col].highlight_move = False
-                                        self.terrain[tile_row, tile_col].highlight_attack = False
                             
                             troop_to_move = None
 
@@ -408,14 +509,9 @@ class Civ6CombatEnv(gym.Env):
                         elif tile.troop and tile.troop.moves > 0 and tile.troop.player_id == self.player.id:
                             troop_to_move = tile.troop
                             #highlight_move the moves of the troop
-                            obs = troop_to_move.get_reachable_pos(self.terrain.tiles)
-                            #Could vectorize these for loops using numpy vector operations
-                            for tile_row in range(self.row_count):
-                                for tile_col in range(self.col_count):
-                                    if obs[tile_row, tile_col] > 0:
-                                        self.terrain[tile_row, tile_col].highlight_move = True
-                                    elif obs[tile_row, tile_col] == -2:
-                                        self.terrain[tile_row, tile_col].highlight_attack = True
+                            obs = troop_to_move.get_reachable_pos(self.terrain)
+                            self.terrain.highlight_move[obs > 0] = True
+                            self.terrain.highlight_attack[obs == -2] = True
                         if terminated or truncated:
                             self.reset()
                             terminated, truncated = False, False
@@ -0,0 +1,81 @@
+from functools import lru_cache
+from collections import deque
+
+import numpy as np
+
+from options import DIRECTIONS_EVEN, DIRECTIONS_ODD
+
+#Hex geometry of a rows x cols board with odd rows shifted right. Tiles are addressed by their flat index
+#row*cols + col. Every table is built once per board shape, cached, and returned read only. Nothing is quadratic
+#in the number of tiles, distances are computed from cube coordinates for the tiles asked about.
+
+#Breadth first orders are kept for this many start tiles, each one is a rows*cols array
+BFS_CACHE_SIZE = 64
+
+def flat_index(row, col, cols):
+    return row * cols + col
+
+
+@lru_cache(maxsize=None)
+def neighbor_table(rows, cols):
+    #(rows*cols + 1, 6) flat neighbor indices, off-board neighbors point at the padding tile rows*cols
+    padding = rows * cols
+    table = np.full((padding + 1, 6), padding, dtype=np.int32)
+    for row in range(rows):
+        directions = DIRECTIONS_EVEN if row % 2 == 0 else DIRECTIONS_ODD
+        for col in range(cols):
+            for k, (dr, dc) in enumerate(directions):
+                nr, nc = row + dr, col + dc
+                if 0 <= nr < rows and 0 <= nc < cols:
+                    table[flat_index(row, col, cols), k] = flat_index(nr, nc, cols)
+    table.flags.writeable = False
+    return table
+
+
+@lru_cache(maxsize=None)
+def neighbor_lists(rows, cols):
+    #same as neighbor_table but as tuples without the padding, faster to loop over in python
+    padding = rows * cols
+    return tuple(tuple(int(n) for n in neighbors if n != padding) for neighbors in neighbor_table(rows, cols)[:padding])
+
+
+@lru_cache(maxsize=None)
+def cube_coordinates(rows, cols):
+    #(rows*cols, 3) cube coordinates x, y, z of every tile, linear in the board size unlike a distance matrix
+    row, col = np.divmod(np.arange(rows * cols), cols)
+    x = col - (row - (row & 1)) // 2
+    z = row
+    cube = np.stack([x, -x - z, z], axis=1).astype(np.int32)
+    cube.flags.writeable = False
+    return cube
+
+
+def hex_distance(rows, cols, a, b):
+    #hex distances between the flat tiles a and b, any shapes that broadcast together
+    cube = cube_coordinates(rows, cols)
+    return np.abs(cube[a] - cube[b]).max(axis=-1)
+
+
+def within_range(rows, cols, tile, k):
+    #(rows*cols,) bool, True for tiles at most k hexes from tile
+    return hex_distance(rows, cols, tile, np.arange(rows * cols)) <= k
+
+
+@lru_cache(maxsize=BFS_CACHE_SIZE)
+def bfs_order(rows, cols, start):
+    #every tile in breadth first order from start, neighbors are visited in the DIRECTIONS order
+    neighbors = neighbor_lists(rows, cols)
+    visited = np.zeros(rows * cols, dtype=bool)
+    visited[start] = True
+    order = []
+    queue = deque([start])
+    while queue:
+        tile = queue.popleft()
+        order.append(tile)
+        for neighbor in neighbors[tile]:
+            if not visited[neighbor]:
+                visited[neighbor] = True
+                queue.append(neighbor)
+    order = np.array(order, dtype=np.int32)
+    order.flags.writeable = False
+    return order
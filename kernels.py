@@ -0,0 +1,119 @@
+import math
+
+import numpy as np
+
+#NumPy kernels shared by the batched code paths. Boards are flattened to rows*cols tiles plus one
+#padding tile at the end, see hex_geometry.neighbor_table, so lookups never need bounds checks.
+
+def batched_reachability(neighbors, move_cost, passable, friendly, enemy, source, moves, max_moves, attack_range):
+    """
+    Computes Troop.get_reachable_pos for a batch of units at once.
+    All board arrays are (B, rows*cols + 1) with the padding tile last, per unit arrays are (B,).
+    passable: tiles a unit can walk through (no obstacle, no troop, no enemy building)
+    friendly: tiles with other troops of the same player, enemy: tiles with enemy troops or buildings
+    Returns (B, rows*cols) float32: move cost for reachable tiles, -2 attackable, 0 blocked, -1 unreachable
+    and max_moves on the unit's own tile.
+    """
+    batch = len(source)
+    tiles = neighbors.shape[0] - 1
+    rows_idx = np.arange(batch)
+    moves = np.asarray(moves, dtype=np.float32)[:, None]
+    attack_range = np.asarray(attack_range, dtype=np.int32)[:, None]
+    walkable = passable.copy()
+    walkable[rows_idx, source] = True
+    walkable[:, tiles] = False
+
+    #cheapest path cost, only tiles cheaper than the remaining moves keep expanding
+    cost = np.full(walkable.shape, np.inf, dtype=np.float32)
+    cost[rows_idx, source] = 0
+    for _ in range(int(np.ceil(moves.max())) if batch else 0):
+        expanding = np.where(cost < moves, cost, np.inf)
+        candidate = expanding[:, neighbors[:tiles]].min(axis=2) + move_cost[:, :tiles]
+        np.minimum(cost[:, :tiles], np.where(walkable[:, :tiles], candidate, np.inf), out=cost[:, :tiles])
+
+    #fewest hexes, only needed up to the attack range
+    hop = np.full(walkable.shape, np.iinfo(np.int32).max, dtype=np.int32)
+    hop[rows_idx, source] = 0
+    for _ in range(int(attack_range.max()) if batch else 0):
+        candidate = hop[:, neighbors[:tiles]].min(axis=2)
+        candidate = np.where(candidate < attack_range, candidate + 1, np.iinfo(np.int32).max)
+        np.minimum(hop[:, :tiles], np.where(walkable[:, :tiles], candidate, hop[:, :tiles]), out=hop[:, :tiles])
+
+    #a tile is reached if any walkable neighbor still expands, either by moves or by attack range
+    expands = walkable & ((cost < moves) | (hop < attack_range))
+    reached = expands[:, neighbors[:tiles]].any(axis=2)
+    nearest = np.where(expands, hop, np.iinfo(np.int32).max)[:, neighbors[:tiles]].min(axis=2)
+
+    observation = np.full((batch, tiles), -1, dtype=np.float32)
+    can_walk = walkable[:, :tiles] & (cost[:, :tiles] <= moves)
+    observation[can_walk] = cost[:, :tiles][can_walk]
+    observation[(friendly[:, :tiles] | enemy[:, :tiles]) & reached] = 0
+    observation[enemy[:, :tiles] & reached & (nearest < attack_range)] = -2
+    observation[rows_idx, source] = max_moves
+    return observation
+
+
+#Damage(HP)=30*e^{0.04*StrengthDifference}*randomBetween(0.8-1.2), the exponential part for every integer strength
+#difference (attacker power - defender power) between -DAMAGE_RANGE and DAMAGE_RANGE, larger ones are clipped
+DAMAGE_RANGE = 200
+DAMAGE_TABLE = np.array([30 * math.exp(0.04 * difference) for difference in range(-DAMAGE_RANGE, DAMAGE_RANGE + 1)])
+DAMAGE_TABLE.flags.writeable = False
+
+
+def combat_damage(strength_difference):
+    #works on ints and int arrays, without the random factor
+    return DAMAGE_TABLE[np.clip(strength_difference, -DAMAGE_RANGE, DAMAGE_RANGE) + DAMAGE_RANGE]
+
+
+def resolve_combat(attack_power, defense_power, attack_health, defense_health, ranged, rand):
+    """
+    Resolves a batch of fights, all inputs are (B,) arrays, ranged attackers take no damage.
+    Returns the new attacker and defender health, their hp power loss (from the health before any revive),
+    whether the attacker or the defender dies and whether the attacker advances into the defender's tile.
+    If both would die the one with more health survives with 1 health, melee attackers advance after a kill.
+    """
+    difference = np.asarray(attack_power) - np.asarray(defense_power)
+    defense_health = defense_health - combat_damage(difference) * rand
+    attack_health = attack_health - np.where(ranged, 0, combat_damage(-difference) * rand)
+    attack_loss = np.round(10 - attack_health / 10)
+    defense_loss = np.round(10 - defense_health / 10)
+
+    both = (defense_health <= 0) & (attack_health <= 0)
+    revive_attacker = both & (attack_health > defense_health)
+    revive_defender = both & ~revive_attacker
+    attack_health = np.where(revive_attacker, 1, attack_health)
+    defense_health = np.where(revive_defender, 1, defense_health)
+    defender_dies = defense_health <= 0
+    return attack_health, defense_health, attack_loss, defense_loss, attack_health <= 0, defender_dies, defender_dies & ~ranged
+
+
+def masked_choice(mask, rng):
+    #picks a random True index per row, -1 for rows without any. Draws rng.integers(count) per row, so for one row
+    #it picks what np.flatnonzero(mask)[rng.integers(count)] would, like the single env's random choices
+    counts = mask.sum(axis=1)
+    picks = rng.integers(np.maximum(counts, 1))
+    choice = (np.cumsum(mask, axis=1) > picks[:, None]).argmax(axis=1)
+    choice[counts == 0] = -1
+    return choice
+
+
+def heuristic_targets(reach, source, enemy_health, city_distance, threatened):
+    """
+    Picks one target tile per unit for the heuristic bots, every input has the batch of units first.
+    reach: (B, tiles) from batched_reachability, source: (B,) tile of the unit
+    enemy_health: (B, tiles) health of what would be attacked on a tile, city_distance: (B, tiles) hexes to the
+    nearest enemy city, threatened: (B,) enemy troops close to the unit.
+    Attacks the weakest enemy in range, otherwise fortifies when threatened, otherwise moves closer to
+    the nearest enemy city, and fortifies if it can't get closer.
+    """
+    rows_idx = np.arange(len(source))
+    attackable = reach == -2
+    attack_target = np.where(attackable, enemy_health, np.inf).argmin(axis=1)
+
+    movable = reach > 0
+    movable[rows_idx, source] = False
+    move_target = np.where(movable, city_distance, np.inf).argmin(axis=1)
+    closer = movable.any(axis=1) & (city_distance[rows_idx, move_target] < city_distance[rows_idx, source])
+
+    advance = np.where(~threatened & closer, move_target, source)
+    return np.where(attackable.any(axis=1), attack_target, advance)
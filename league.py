@@ -0,0 +1,78 @@
+import numpy as np
+
+
+class SelfPlayLeague:
+    """
+    Pool of frozen policies the bots of Civ6CombatVectorEnv(bot_policy=league) play with.
+    Every bot of every game gets a checkpoint sampled by weight when the game is reset. On each decision round
+    the bots of all games that still have moves are batched, and every checkpoint does one forward pass over
+    the games it was assigned to.
+    A policy is a callable from a (batch, channels, rows, columns) observation to (batch, tiles*tiles) action logits,
+    the same flat actions as Civ6CombatEnv.action_masks().reshape(-1). Illegal actions are masked out before sampling.
+    """
+
+    def __init__(self, deterministic=False):
+        self.policies = []
+        self.names = []
+        self.weights = np.zeros(0)
+        #argmax over the legal logits instead of sampling
+        self.deterministic = deterministic
+
+    def __len__(self):
+        return len(self.policies)
+
+    def add(self, policy, weight=1.0, name=None):
+        #adds a checkpoint to the pool, returns its index
+        self.policies.append(policy)
+        self.names.append(name if name is not None else f"checkpoint_{len(self.policies) - 1}")
+        self.weights = np.append(self.weights, weight)
+        return len(self.policies) - 1
+
+    def set_weight(self, index, weight):
+        #games keep their checkpoint until they are reset, a weight of 0 only stops new games from getting it
+        self.weights[index] = weight
+
+    def sample(self, shape, np_random):
+        if len(self.policies) == 0:
+            raise RuntimeError("The league has no checkpoints, add one before resetting the env")
+        return np_random.choice(len(self.policies), size=shape, p=self.weights / self.weights.sum())
+
+    def act(self, observations, masks, checkpoints, np_random):
+        """
+        One flat action per row, observations: (batch, channels, rows, columns), masks: (batch, tiles*tiles) bool,
+        checkpoints: (batch,) index of the checkpoint playing each row
+        """
+        actions = np.empty(len(observations), dtype=np.int64)
+        for checkpoint in np.unique(checkpoints):
+            rows = np.flatnonzero(checkpoints == checkpoint)
+            logits = np.asarray(self.policies[checkpoint](observations[rows]), dtype=np.float64)
+            actions[rows] = masked_sample(logits, masks[rows], np_random, self.deterministic)
+        return actions
+
+
+def masked_sample(logits, mask, np_random, deterministic=False):
+    #samples one legal index per row from softmax(logits) with the gumbel max trick, noise only for legal actions
+    scores = np.full(logits.shape, -np.inf)
+    scores[mask] = logits[mask]
+    if not deterministic:
+        scores[mask] += np_random.gumbel(size=np.count_nonzero(mask))
+    return scores.argmax(axis=1)
+
+
+class TorchPolicy:
+    #logits of a torch module (e.g. a saved policy network) for SelfPlayLeague, torch is only imported when used
+    def __init__(self, module, device="cpu"):
+        import torch
+        self.torch = torch
+        self.device = device
+        self.module = module.to(device).eval()
+
+    @classmethod
+    def load(cls, path, device="cpu"):
+        #a module saved with torch.save(module, path)
+        import torch
+        return cls(torch.load(path, map_location=device, weights_only=False), device)
+
+    def __call__(self, observations):
+        with self.torch.no_grad():
+            return self.module(self.torch.as_tensor(observations, device=self.device)).cpu().numpy()
@@ -0,0 +1,89 @@
+import os
+import json
+
+import numpy as np
+
+#A map bank is a directory of .npy arrays holding pregenerated starting positions, opened as memory maps so
+#a reset only copies one position out of it. Positions are the same as the ones the envs generate themselves.
+FIELDS = (
+    "tile_type", #(count, rows, columns) TileType values
+    "owner",     #(count, rows, columns) owning player or -1
+    "cities",    #(count, players) flat tile of every player's city center
+    "units",     #(count, players, 2*start_troops) flat tiles of warriors then archers, -1 if not placed
+)
+
+
+def field_dtypes(rows, columns, players):
+    #tiles and players are signed so -1 fits, wider dtypes only for boards or player counts that don't fit the small ones
+    tile = np.int16 if rows * columns - 1 <= np.iinfo(np.int16).max else np.int32
+    player = np.int8 if players - 1 <= np.iinfo(np.int8).max else np.int16
+    return {"tile_type": np.int8, "owner": player, "cities": tile, "units": tile}
+
+
+class MapBank:
+    """
+    Read only bank of starting positions, see MapBank.generate.
+    Player 0 is the learning player, the rest are bots, same as in the envs.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as file:
+            self.meta = json.load(file)
+        self.row_count = self.meta["rows"]
+        self.col_count = self.meta["columns"]
+        self.bot_count = self.meta["bots"]
+        self.start_troop_count = self.meta["start_troops"]
+        for field in FIELDS:
+            setattr(self, field, np.load(os.path.join(path, f"{field}.npy"), mmap_mode="r"))
+
+    def __len__(self):
+        return len(self.tile_type)
+
+    def sample(self, np_random, size=None):
+        return np_random.integers(len(self), size=size)
+
+    def check(self, rows, columns, bots, start_troops):
+        #the bank can only be used by envs with the same board and players
+        if (rows, columns, bots, start_troops) != (self.row_count, self.col_count, self.bot_count, self.start_troop_count):
+            raise ValueError(f"Map bank {self.path} is for {self.row_count}x{self.col_count} boards with {self.bot_count} bots "
+                             f"and {self.start_troop_count} start troops")
+
+    @staticmethod
+    def generate(path, count, rows=6, columns=6, bots=1, start_troops=2, seed=None, chunk=4096):
+        """
+        Writes count starting positions to path and returns the opened bank.
+        Maps are generated in chunks by Civ6CombatVectorEnv, so the bank never has to fit in memory.
+        """
+        from vector_env import Civ6CombatVectorEnv
+
+        os.makedirs(path, exist_ok=True)
+        players = bots + 1
+        shapes = {
+            "tile_type": (count, rows, columns),
+            "owner": (count, rows, columns),
+            "cities": (count, players),
+            "units": (count, players, 2 * start_troops),
+        }
+        arrays = {field: np.lib.format.open_memmap(os.path.join(path, f"{field}.npy"), mode="w+", dtype=dtype, shape=shapes[field])
+                  for field, dtype in field_dtypes(rows, columns, players).items()}
+
+        env = Civ6CombatVectorEnv(min(chunk, count), rows, columns, bots=bots, start_troops=start_troops)
+        env.reset(seed=seed)
+        for start in range(0, count, env.num_envs):
+            if start:
+                env._reset_games(np.arange(env.num_envs))
+            end = min(start + env.num_envs, count)
+            games = slice(0, end - start)
+            arrays["tile_type"][start:end] = env.tile_type[games]
+            arrays["owner"][start:end] = env.owner[games]
+            arrays["cities"][start:end] = env.city_pos[games]
+            units = np.where(env.unit_alive[games], env.unit_pos[games], -1)
+            arrays["units"][start:end] = units.reshape(end - start, players, 2 * start_troops)
+        for array in arrays.values():
+            array.flush()
+        del arrays
+
+        with open(os.path.join(path, "meta.json"), "w") as file:
+            json.dump({"rows": rows, "columns": columns, "bots": bots, "start_troops": start_troops, "count": count, "seed": seed}, file)
+        return MapBank(path)
@@ -0,0 +1,229 @@
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
+
+from state import GameState, entities_to_array
+
+#Weight of a city center against a troop when scoring a position
+CITY_WEIGHT = 2.0
+
+
+class ForwardModel:
+    """
+    The game itself used as the planner's simulator: a private Civ6CombatEnv that states are loaded into.
+    Actions are flat indices from*tiles + to like in Civ6CombatEnv.action_masks.
+    """
+
+    def __init__(self, rows, columns, np_random):
+        from env import Civ6CombatEnv
+        self.env = Civ6CombatEnv(rows, columns)
+        self.env.np_random = np_random
+        self.tile_count = rows * columns
+
+    def load(self, state):
+        #the env's random state stays, otherwise every rollout from a state would play out the same
+        #and the search never reads observations, so their planes aren't built
+        self.env.set_state(state, restore_rng=False, observe=False)
+
+    def save(self):
+        return self.env.get_state()
+
+    @property
+    def players(self):
+        return [self.env.player] + self.env.bots
+
+    def legal_actions(self, player_id):
+        return np.flatnonzero(self.env.terrain.action_masks(player_id).reshape(-1))
+
+    def apply(self, player_id, action):
+        player = self.players[player_id]
+        self.env.terrain.action(self.env.decode_action(action), player.id)
+        for other in self.players:
+            self.env._cleanup(other)
+
+    def random_turn(self, player_id, max_actions):
+        #random moves like Civ6CombatEnv._ai_sim, returns the number of actions taken
+        player = self.players[player_id]
+        terrain = self.env.terrain
+        rng = self.env.np_random
+        actions = 0
+        troops = terrain.registry.movable(player_id)
+        while troops and actions < max_actions:
+            troop = troops[rng.integers(len(troops))]
+            possible_moves = troop.get_reachable_pos(terrain)
+            targets = np.flatnonzero((possible_moves > 0) | (possible_moves == -2))
+            target = targets[rng.integers(len(targets))]
+            self.apply(player_id, flat_action(troop.row, troop.col, target, terrain.column_count, self.tile_count))
+            actions += 1
+            troops = terrain.registry.movable(player_id)
+        self.env._reset_moves(player)
+        return actions
+
+    def game_over(self):
+        registry = self.env.terrain.registry
+        return sum(registry.building_count(player.id) > 0 for player in self.players) <= 1
+
+
+def flat_action(row, col, target, columns, tiles):
+    return (row * columns + col) * tiles + target
+
+
+def evaluate(entities, player_id):
+    """
+    Scores a batch of positions for player_id in [-1, 1], entities is (batch, entities) of state.ENTITY_DTYPE.
+    Own minus enemy strength over the total, strength is health/max_health times power, cities count double.
+    """
+    alive = entities["listed"] & (entities["health"] > 0)
+    strength = np.clip(entities["health"] / entities["max_health"], 0, 1) * entities["power"]
+    strength = np.where(entities["kind"] == 2, CITY_WEIGHT * strength, strength) * alive
+    own = (strength * (entities["player_id"] == player_id)).sum(axis=1)
+    enemy = (strength * (entities["player_id"] != player_id)).sum(axis=1)
+    return (own - enemy) / np.maximum(own + enemy, 1e-9)
+
+
+class Node:
+    def __init__(self, state, parent=None, action=None):
+        self.state = state
+        self.parent = parent
+        self.action = action
+        self.children = []
+        #legal actions not expanded yet, filled the first time the node is reached
+        self.untried = None
+        self.visits = 0
+        self.value = 0.0
+
+    def best_child(self, exploration):
+        log_visits = math.log(self.visits)
+        return max(self.children, key=lambda child: child.value / child.visits + exploration * math.sqrt(log_visits / child.visits))
+
+
+class MCTSPlanner:
+    """
+    UCT search over the unit actions of one player's turn, the tree ends when the player runs out of moves.
+    Leaves are scored by random rollouts through the following turns of all players, a batch of leaves is
+    selected with virtual visits and their rollouts are scored together with evaluate.
+    workers > 1 runs independent trees (root parallelism), one in the calling process and the others in a thread or
+    process pool, and sums their visits. The search is mostly python, so only the process pool scales with the CPUs.
+    """
+
+    def __init__(self, simulations=64, rollout_depth=8, batch_size=8, exploration=1.0, workers=1, pool="process", seed=None):
+        self.simulations = simulations
+        self.rollout_depth = rollout_depth
+        self.batch_size = batch_size
+        self.exploration = exploration
+        self.workers = workers
+        self.pool = pool
+        self.np_random = np.random.default_rng(seed)
+        self._models = {}
+        self._executor = None
+
+    def plan(self, env, player):
+        """Best action ((from_row, from_col), (to_row, to_col)) for player in env, None if it has no legal action"""
+        legal = np.flatnonzero(env.terrain.action_masks(player.id).reshape(-1))
+        if len(legal) == 0:
+            return None
+        if len(legal) == 1:
+            return env.decode_action(legal[0])
+
+        state = env.get_state()
+        rows, columns = env.row_count, env.col_count
+        if self.workers <= 1:
+            stats = self._search(state, rows, columns, player.id, self.simulations)
+        else:
+            seeds = self.np_random.integers(2**63, size=self.workers)
+            simulations = -(-self.simulations // self.workers)
+            data = state.to_bytes()
+            args = [(data, rows, columns, player.id, simulations, self.rollout_depth, self.batch_size,
+                     self.exploration, int(seed)) for seed in seeds]
+            #the first tree is searched here while the pool searches the others, so workers - 1 pool workers are enough
+            results = self._pool().map(_search_worker, args[1:])
+            stats = {}
+            for result in [_search_worker(args[0])] + list(results):
+                for action, (visits, value) in result.items():
+                    total = stats.get(action, (0, 0.0))
+                    stats[action] = (total[0] + visits, total[1] + value)
+        #most visited action, mean value breaks ties
+        action = max(stats, key=lambda action: (stats[action][0], stats[action][1] / stats[action][0]))
+        return env.decode_action(action)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _pool(self):
+        if self._executor is None:
+            executor = ProcessPoolExecutor if self.pool == "process" else ThreadPoolExecutor
+            self._executor = executor(max_workers=self.workers - 1)
+        return self._executor
+
+    def _model(self, rows, columns):
+        if (rows, columns) not in self._models:
+            self._models[rows, columns] = ForwardModel(rows, columns, self.np_random)
+        return self._models[rows, columns]
+
+    def _search(self, state, rows, columns, player_id, simulations):
+        #returns action -> (visits, summed value) of the root's children
+        model = self._model(rows, columns)
+        root = Node(state)
+        done = 0
+        while done < simulations:
+            leaves = [self._select(model, root, player_id) for _ in range(min(self.batch_size, simulations - done))]
+            done += len(leaves)
+            values = evaluate(np.stack([self._rollout(model, leaf.state, player_id) for leaf in leaves]), player_id)
+            for leaf, value in zip(leaves, values):
+                node = leaf
+                while node is not None:
+                    node.value += value
+                    node = node.parent
+        return {child.action: (child.visits, child.value) for child in root.children}
+
+    def _select(self, model, root, player_id):
+        #walks down with UCT and expands one action, visits are counted on the way so a batch spreads out
+        node = root
+        while True:
+            node.visits += 1
+            if node.untried is None:
+                model.load(node.state)
+                node.untried = list(self.np_random.permutation(model.legal_actions(player_id)))
+            if node.untried:
+                action = node.untried.pop()
+                model.load(node.state)
+                model.apply(player_id, action)
+                child = Node(model.save(), node, action)
+                child.visits = 1
+                node.children.append(child)
+                return child
+            if not node.children:
+                return node
+            node = node.best_child(self.exploration)
+
+    def _rollout(self, model, state, player_id):
+        #the rest of the player's turn, then everyone's turns in env order, until rollout_depth actions
+        model.load(state)
+        players = len(model.players)
+        remaining = self.rollout_depth
+        turn = player_id
+        while remaining > 0 and not model.game_over():
+            remaining -= max(model.random_turn(turn, remaining), 1)
+            turn = (turn + 1) % players
+        return entities_to_array(model.env.terrain.registry)
+
+
+#planners of the pool workers by search settings, per thread so thread pools don't share forward models
+_workers = threading.local()
+
+
+def _search_worker(args):
+    #runs one tree in a pool worker, the state comes in as bytes so it pickles quickly
+    #the worker's planner and its forward models are kept between moves, only its random generator is seeded again
+    data, rows, columns, player_id, simulations, rollout_depth, batch_size, exploration, seed = args
+    planners = _workers.__dict__.setdefault("planners", {})
+    key = (rollout_depth, batch_size, exploration)
+    if key not in planners:
+        planners[key] = MCTSPlanner(simulations, rollout_depth, batch_size, exploration)
+    planner = planners[key]
+    planner.np_random.bit_generator.state = np.random.PCG64(seed).state
+    return planner._search(GameState.from_bytes(data), rows, columns, player_id, simulations)
@@ -0,0 +1,360 @@
+import math
+
+import numpy as np
+import gymnasium as gym
+
+from hex_geometry import hex_distance
+from options import CnnChannels
+
+#channel indices, looked up once instead of going through the enum for every tile
+IS_ENEMY_TROOP = CnnChannels.IS_ENEMY_TROOP.value
+IS_ENEMY_BUILDING = CnnChannels.IS_ENEMY_BUILDING.value
+CAN_MOVE = CnnChannels.CAN_MOVE.value
+
+#health and power planes in CnnChannels order, rows of ObservationBuilder.stats
+STATS = slice(CnnChannels.TROOP_HEALTH.value, CnnChannels.BUILDING_POWER.value + 1)
+HEALTH_ROWS = [CnnChannels.TROOP_HEALTH.value - STATS.start, CnnChannels.BUILDING_HEALTH.value - STATS.start]
+POWER_ROWS = [CnnChannels.TROOP_POWER.value - STATS.start, CnnChannels.BUILDING_POWER.value - STATS.start]
+
+
+class ObservationBuilder:
+    """
+    Observation of one player kept in a contiguous (channels, rows, columns) array.
+    The terrain reports changed tiles through Terrain.add_observer, tiles that changed hands with mark_dirty and
+    tiles whose health or power changed with mark_stats, so only those tiles are rewritten. Health and power are
+    normalized by the largest on the board, which is tracked as tiles change and only searched for again when
+    the largest went down. The whole board is only scanned when the builder is created on reset.
+    """
+
+    def __init__(self, terrain, player):
+        self.terrain = terrain
+        self.player = player
+        tiles = terrain.row_count * terrain.column_count
+        self.planes = np.full((len(CnnChannels), terrain.row_count, terrain.column_count), -1, dtype=np.float32)
+        #raw health and power of what stands on every tile, nan where there is nothing
+        self.stats = np.full((STATS.stop - STATS.start, tiles), np.nan)
+        self.max_health = -np.inf
+        self.max_power = -np.inf
+        self.dirty = set()
+        #tiles that changed hands since CAN_MOVE was merged
+        self.board_changes = []
+        #troop id -> (tile, moves, reachable positions) of the troops merged into CAN_MOVE
+        self._reach = {}
+        self.rebuild()
+
+    def rebuild(self):
+        self.planes.fill(-1)
+        self.stats.fill(np.nan)
+        self.dirty.clear()
+        self.board_changes.clear()
+        self._reach = {}
+        for tile in np.flatnonzero((self.terrain.troop_ids >= 0) | (self.terrain.building_ids >= 0)):
+            self._update_tile(int(tile))
+        self.max_health = self._stat_max(HEALTH_ROWS)
+        self.max_power = self._stat_max(POWER_ROWS)
+        self._normalize()
+        self._update_can_move()
+
+    def mark_dirty(self, row, col):
+        tile = row * self.terrain.column_count + col
+        self.dirty.add(tile)
+        self.board_changes.append(tile)
+
+    def mark_stats(self, row, col):
+        self.dirty.add(row * self.terrain.column_count + col)
+
+    def get(self, copy=True):
+        #copy=False returns the builder's own planes, only valid until the board changes
+        if self.dirty:
+            self._update_stats()
+        self._update_can_move()
+        return self.planes.copy() if copy else self.planes
+
+    def views(self, player_ids):
+        """
+        (players, channels, rows, columns) observations of the board from the side of every player in player_ids.
+        The builder's planes are shared, only the enemy channels and the CAN_MOVE plane of players other than the
+        builder's own are rewritten, so every player sees the board like the builder's player does.
+        """
+        terrain = self.terrain
+        viewers = np.asarray(player_ids)
+        observations = np.repeat(self.get(copy=False)[None], len(viewers), axis=0)
+        entity_player = np.array([entity.player_id for entity in terrain.entities] + [-1])
+        observations[:, IS_ENEMY_TROOP] = enemy_plane(entity_player[terrain.troop_ids], viewers[:, None, None])
+        observations[:, IS_ENEMY_BUILDING] = enemy_plane(entity_player[terrain.building_ids], viewers[:, None, None])
+        for observation, player_id in zip(observations, viewers.tolist()):
+            if player_id != self.player.id:
+                #troops are merged in tile order like in _update_can_move
+                troops = sorted(terrain.registry.movable(player_id), key=lambda troop: (troop.row, troop.col))
+                merge_reachable(observation[CAN_MOVE], [troop.get_reachable_pos(terrain) for troop in troops])
+        return observations
+
+    def _update_stats(self):
+        #usually only a couple of tiles changed, so they are handled value by value instead of with arrays
+        tiles = list(self.dirty)
+        self.dirty.clear()
+        olds = [self.stats[:, tile].tolist() for tile in tiles]
+        for tile in tiles:
+            self._update_tile(tile)
+        news = [self.stats[:, tile].tolist() for tile in tiles]
+        max_health = self._track_max(self.max_health, olds, news, HEALTH_ROWS)
+        max_power = self._track_max(self.max_power, olds, news, POWER_ROWS)
+        if max_health != self.max_health or max_power != self.max_power:
+            self.max_health, self.max_power = max_health, max_power
+            self._normalize()
+            return
+
+        scales = [max_health if stat in HEALTH_ROWS else max_power for stat in range(len(self.stats))]
+        for tile, new in zip(tiles, news):
+            row, col = divmod(tile, self.terrain.column_count)
+            for stat, value in enumerate(new):
+                self.planes[STATS.start + stat, row, col] = -1 if math.isnan(value) else value / scales[stat]
+
+    def _track_max(self, current, olds, news, rows):
+        #the board is only searched again if a tile holding the max went down or was emptied
+        values = [current]
+        for old, new in zip(olds, news):
+            for row in rows:
+                if old[row] == current and not new[row] >= current:
+                    return self._stat_max(rows)
+                if not math.isnan(new[row]):
+                    values.append(new[row])
+        return max(values)
+
+    def _update_tile(self, tile):
+        row, col = divmod(tile, self.terrain.column_count)
+        troop = self.terrain.get_troop(row, col)
+        building = self.terrain.get_building(row, col)
+        stats = self.stats[:, tile]
+
+        if troop:
+            self.planes[IS_ENEMY_TROOP, row, col] = troop.player_id != self.player.id
+            stats[HEALTH_ROWS[0]], stats[POWER_ROWS[0]] = troop.health, troop.power
+        else:
+            self.planes[IS_ENEMY_TROOP, row, col] = -1
+            stats[HEALTH_ROWS[0]] = stats[POWER_ROWS[0]] = np.nan
+
+        if building:
+            self.planes[IS_ENEMY_BUILDING, row, col] = building.player_id != self.player.id
+            stats[HEALTH_ROWS[1]], stats[POWER_ROWS[1]] = building.health, building.power
+        else:
+            self.planes[IS_ENEMY_BUILDING, row, col] = -1
+            stats[HEALTH_ROWS[1]] = stats[POWER_ROWS[1]] = np.nan
+
+    def _stat_max(self, rows):
+        values = self.stats[rows]
+        return values.max(initial=-np.inf, where=~np.isnan(values))
+
+    def _normalize(self):
+        #health and power between 0 and 1 on the whole board, -1 where there is nothing
+        scale = np.zeros((len(self.stats), 1))
+        scale[HEALTH_ROWS], scale[POWER_ROWS] = self.max_health, self.max_power
+        with np.errstate(invalid="ignore"):
+            self.planes[STATS] = np.where(np.isnan(self.stats), -1, self.stats / scale).reshape(self.planes[STATS].shape)
+
+    def _update_can_move(self):
+        #a troop's reachable positions only depend on tiles within its moves plus attack range, so only troops
+        #near a changed tile or with different moves are searched again
+        terrain = self.terrain
+        registry = terrain.registry
+        cols = terrain.column_count
+        troops = [registry.entities[entity_id] for entity_id in registry.movable_ids(self.player.id).tolist()]
+        tiles = [troop.row * cols + troop.col for troop in troops]
+        if self.board_changes and troops:
+            changed = np.array(self.board_changes, dtype=np.intp)
+            nearest = hex_distance(terrain.row_count, cols, np.array(tiles)[:, None], changed[None]).min(axis=1).tolist()
+        else:
+            nearest = [math.inf] * len(troops)
+        self.board_changes.clear()
+
+        reach = {}
+        searched = False
+        for troop, tile, distance in zip(troops, tiles, nearest):
+            cached = self._reach.get(troop.id)
+            if cached is not None and cached[0] == tile and cached[1] == troop.moves and distance > math.ceil(troop.moves) + troop.attack_range:
+                reach[troop.id] = cached
+            else:
+                reach[troop.id] = (tile, troop.moves, troop.get_reachable_pos(terrain))
+                searched = True
+        if not searched and reach.keys() == self._reach.keys():
+            return
+        self._reach = reach
+
+        #troops are merged in tile order
+        merge_reachable(self.planes[CAN_MOVE], [reach[troop.id][2] for _, troop in sorted(zip(tiles, troops), key=lambda pair: pair[0])])
+
+
+def enemy_plane(owner, viewer):
+    #IS_ENEMY_TROOP or IS_ENEMY_BUILDING seen from viewer, owner holds the player id on every tile and -1 where there
+    #is nothing, both broadcast so a batch of boards or of viewers is one call
+    return np.where(owner < 0, -1, owner != viewer)
+
+
+def merge_reachable(current_values, reachable):
+    #the CAN_MOVE plane of the troops' reachable positions, written into current_values
+    current_values.fill(-1)
+    for new_values in reachable:
+        # Only update current_values where it's -1 and new_values is either 0 or 1
+        # or where current_values is 0 and new_values is 1
+        mask = ((current_values == -1) & ((new_values > 0) | (new_values == 0) | (new_values == -2))) | ((current_values == 0) & (new_values == 1))
+        current_values[mask] = new_values[mask]
+
+
+#Egocentric observations: a window_size x window_size crop of the planes around each of the player's units and cities plus
+#two channels, 1 where the crop is outside the board and a summary of the whole board downsampled to the window size
+OUT_OF_BOARD = len(CnnChannels)
+SUMMARY = len(CnnChannels) + 1
+EGOCENTRIC_CHANNELS = len(CnnChannels) + 2
+#-2 is an attack, otherwise the move cost to get there and max moves on the troop's own tile, troops have 3 moves
+CAN_MOVE_LOW = -2
+CAN_MOVE_HIGH = 3
+
+_pooling = {}
+
+
+def _pooling_matrix(size, length):
+    #(size, length) matrix averaging length cells into size bins, boards smaller than the window repeat cells
+    key = (size, length)
+    if key not in _pooling:
+        matrix = np.zeros((size, length), dtype=np.float32)
+        for i in range(size):
+            start = i * length // size
+            end = max((i + 1) * length // size, start + 1)
+            matrix[i, start:end] = 1 / (end - start)
+        _pooling[key] = matrix
+    return _pooling[key]
+
+
+def downsample(plane, size):
+    #averages a (rows, columns) plane down to (size, size)
+    return _pooling_matrix(size, plane.shape[0]) @ plane @ _pooling_matrix(size, plane.shape[1]).T
+
+
+def egocentric_windows(planes, centers, window_size, count):
+    """
+    (count, EGOCENTRIC_CHANNELS, window_size, window_size) crops of the (channels, rows, columns) planes around the
+    (row, col) centers, all gathered with one indexing call. Crops past the board read -1 with OUT_OF_BOARD set,
+    unused crops (more count than centers) are entirely out of board.
+    The summary channel is own units and cities (1) minus enemy ones downsampled from the whole board.
+    """
+    if window_size % 2 == 0:
+        raise ValueError(f"Window size has to be odd, got {window_size}")
+    channels, rows, columns = planes.shape
+    half = window_size // 2
+    padded = np.full((channels + 1, rows + 2 * half, columns + 2 * half), -1, dtype=np.float32)
+    padded[:channels, half:half + rows, half:half + columns] = planes
+    padded[channels] = 1
+    padded[channels, half:half + rows, half:half + columns] = 0
+
+    #a window centered on (row, col) starts at (row, col) of the padded planes
+    centers = np.asarray(centers, dtype=np.intp).reshape(-1, 2)[:count]
+    starts = np.zeros((count, 2), dtype=np.intp)
+    starts[:len(centers)] = centers
+    offsets = np.arange(window_size)
+    windows = np.empty((count, EGOCENTRIC_CHANNELS, window_size, window_size), dtype=np.float32)
+    windows[:, :SUMMARY] = padded[:, starts[:, 0, None, None] + offsets[:, None], starts[:, 1, None, None] + offsets].transpose(1, 0, 2, 3)
+    windows[len(centers):, :OUT_OF_BOARD] = -1
+    windows[len(centers):, OUT_OF_BOARD] = 1
+
+    own = (planes[IS_ENEMY_TROOP] == 0) | (planes[IS_ENEMY_BUILDING] == 0)
+    enemy = (planes[IS_ENEMY_TROOP] == 1) | (planes[IS_ENEMY_BUILDING] == 1)
+    windows[:, SUMMARY] = downsample(own.astype(np.float32) - enemy, window_size)
+    return windows
+
+
+def egocentric_space(window_size, count):
+    #bounds per channel, CAN_MOVE goes from -2 (attack) up to the moves of a troop
+    shape = (count, EGOCENTRIC_CHANNELS, window_size, window_size)
+    low = np.full(shape, -1, dtype=np.float32)
+    high = np.ones(shape, dtype=np.float32)
+    low[:, CAN_MOVE], high[:, CAN_MOVE] = CAN_MOVE_LOW, CAN_MOVE_HIGH
+    low[:, OUT_OF_BOARD] = 0
+    return gym.spaces.Box(low=low, high=high, dtype=np.float32)
+
+
+#Compact observation formats, float32 is the plain (channels, rows, columns) observation.
+#int8 keeps that layout, the bool channels as they are, health and power in 127ths and CAN_MOVE in half moves
+#(so no value is -2 there). packed is a flat uint8 vector: the present and enemy bits of buildings and troops packed
+#8 tiles a byte, then health and power with 0 as no value and 1..255 for 0..1, then CAN_MOVE in half moves plus 4.
+OBSERVATION_FORMATS = ("float32", "int8", "packed")
+BOOL_CHANNELS = [IS_ENEMY_BUILDING, IS_ENEMY_TROOP]
+STAT_LEVELS = 127
+PACKED_STAT_LEVELS = 254
+MOVE_STEPS = 2
+PACKED_MOVE_OFFSET = 4
+
+
+def _packed_sizes(rows, columns):
+    #bytes of the bit planes, the stats and CAN_MOVE in a packed observation
+    tiles = rows * columns
+    return (2 * len(BOOL_CHANNELS) * tiles + 7) // 8, (STATS.stop - STATS.start) * tiles, tiles
+
+
+def format_space(observation_format, rows, columns, num_envs=None):
+    #observation space of a format, with num_envs in front for the vector envs
+    channels = len(CnnChannels)
+    if observation_format == "float32":
+        low, high, dtype = np.full((channels, rows, columns), -1), np.ones((channels, rows, columns)), np.float32
+        low[CAN_MOVE], high[CAN_MOVE] = CAN_MOVE_LOW, CAN_MOVE_HIGH
+    elif observation_format == "int8":
+        low = np.full((channels, rows, columns), -1)
+        high = np.ones((channels, rows, columns))
+        high[STATS] = STAT_LEVELS
+        low[CAN_MOVE], high[CAN_MOVE] = CAN_MOVE_LOW * MOVE_STEPS, CAN_MOVE_HIGH * MOVE_STEPS
+        dtype = np.int8
+    elif observation_format == "packed":
+        size = sum(_packed_sizes(rows, columns))
+        low, high, dtype = np.zeros(size), np.full(size, 255), np.uint8
+    else:
+        raise ValueError(f"Invalid observation format {observation_format}, available formats are {OBSERVATION_FORMATS}")
+    if num_envs is not None:
+        low, high = np.broadcast_to(low, (num_envs, *low.shape)), np.broadcast_to(high, (num_envs, *high.shape))
+    return gym.spaces.Box(low=low.astype(dtype), high=high.astype(dtype), dtype=dtype)
+
+
+def encode_observations(observations, observation_format):
+    #(..., channels, rows, columns) float32 observations into the format, any leading batch dimensions
+    if observation_format == "float32":
+        return observations
+    if observation_format == "int8":
+        encoded = observations.astype(np.int8)
+        stats = observations[..., STATS, :, :]
+        encoded[..., STATS, :, :] = np.where(stats < 0, -1, np.rint(stats * STAT_LEVELS))
+        encoded[..., CAN_MOVE, :, :] = np.rint(observations[..., CAN_MOVE, :, :] * MOVE_STEPS)
+        return encoded
+    if observation_format == "packed":
+        batch = observations.shape[:-3]
+        flags = observations[..., BOOL_CHANNELS, :, :]
+        #present then enemy bits of every bool channel
+        bits = np.stack([flags >= 0, flags == 1], axis=-3).reshape(*batch, -1)
+        stats = observations[..., STATS, :, :]
+        stats = np.where(stats < 0, 0, np.rint(stats * PACKED_STAT_LEVELS) + 1).reshape(*batch, -1)
+        can_move = np.rint(observations[..., CAN_MOVE, :, :] * MOVE_STEPS + PACKED_MOVE_OFFSET).reshape(*batch, -1)
+        return np.concatenate([np.packbits(bits, axis=-1), stats.astype(np.uint8), can_move.astype(np.uint8)], axis=-1)
+    raise ValueError(f"Invalid observation format {observation_format}, available formats are {OBSERVATION_FORMATS}")
+
+
+def decode_observations(observations, observation_format, rows, columns):
+    #back to (..., channels, rows, columns) float32, the same as float32 observations up to the quantization of the stats
+    if observation_format == "float32":
+        return observations
+    if observation_format == "int8":
+        decoded = observations.astype(np.float32)
+        stats = observations[..., STATS, :, :]
+        decoded[..., STATS, :, :] = np.where(stats < 0, np.float32(-1), stats * np.float32(1 / STAT_LEVELS))
+        decoded[..., CAN_MOVE, :, :] /= MOVE_STEPS
+        return decoded
+    if observation_format == "packed":
+        batch = observations.shape[:-1]
+        bit_size, stat_size, _ = _packed_sizes(rows, columns)
+        tiles = rows * columns
+        bits = np.unpackbits(observations[..., :bit_size], axis=-1, count=2 * len(BOOL_CHANNELS) * tiles)
+        bits = bits.reshape(*batch, len(BOOL_CHANNELS), 2, rows, columns)
+        decoded = np.empty((*batch, len(CnnChannels), rows, columns), dtype=np.float32)
+        decoded[..., BOOL_CHANNELS, :, :] = np.where(bits[..., 0, :, :], bits[..., 1, :, :].astype(np.int8), np.int8(-1))
+        stats = observations[..., bit_size:bit_size + stat_size].reshape(*batch, STATS.stop - STATS.start, rows, columns)
+        decoded[..., STATS, :, :] = np.where(stats > 0, (stats.astype(np.float32) - 1) / PACKED_STAT_LEVELS, -1)
+        can_move = observations[..., bit_size + stat_size:].reshape(*batch, rows, columns)
+        decoded[..., CAN_MOVE, :, :] = (can_move.astype(np.float32) - PACKED_MOVE_OFFSET) / MOVE_STEPS
+        return decoded
+    raise ValueError(f"Invalid observation format {observation_format}, available formats are {OBSERVATION_FORMATS}")
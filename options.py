@@ -1,10 +1,12 @@
 from enum import Enum
-from pygame.math import Vector2
 
+#pygame is imported inside the drawing helpers so the game logic can run without it
 def worldToScreen(world, offset, scale):
+    from pygame.math import Vector2
     return Vector2(int((world.x - offset.x) * scale.x), int((world.y - offset.y) * scale.y))
 
 def screenToWorld(screen, offset, scale):
+    from pygame.math import Vector2
     return Vector2(screen.x / scale.x + offset.x, screen.y / scale.y + offset.y)
 
 def draw_centered(window, image, pos):
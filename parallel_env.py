@@ -0,0 +1,124 @@
+import numpy as np
+
+from env import Civ6CombatEnv
+from observation import encode_observations
+from options import Rewards
+
+#pettingzoo is optional, the env follows its parallel api either way
+try:
+    from pettingzoo import ParallelEnv
+except ImportError:
+    ParallelEnv = object
+
+
+class Civ6CombatParallelEnv(ParallelEnv):
+    """
+    Every civ is an agent ("player_0", "player_1", ...), following PettingZoo's ParallelEnv api.
+    Each step every agent with moves left does one action, in an order that rotates every step, and when no agent
+    has moves left a new turn starts for all of them. Invalid actions fall back to a random move and are punished like in Civ6CombatEnv.
+    Rewards are the same as the single agent env, an attack on an agent's unit costs that agent the attacker's reward.
+    Observations are Civ6CombatEnv observations from every agent's side. The board planes are built once and only
+    the enemy channels and the agent's own CAN_MOVE plane differ per agent.
+    """
+
+    metadata = {"name": "civ6combat_parallel_v0", "render_modes": ["human"], "render_fps": 2}
+
+    def __init__(self, rows=6, columns=6, max_steps=100, agents=2, start_troops=2, render_mode=None, fps=None, map_bank=None,
+                 observation_format="float32"):
+        self.env = Civ6CombatEnv(rows, columns, max_steps, render_mode, agents - 1, start_troops, fps, map_bank,
+                                 observation_format=observation_format)
+        self.render_mode = render_mode
+        self.possible_agents = [f"player_{i}" for i in range(agents)]
+        self.agent_ids = {agent: i for i, agent in enumerate(self.possible_agents)}
+        self.agents = []
+        self.curr_steps = 0
+        self.observation_spaces = {agent: self.env.observation_space for agent in self.possible_agents}
+        self.action_spaces = {agent: self.env.action_space for agent in self.possible_agents}
+
+    def observation_space(self, agent):
+        return self.observation_spaces[agent]
+
+    def action_space(self, agent):
+        return self.action_spaces[agent]
+
+    @property
+    def players(self):
+        return [self.env.player] + self.env.bots
+
+    def reset(self, seed=None, options=None):
+        self.env.reset(seed=seed, options=options)
+        self.agents = self.possible_agents[:]
+        self.curr_steps = 0
+        observations = self._observations(self.agents)
+        return observations, {agent: {} for agent in self.agents}
+
+    def step(self, actions):
+        env = self.env
+        registry = env.terrain.registry
+        players = self.players
+        rewards = {agent: 0.0 for agent in self.agents}
+
+        #rotating order so no agent always moves first
+        start = self.curr_steps % len(self.agents)
+        for agent in self.agents[start:] + self.agents[:start]:
+            player_id = self.agent_ids[agent]
+            #troops killed earlier in this step are still listed until cleanup, so check for movable ones
+            if agent not in actions or len(registry.movable_ids(player_id)) == 0 or registry.building_count(player_id) == 0:
+                continue
+            action = actions[agent]
+            (_, _), (target_row, target_col) = action
+            target = env.terrain.get_building(target_row, target_col) or env.terrain.get_troop(target_row, target_col)
+            valid = env.terrain.is_valid_action(action, player_id)
+            reward = env.terrain.action(action, player_id)
+            rewards[agent] += reward
+            #the attacked agent loses what the attacker got, like the bots' attacks in Civ6CombatEnv
+            if valid and target is not None and target.player_id != player_id and self.possible_agents[target.player_id] in rewards:
+                rewards[self.possible_agents[target.player_id]] -= reward
+
+        for agent in self.agents:
+            rewards[agent] -= env._cleanup(players[self.agent_ids[agent]])
+
+        self.curr_steps += 1
+        terminations = {}
+        for agent in self.agents:
+            player_id = self.agent_ids[agent]
+            lost = registry.troop_count(player_id) == 0 or registry.building_count(player_id) == 0
+            terminations[agent] = lost
+            if lost:
+                rewards[agent] -= Rewards.WIN_GAME.value
+        alive = [agent for agent in self.agents if not terminations[agent]]
+        if len(alive) == 1:
+            terminations[alive[0]] = True
+            rewards[alive[0]] += Rewards.WIN_GAME.value
+        truncated = self.curr_steps >= env.max_steps
+        truncations = {agent: truncated for agent in self.agents}
+
+        #new turn once nobody has moves left
+        if all(registry.turn_over(self.agent_ids[agent]) for agent in alive):
+            for agent in alive:
+                env._reset_moves(players[self.agent_ids[agent]])
+
+        observations = self._observations(self.agents)
+        infos = {agent: {} for agent in self.agents}
+        self.agents = [agent for agent in self.agents if not terminations[agent] and not truncated]
+        if self.render_mode == "human":
+            env._render_frame()
+        return observations, rewards, terminations, truncations, infos
+
+    def action_masks(self, agent):
+        #like Civ6CombatEnv.action_masks for the agent
+        return self.env.terrain.action_masks(self.agent_ids[agent])
+
+    def _observations(self, agents):
+        #player_0's planes from the env's ObservationBuilder, the other agents only rewrite what depends on the viewer
+        env = self.env
+        observations = env._observations().views([self.agent_ids[agent] for agent in agents])
+        observations = encode_observations(observations, env.observation_format)
+        return dict(zip(agents, observations))
+
+    def render(self):
+        if self.render_mode == "human":
+            self.env._render_frame()
+
+    def close(self):
+        self.env.close()
@@ -0,0 +1,89 @@
+import json
+import time
+
+import numpy as np
+
+#Phases of Civ6CombatEnv.step and reset, ai_sim includes the bots' cleanups and the frames rendered during their turns
+PHASES = ("reset", "action", "cleanup", "render", "ai_sim", "get_obs")
+#hot path events, bfs is a single troop reachability that missed its cache, batched_bfs one batched pass
+COUNTERS = ("bfs", "batched_bfs", "invalid_actions", "attacks", "kills")
+#histogram bucket edges in microseconds, log spaced from 1us to 1s
+HISTOGRAM_EDGES = np.logspace(0, 6, 25)
+
+
+class StepProfiler:
+    """
+    Opt in timings of Civ6CombatEnv, enabled with Civ6CombatEnv(profile=True).
+    Every step or reset is split into phases with lap, the env reports the step's timings and counters
+    through info["profile"]. The last window samples of every phase are kept for summary, histograms and export.
+    """
+
+    def __init__(self, window=10000):
+        self.window = window
+        #ring buffers of phase times in nanoseconds
+        self.samples = {phase: np.zeros(window, dtype=np.int64) for phase in PHASES}
+        self.sample_counts = dict.fromkeys(PHASES, 0)
+        self.totals = dict.fromkeys(COUNTERS, 0)
+        self.timings = {}
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self._last = time.perf_counter_ns()
+
+    def start(self):
+        #starts a step or reset, the timings and counters so far are dropped
+        self.timings = {}
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self._last = time.perf_counter_ns()
+
+    def lap(self, phase):
+        #time since the previous lap goes to phase, a phase can be lapped several times per step
+        now = time.perf_counter_ns()
+        self.timings[phase] = self.timings.get(phase, 0) + now - self._last
+        self._last = now
+
+    def count(self, counter, amount=1):
+        self.counters[counter] += amount
+
+    def finish(self):
+        #stores the step in the rolling windows, returns what goes into info: seconds per phase and the counters
+        for phase, elapsed in self.timings.items():
+            self.samples[phase][self.sample_counts[phase] % self.window] = elapsed
+            self.sample_counts[phase] += 1
+        for counter, amount in self.counters.items():
+            self.totals[counter] += amount
+        return {"timings": {phase: elapsed / 1e9 for phase, elapsed in self.timings.items()}, "counters": dict(self.counters)}
+
+    def window_samples(self, phase):
+        #the phase's samples still in the window in microseconds, oldest first isn't guaranteed
+        return self.samples[phase][:min(self.sample_counts[phase], self.window)] / 1000
+
+    def summary(self):
+        summary = {}
+        for phase in PHASES:
+            samples = self.window_samples(phase)
+            if len(samples):
+                summary[phase] = {"count": self.sample_counts[phase], "mean_us": float(samples.mean()),
+                                  "p50_us": float(np.median(samples)), "p95_us": float(np.percentile(samples, 95)),
+                                  "max_us": float(samples.max())}
+        return summary
+
+    def histograms(self, edges=HISTOGRAM_EDGES):
+        #counts per bucket, times outside the edges go to the first or last bucket
+        histograms = {}
+        for phase in PHASES:
+            samples = self.window_samples(phase)
+            if len(samples):
+                counts, _ = np.histogram(np.clip(samples, edges[0], edges[-1]), bins=edges)
+                histograms[phase] = counts.tolist()
+        return {"edges_us": np.asarray(edges).tolist(), "counts": histograms}
+
+    def export(self, path=None):
+        #everything as a json compatible dict, also written to path if given
+        data = {"summary": self.summary(), "histograms": self.histograms(), "counters": dict(self.totals)}
+        if path is not None:
+            with open(path, "w") as file:
+                json.dump(data, file, indent=2)
+        return data
+
+    def clear(self):
+        self.sample_counts = dict.fromkeys(PHASES, 0)
+        self.totals = dict.fromkeys(COUNTERS, 0)
@@ -0,0 +1,141 @@
+import numpy as np
+
+from entities import Troop
+
+
+class DenseIds:
+    #ids in no particular order, removing moves the last id into the hole
+    def __init__(self, capacity=8):
+        self.ids = np.empty(capacity, dtype=np.int32)
+        self.count = 0
+
+    def view(self):
+        return self.ids[:self.count]
+
+    def append(self, entity_id):
+        if self.count == len(self.ids):
+            self.ids = np.concatenate([self.ids, np.empty(len(self.ids), dtype=np.int32)])
+        self.ids[self.count] = entity_id
+        self.count += 1
+        return self.count - 1
+
+
+class EntityRegistry:
+    """
+    All entities of a game by id and the troops and buildings every player still has.
+    Every player has a dense array of troop ids and one of building ids, an id is swapped out on removal so adding
+    and removing are O(1). Ids never change, they index entities and the troop_ids and building_ids grids.
+    alive and has_moves are flags over all ids, kill clears alive and Troop.moves keeps has_moves up to date.
+    Lists of entities are returned in id order, which is the order they were created in.
+    """
+
+    def __init__(self, capacity=32):
+        self.entities = []
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.has_moves = np.zeros(capacity, dtype=bool)
+        #index into the player's dense array, -1 once removed
+        self.slot = np.full(capacity, -1, dtype=np.int32)
+        self._troops = []
+        self._buildings = []
+
+    def add(self, entity, listed=True):
+        #gives the entity its id, listed entities are added to their player's troops or buildings
+        entity_id = len(self.entities)
+        if entity_id == len(self.alive):
+            self.alive = np.concatenate([self.alive, np.zeros_like(self.alive)])
+            self.has_moves = np.concatenate([self.has_moves, np.zeros_like(self.has_moves)])
+            self.slot = np.concatenate([self.slot, np.full_like(self.slot, -1)])
+        entity.id = entity_id
+        self.entities.append(entity)
+        self.alive[entity_id] = entity.health > 0
+        if isinstance(entity, Troop):
+            entity.registry = self
+            self.has_moves[entity_id] = entity.moves > 0
+        if listed:
+            self.slot[entity_id] = self._dense(entity).append(entity_id)
+
+    def remove(self, entity):
+        slot = self.slot[entity.id]
+        if slot < 0:
+            return
+        dense = self._dense(entity)
+        last = dense.ids[dense.count - 1]
+        dense.ids[slot] = last
+        self.slot[last] = slot
+        dense.count -= 1
+        self.slot[entity.id] = -1
+
+    def remove_dead(self, player_id):
+        #removes the player's killed troops and buildings, returns them
+        dead = []
+        for dense in (self._dense_of(self._troops, player_id), self._dense_of(self._buildings, player_id)):
+            ids = dense.view()
+            dead += [self.entities[entity_id] for entity_id in np.sort(ids[~self.alive[ids]])]
+        for entity in dead:
+            self.remove(entity)
+        return dead
+
+    def reset_moves(self, player_id):
+        #every listed troop of the player gets its max moves, the flags are set in one go
+        ids = self._dense_of(self._troops, player_id).view()
+        for entity_id in ids.tolist():
+            troop = self.entities[entity_id]
+            troop._moves = troop.max_moves
+        self.has_moves[ids] = [self.entities[entity_id].max_moves > 0 for entity_id in ids.tolist()]
+
+    def clear_troops(self, player_id):
+        dense = self._dense_of(self._troops, player_id)
+        self.slot[dense.view()] = -1
+        dense.count = 0
+
+    def clear(self):
+        self.entities.clear()
+        self.alive[:] = False
+        self.has_moves[:] = False
+        self.slot[:] = -1
+        self._troops = []
+        self._buildings = []
+
+    def troop_ids(self, player_id):
+        return np.sort(self._dense_of(self._troops, player_id).view())
+
+    def building_ids(self, player_id):
+        return np.sort(self._dense_of(self._buildings, player_id).view())
+
+    def movable_ids(self, player_id):
+        #listed troops that are alive and have moves left
+        ids = self.troop_ids(player_id)
+        return ids[self.alive[ids] & self.has_moves[ids]]
+
+    def troops(self, player_id):
+        return [self.entities[entity_id] for entity_id in self.troop_ids(player_id)]
+
+    def buildings(self, player_id):
+        return [self.entities[entity_id] for entity_id in self.building_ids(player_id)]
+
+    def movable(self, player_id):
+        return [self.entities[entity_id] for entity_id in self.movable_ids(player_id)]
+
+    def troop_count(self, player_id):
+        return self._dense_of(self._troops, player_id).count
+
+    def building_count(self, player_id):
+        return self._dense_of(self._buildings, player_id).count
+
+    def turn_over(self, player_id):
+        #no listed troop has moves left
+        dense = self._dense_of(self._troops, player_id)
+        return not self.has_moves[dense.view()].any()
+
+    def listed(self):
+        #flag per entity id, still in its player's troops or buildings
+        return self.slot[:len(self.entities)] >= 0
+
+    def _dense(self, entity):
+        return self._dense_of(self._troops if isinstance(entity, Troop) else self._buildings, entity.player_id)
+
+    @staticmethod
+    def _dense_of(lists, player_id):
+        while len(lists) <= player_id:
+            lists.append(DenseIds())
+        return lists[player_id]
@@ -0,0 +1,95 @@
+import numpy as np
+
+from hex_geometry import neighbor_lists
+
+#pygame is imported inside the methods like in the rest of the drawing code, only render modes need it
+
+class BoardRenderer:
+    """
+    Draws a Terrain onto the window. The terrain never changes during an episode so all tile backgrounds
+    are composited once into a surface for the current offset, zoom and window size. After that only the
+    tiles whose units or highlights changed since the last frame are redrawn and pushed to the display.
+    """
+
+    def __init__(self, terrain, player_id):
+        self.terrain = terrain
+        self.player_id = player_id
+        self._static = None
+        self._static_key = None
+        #flat tile -> what was drawn there last frame, see _signature
+        self._drawn = {}
+
+    def draw(self, window, offset, scale):
+        #returns the screen rects that changed, the caller passes them to pygame.display.update
+        import pygame
+        key = (offset.x, offset.y, scale.x, scale.y, window.get_size())
+        signatures = self._signatures()
+        if key != self._static_key:
+            self._compose_static(window, offset, scale, key)
+            window.blit(self._static, (0, 0))
+            for tile in sorted(signatures):
+                self._tile(tile).draw_units(window, self.player_id, offset, scale)
+            self._drawn = signatures
+            return [window.get_rect()]
+
+        dirty = [tile for tile in signatures.keys() | self._drawn.keys() if signatures.get(tile) != self._drawn.get(tile)]
+        self._drawn = signatures
+        neighbors = neighbor_lists(self.terrain.row_count, self.terrain.column_count)
+        rects = []
+        for tile in dirty:
+            pos, size = self._tile(tile).screen_rect(offset, scale)
+            rect = pygame.Rect(int(pos.x) - 1, int(pos.y) - 1, int(size) + 3, int(size) + 3).clip(window.get_rect())
+            if rect.width == 0 or rect.height == 0:
+                continue
+            #neighboring hexes overlap the square of this one, so their units are drawn again inside the clip
+            self._redraw(window, rect, (tile,) + neighbors[tile], offset, scale)
+            rects.append(rect)
+        return rects
+
+    def clear(self, window, rect, offset, scale):
+        #puts the board back under rect, for things drawn on top of it like the game info text
+        import pygame
+        rect = pygame.Rect(rect)
+        tiles = []
+        for tile in self._drawn:
+            pos, size = self._tile(tile).screen_rect(offset, scale)
+            if rect.colliderect((pos.x, pos.y, size, size)):
+                tiles.append(tile)
+        self._redraw(window, rect, tiles, offset, scale)
+
+    def _redraw(self, window, rect, tiles, offset, scale):
+        window.set_clip(rect)
+        window.blit(self._static, rect, rect)
+        for tile in sorted(tiles):
+            if tile in self._drawn:
+                self._tile(tile).draw_units(window, self.player_id, offset, scale)
+        window.set_clip(None)
+
+    def _compose_static(self, window, offset, scale, key):
+        import pygame
+        self._static = pygame.Surface(window.get_size()).convert()
+        self._static.fill((0, 0, 0))
+        for row in range(self.terrain.row_count):
+            for col in range(self.terrain.column_count):
+                self.terrain[row, col].draw_terrain(self._static, offset, scale)
+        self._static_key = key
+
+    def _tile(self, tile):
+        return self.terrain[divmod(tile, self.terrain.column_count)]
+
+    def _signatures(self):
+        #everything that changes how a tile looks, only for tiles that have something drawn on them
+        terrain = self.terrain
+        shown = (terrain.troop_ids >= 0) | (terrain.building_ids >= 0) | terrain.highlight_move | terrain.highlight_attack
+        signatures = {}
+        for tile in np.flatnonzero(shown):
+            row, col = divmod(int(tile), terrain.column_count)
+            troop = terrain.get_troop(row, col)
+            building = terrain.get_building(row, col)
+            signatures[int(tile)] = (
+                (troop.id, troop.health, troop.power, troop.moves, troop.fortified) if troop else None,
+                (building.id, building.health, building.power) if building else None,
+                bool(terrain.highlight_move[row, col]),
+                bool(terrain.highlight_attack[row, col]),
+            )
+        return signatures
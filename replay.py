@@ -0,0 +1,341 @@
+import queue
+import struct
+import argparse
+import threading
+
+import numpy as np
+import gymnasium as gym
+
+from state import GameState, ENTITY_DTYPE, entities_to_array, entities_from_array
+from options import MARGIN, HEX_SIZE, Colors
+
+#Replay file: header (magic, format version) followed by records. A record is (kind, payload length) and the payload,
+#an episode record holds the starting GameState and every step record the changes the step made to it.
+MAGIC = b"CIVR"
+REPLAY_VERSION = 1
+HEADER = struct.Struct("<4sH")
+RECORD = struct.Struct("<BI")
+EPISODE = 0
+STEP = 1
+#step number, action (from_row, from_col, to_row, to_col), reward, terminated, truncated, changed entities, changed tiles
+STEP_HEADER = struct.Struct("<I4hf??HH")
+
+
+class EpisodeRecorder(gym.Wrapper):
+    """
+    Records episodes of a Civ6CombatEnv into a replay file, see ReplayViewer.
+    Only the entities and tiles a step changed are written (moves, damage, deaths, fortify changes), the file is
+    written by a background thread. probability is the share of episodes recorded, decided at every reset.
+    """
+
+    def __init__(self, env, path, probability=1.0, seed=None, max_queue=1024):
+        super().__init__(env)
+        self.path = path
+        self.probability = probability
+        #own generator, recording doesn't change the env's random stream
+        self.np_random_recorder = np.random.default_rng(seed)
+        self.recording = False
+        self.episodes = 0
+        self._steps = 0
+        self._entities = None
+        self._troop_ids = None
+        self._building_ids = None
+
+        self._file = open(path, "wb")
+        self._file.write(HEADER.pack(MAGIC, REPLAY_VERSION))
+        self._queue = queue.Queue(max_queue)
+        self._writer = threading.Thread(target=self._write, daemon=True)
+        self._writer.start()
+
+    def reset(self, **kwargs):
+        observation, info = self.env.reset(**kwargs)
+        self.recording = self.probability >= 1 or self.np_random_recorder.random() < self.probability
+        if self.recording:
+            env = self.env.unwrapped
+            state = env.get_state()
+            self._steps = 0
+            self._entities = state.entities
+            self._troop_ids = state.troop_ids.reshape(-1)
+            self._building_ids = state.building_ids.reshape(-1)
+            self._put(EPISODE, state.to_bytes())
+            self.episodes += 1
+        return observation, info
+
+    def step(self, action):
+        observation, reward, terminated, truncated, info = self.env.step(action)
+        if self.recording:
+            self._record_step(action, reward, terminated, truncated)
+        return observation, reward, terminated, truncated, info
+
+    def _record_step(self, action, reward, terminated, truncated):
+        env = self.env.unwrapped
+        terrain = env.terrain
+        entities = entities_to_array(terrain.registry)
+        troop_ids = terrain.troop_ids.reshape(-1)
+        building_ids = terrain.building_ids.reshape(-1)
+        #compared as raw bytes, comparing structured arrays field by field is much slower
+        changed = np.flatnonzero((entities.view(np.uint8) != self._entities.view(np.uint8)).reshape(len(entities), -1).any(axis=1)).astype(np.int32)
+        tiles = np.flatnonzero((troop_ids != self._troop_ids) | (building_ids != self._building_ids)).astype(np.int32)
+
+        (from_row, from_col), (to_row, to_col) = action
+        header = STEP_HEADER.pack(self._steps, from_row, from_col, to_row, to_col, reward, terminated, truncated, len(changed), len(tiles))
+        self._put(STEP, b"".join([header, changed.tobytes(), entities[changed].tobytes(), tiles.tobytes(),
+                                  troop_ids[tiles].astype(np.int32).tobytes(), building_ids[tiles].astype(np.int32).tobytes()]))
+        self._steps += 1
+        self._entities = entities
+        self._troop_ids = troop_ids.copy()
+        self._building_ids = building_ids.copy()
+
+    def _put(self, kind, payload):
+        self._queue.put(RECORD.pack(kind, len(payload)) + payload)
+
+    def _write(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                return
+            self._file.write(data)
+
+    def close(self):
+        if self._file is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._file.close()
+            self._file = None
+        super().close()
+
+
+class Episode:
+    """
+    One recorded episode. Every frame is rebuilt from the start state and the step deltas when the episode
+    is read, so moving through it backwards or forwards is only indexing.
+    Frame 0 is the start, frame i the game after step i.
+    """
+
+    def __init__(self, start, steps):
+        self.start = start
+        self.actions = np.array([step[0] for step in steps], dtype=np.int16).reshape(-1, 4)
+        self.rewards = np.array([step[1] for step in steps], dtype=np.float32)
+        self.terminated = bool(steps and steps[-1][2])
+        self.truncated = bool(steps and steps[-1][3])
+
+        frames = len(steps) + 1
+        self.entities = np.empty((frames, len(start.entities)), dtype=ENTITY_DTYPE)
+        self.troop_ids = np.empty((frames, start.troop_ids.size), dtype=np.int32)
+        self.building_ids = np.empty((frames, start.building_ids.size), dtype=np.int32)
+        self.entities[0] = start.entities
+        self.troop_ids[0] = start.troop_ids.reshape(-1)
+        self.building_ids[0] = start.building_ids.reshape(-1)
+        for frame, (_, _, _, _, changed, rows, tiles, troop_ids, building_ids) in enumerate(steps, 1):
+            self.entities[frame] = self.entities[frame - 1]
+            self.entities[frame, changed] = rows
+            self.troop_ids[frame] = self.troop_ids[frame - 1]
+            self.troop_ids[frame, tiles] = troop_ids
+            self.building_ids[frame] = self.building_ids[frame - 1]
+            self.building_ids[frame, tiles] = building_ids
+
+    def __len__(self):
+        return len(self.entities)
+
+    def state(self, frame):
+        start = self.start
+        return GameState(start.tile_type, start.owner, self.troop_ids[frame].reshape(start.troop_ids.shape),
+                         self.building_ids[frame].reshape(start.building_ids.shape), self.entities[frame],
+                         start.player_count, start.curr_steps + frame, start.score + float(self.rewards[:frame].sum()))
+
+
+def read_replay(path):
+    """All episodes of a replay file as a list of Episode"""
+    with open(path, "rb") as file:
+        data = file.read()
+    magic, version = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not a replay file")
+    if version != REPLAY_VERSION:
+        raise ValueError(f"Replay version {version} is not supported, expected {REPLAY_VERSION}")
+
+    episodes = []
+    start, steps = None, []
+    offset = HEADER.size
+    #a file cut off while writing ends with a partial record, it is ignored
+    while offset + RECORD.size <= len(data):
+        kind, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        if offset + length > len(data):
+            break
+        payload = memoryview(data)[offset:offset + length]
+        offset += length
+        if kind == EPISODE:
+            if start is not None:
+                episodes.append(Episode(start, steps))
+            start, steps = GameState.from_bytes(payload), []
+        elif kind == STEP:
+            steps.append(_read_step(payload))
+    if start is not None:
+        episodes.append(Episode(start, steps))
+    return episodes
+
+
+def _read_step(payload):
+    _, *action, reward, terminated, truncated, entity_count, tile_count = STEP_HEADER.unpack_from(payload)
+    offset = STEP_HEADER.size
+
+    def read(dtype, count):
+        nonlocal offset
+        array = np.frombuffer(payload, dtype=dtype, count=count, offset=offset)
+        offset += array.nbytes
+        return array
+
+    changed = read(np.int32, entity_count)
+    rows = read(ENTITY_DTYPE, entity_count)
+    tiles = read(np.int32, tile_count)
+    return action, reward, terminated, truncated, changed, rows, tiles, read(np.int32, tile_count), read(np.int32, tile_count)
+
+
+class ReplayViewer:
+    """
+    Shows recorded episodes with the env's drawing code, no game logic runs.
+    Right/Left step a frame, PageUp/PageDown 10 frames, Home/End jump to the start or end,
+    Space plays or pauses, Up/Down switch episodes, +/- zoom and dragging the mouse pans.
+    """
+
+    def __init__(self, path, fps=4):
+        self.episodes = read_replay(path)
+        if not self.episodes:
+            raise ValueError(f"{path} has no episodes")
+        self.fps = fps
+        self.episode = 0
+        self.frame = 0
+        self.window = None
+        self.terrain = None
+        self.players = None
+        self.renderer = None
+
+    def open(self):
+        import pygame
+        from pygame.math import Vector2
+        pygame.init()
+        pygame.display.init()
+        info = pygame.display.Info()
+        self.window = pygame.display.set_mode((info.current_w, info.current_h), pygame.RESIZABLE)
+        self.clock = pygame.time.Clock()
+        self.offset = Vector2(0, 0)
+        self.scale = Vector2(1, 1)
+        self.show(0, 0)
+
+    def show(self, episode, frame):
+        #draws a frame, the board is only rebuilt when the episode changes
+        import pygame
+        from renderer import BoardRenderer
+        episode = min(max(episode, 0), len(self.episodes) - 1)
+        frame = min(max(frame, 0), len(self.episodes[episode]) - 1)
+        state = self.episodes[episode].state(frame)
+        if self.renderer is None or episode != self.episode:
+            self.terrain, self.players = state.to_game(draw=True)
+            self.renderer = BoardRenderer(self.terrain, 0)
+            self.window.fill((0, 0, 0))
+        else:
+            #entities are replaced, the renderer compares what they look like and redraws the changed tiles
+            self.terrain.troop_ids[:] = state.troop_ids
+            self.terrain.building_ids[:] = state.building_ids
+            self.terrain.registry.clear()
+            entities_from_array(state.entities, self.terrain.registry)
+        self.episode, self.frame = episode, frame
+
+        rects = self.renderer.draw(self.window, self.offset, self.scale)
+        rects.append(self._draw_info())
+        pygame.display.update(rects)
+
+    def _draw_info(self):
+        from assets import render_cache
+        episode = self.episodes[self.episode]
+        font_size = int(HEX_SIZE/5)
+        font = render_cache.font(font_size)
+        x = MARGIN
+        y = HEX_SIZE * 0.75 * (self.terrain.row_count+1) + MARGIN
+        if self.frame > 0:
+            action = episode.actions[self.frame - 1]
+            last = f"Action: ({action[0]}, {action[1]}) -> ({action[2]}, {action[3]}) | Reward: {episode.rewards[self.frame - 1]:.1f}"
+        else:
+            last = "Start"
+        lines = [f"Episode {self.episode + 1}/{len(self.episodes)} | Frame {self.frame}/{len(episode) - 1}", last]
+        rect = self.window.get_rect().clip((x, y, self.window.get_width() - x, font_size * len(lines)))
+        self.renderer.clear(self.window, rect, self.offset, self.scale)
+        for line in lines:
+            self.window.blit(font.render(line, True, Colors.WHITE.value), (x, y))
+            y += font_size
+        return rect
+
+    def run(self):
+        import pygame
+        if self.window is None:
+            self.open()
+        playing = False
+        start_pan = None
+        running = True
+        while running:
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    running = False
+                elif event.type == pygame.VIDEORESIZE:
+                    self.window = pygame.display.set_mode((event.w, event.h), pygame.RESIZABLE)
+                    self.show(self.episode, self.frame)
+                elif event.type == pygame.KEYDOWN:
+                    jumps = {pygame.K_RIGHT: 1, pygame.K_LEFT: -1, pygame.K_PAGEDOWN: 10, pygame.K_PAGEUP: -10}
+                    if event.key == pygame.K_ESCAPE:
+                        running = False
+                    elif event.key == pygame.K_SPACE:
+                        playing = not playing
+                    elif event.key in jumps:
+                        self.show(self.episode, self.frame + jumps[event.key])
+                    elif event.key == pygame.K_HOME:
+                        self.show(self.episode, 0)
+                    elif event.key == pygame.K_END:
+                        self.show(self.episode, len(self.episodes[self.episode]) - 1)
+                    elif event.key in (pygame.K_UP, pygame.K_DOWN):
+                        self.show(self.episode + (1 if event.key == pygame.K_DOWN else -1), 0)
+                    elif event.key in (pygame.K_EQUALS, pygame.K_MINUS):
+                        zoom = 1.1 if event.key == pygame.K_EQUALS else 0.9
+                        self.scale.x *= zoom
+                        self.scale.y *= zoom
+                        self.show(self.episode, self.frame)
+                elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+                    start_pan = pygame.mouse.get_pos()
+                elif event.type == pygame.MOUSEMOTION and event.buttons[0] and start_pan is not None:
+                    end_pan = pygame.mouse.get_pos()
+                    self.offset.x -= (end_pan[0] - start_pan[0]) / self.scale.x
+                    self.offset.y -= (end_pan[1] - start_pan[1]) / self.scale.y
+                    start_pan = end_pan
+                    self.show(self.episode, self.frame)
+            if playing:
+                if self.frame < len(self.episodes[self.episode]) - 1:
+                    self.show(self.episode, self.frame + 1)
+                else:
+                    playing = False
+            self.clock.tick(self.fps if playing else 30)
+        self.close()
+
+    def close(self):
+        if self.window is not None:
+            import pygame
+            from assets import render_cache
+            render_cache.clear()
+            pygame.display.quit()
+            pygame.quit()
+            self.window = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Watch recorded Civ6CombatEnv episodes")
+    parser.add_argument("path")
+    parser.add_argument("--episode", type=int, default=0)
+    parser.add_argument("--fps", type=int, default=4)
+    args = parser.parse_args(argv)
+    viewer = ReplayViewer(args.path, args.fps)
+    viewer.open()
+    viewer.show(args.episode, 0)
+    viewer.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import json
+import struct
+
+import numpy as np
+
+from entities import Warrior, Archer, Center, Troop, Player
+from terrain import Terrain
+from options import FortifiedBonus
+
+#Binary format: header (magic, format version, json length), json with the scalars, then the raw arrays.
+#Bump STATE_VERSION whenever the layout changes, old files are rejected instead of read wrong.
+MAGIC = b"CIVS"
+STATE_VERSION = 1
+HEADER = struct.Struct("<4sHI")
+
+WARRIOR = 0
+ARCHER = 1
+CENTER = 2
+KINDS = {Warrior: WARRIOR, Archer: ARCHER, Center: CENTER}
+
+#one row per Terrain.entities entry, dead entities included so ids in the grids stay valid
+ENTITY_DTYPE = np.dtype([
+    ("kind", np.int8),
+    ("player_id", np.int16),
+    ("listed", bool), #still in its player's troops or buildings list
+    ("row", np.int16),
+    ("col", np.int16),
+    ("health", np.float64),
+    ("max_health", np.float64),
+    ("power", np.int32),
+    ("hp_power_loss", np.int32),
+    ("attack_range", np.int8),
+    ("moves", np.float64),
+    ("max_moves", np.int32),
+    ("fortified", np.int8),
+])
+
+
+class GameState:
+    """
+    Snapshot of one Civ6CombatEnv game, see Civ6CombatEnv.get_state and set_state.
+    Everything is kept in arrays so copying a state is a handful of memcpys.
+    """
+
+    def __init__(self, tile_type, owner, troop_ids, building_ids, entities, player_count, curr_steps, score, rng_state=None):
+        self.tile_type = tile_type
+        self.owner = owner
+        self.troop_ids = troop_ids
+        self.building_ids = building_ids
+        self.entities = entities
+        self.player_count = player_count
+        self.curr_steps = curr_steps
+        self.score = score
+        #bit generator state of the env's np_random, None if it isn't restored
+        self.rng_state = rng_state
+
+    def copy(self):
+        return GameState(self.tile_type.copy(), self.owner.copy(), self.troop_ids.copy(), self.building_ids.copy(),
+                         self.entities.copy(), self.player_count, self.curr_steps, self.score,
+                         json.loads(json.dumps(self.rng_state)))
+
+    def to_bytes(self):
+        meta = {
+            "rows": self.tile_type.shape[0],
+            "columns": self.tile_type.shape[1],
+            "entities": len(self.entities),
+            "player_count": self.player_count,
+            "curr_steps": self.curr_steps,
+            "score": self.score,
+            "rng_state": self.rng_state,
+        }
+        meta = json.dumps(meta).encode()
+        arrays = [self.tile_type.astype(np.int8), self.owner.astype(np.int16), self.troop_ids.astype(np.int32),
+                  self.building_ids.astype(np.int32), self.entities.astype(ENTITY_DTYPE)]
+        return b"".join([HEADER.pack(MAGIC, STATE_VERSION, len(meta)), meta] + [np.ascontiguousarray(array).tobytes() for array in arrays])
+
+    @staticmethod
+    def from_bytes(data):
+        magic, version, meta_length = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError("Not a game state")
+        if version != STATE_VERSION:
+            raise ValueError(f"Game state version {version} is not supported, expected {STATE_VERSION}")
+        offset = HEADER.size
+        meta = json.loads(bytes(data[offset:offset + meta_length]))
+        offset += meta_length
+
+        def read(dtype, count):
+            nonlocal offset
+            array = np.frombuffer(data, dtype=dtype, count=count, offset=offset).copy()
+            offset += array.nbytes
+            return array
+
+        shape = (meta["rows"], meta["columns"])
+        tiles = shape[0] * shape[1]
+        tile_type = read(np.int8, tiles).reshape(shape)
+        owner = read(np.int16, tiles).reshape(shape)
+        troop_ids = read(np.int32, tiles).reshape(shape)
+        building_ids = read(np.int32, tiles).reshape(shape)
+        entities = read(ENTITY_DTYPE, meta["entities"])
+        return GameState(tile_type, owner, troop_ids, building_ids, entities, meta["player_count"],
+                         meta["curr_steps"], meta["score"], meta["rng_state"])
+
+    def to_game(self, draw=False, np_random=None):
+        #the board and players of the state, (terrain, players) with player 0 the learning player
+        terrain = Terrain(self.tile_type.shape[0], self.tile_type.shape[1], draw, np_random, self.tile_type)
+        terrain.owner[:] = self.owner
+        terrain.troop_ids[:] = self.troop_ids
+        terrain.building_ids[:] = self.building_ids
+        entities_from_array(self.entities, terrain.registry)
+        players = [Player("Hero", 0, terrain.registry)] + [Player(f"{i}", i+1, terrain.registry) for i in range(self.player_count - 1)]
+        return terrain, players
+
+    def save(self, path):
+        with open(path, "wb") as file:
+            file.write(self.to_bytes())
+
+    @staticmethod
+    def load(path):
+        with open(path, "rb") as file:
+            return GameState.from_bytes(file.read())
+
+
+def entities_to_array(registry):
+    rows = []
+    for entity, listed in zip(registry.entities, registry.listed().tolist()):
+        is_troop = isinstance(entity, Troop)
+        rows.append((KINDS[type(entity)], entity.player_id, listed, entity.row, entity.col,
+                     entity.health, entity.max_health, entity.power, entity.hp_power_loss, entity.attack_range,
+                     entity.moves if is_troop else 0, entity.max_moves if is_troop else 0,
+                     entity.fortified.value if is_troop else 0))
+    return np.array(rows, dtype=ENTITY_DTYPE)
+
+
+def entities_from_array(array, registry):
+    #adds the entities to an empty registry in id order, so every entity gets its old id back
+    for kind, player_id, listed, row, col, health, max_health, power, hp_power_loss, attack_range, \
+            moves, max_moves, fortified in array.tolist():
+        if kind == CENTER:
+            entity = Center(health, max_health, power, player_id, row, col, hp_power_loss, attack_range)
+        else:
+            troop = Warrior if kind == WARRIOR else Archer
+            entity = troop(moves, max_moves, health, max_health, power, player_id, row, col,
+                           FortifiedBonus(fortified), hp_power_loss, attack_range)
+        registry.add(entity, listed)
+    return registry.entities
@@ -0,0 +1,179 @@
+import multiprocessing as mp
+import traceback
+from multiprocessing import shared_memory
+
+import numpy as np
+import gymnasium as gym
+
+from env import Civ6CombatEnv
+from observation import format_space
+
+#Commands sent to the workers as single bytes, so nothing is pickled per step
+STEP = b"s"
+RESET = b"r"
+CLOSE = b"c"
+
+
+class SharedBuffers:
+    """
+    Every array the workers write into lives in one shared memory block, workers attach to it by name.
+    Layout is fixed by num_envs and the board size so both sides compute the same views.
+    """
+
+    def __init__(self, num_envs, rows, columns, name=None, observation_format="float32"):
+        space = format_space(observation_format, rows, columns, num_envs)
+        self.specs = [
+            ("observations", space.shape, space.dtype),
+            ("final_observations", space.shape, space.dtype),
+            ("actions", (num_envs, 4), np.int64),
+            ("seeds", (num_envs, 4), np.uint32),
+            ("rewards", (num_envs,), np.float32),
+            ("terminated", (num_envs,), bool),
+            ("truncated", (num_envs,), bool),
+            ("reseed", (num_envs,), bool),
+        ]
+        size = sum(self._nbytes(shape, dtype) for _, shape, dtype in self.specs)
+        if name is None:
+            self.memory = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+
+        offset = 0
+        for field, shape, dtype in self.specs:
+            setattr(self, field, np.ndarray(shape, dtype=dtype, buffer=self.memory.buf, offset=offset))
+            offset += self._nbytes(shape, dtype)
+
+    @staticmethod
+    def _nbytes(shape, dtype):
+        #rounded up so every array starts 64 byte aligned
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        return (nbytes + 63) // 64 * 64
+
+    def close(self, unlink=False):
+        #the views have to go before the memory can be closed
+        for field, _, _ in self.specs:
+            setattr(self, field, None)
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+
+def _worker(conn, name, num_envs, envs, env_kwargs):
+    buffers = SharedBuffers(num_envs, env_kwargs["rows"], env_kwargs["columns"], name, env_kwargs["observation_format"])
+    games = {index: Civ6CombatEnv(**env_kwargs) for index in envs}
+    try:
+        while True:
+            command = conn.recv_bytes()
+            if command == CLOSE:
+                break
+            try:
+                for index, game in games.items():
+                    if command == RESET:
+                        if buffers.reseed[index]:
+                            #every game owns a generator from its own branch of the seed sequence
+                            game.np_random = np.random.Generator(np.random.PCG64(np.random.SeedSequence(buffers.seeds[index])))
+                        buffers.observations[index], _ = game.reset()
+                    else:
+                        action = buffers.actions[index]
+                        observation, reward, terminated, truncated, _ = game.step(((action[0], action[1]), (action[2], action[3])))
+                        buffers.rewards[index] = reward
+                        buffers.terminated[index] = terminated
+                        buffers.truncated[index] = truncated
+                        if terminated or truncated:
+                            buffers.final_observations[index] = observation
+                            observation, _ = game.reset()
+                        buffers.observations[index] = observation
+                conn.send_bytes(b"")
+            except Exception:
+                conn.send_bytes(traceback.format_exc().encode())
+    finally:
+        for game in games.values():
+            game.close()
+        buffers.close()
+        conn.close()
+
+
+class Civ6CombatSubprocVectorEnv:
+    """
+    Runs num_envs Civ6CombatEnv games spread over worker processes.
+    Workers write observations, rewards and done flags straight into shared memory and only get one byte
+    per step over their pipe. Every game has its own np.random.Generator spawned from one SeedSequence,
+    so a seeded reset gives the same rollouts no matter how many workers there are.
+    Actions are (num_envs, 4) arrays of (from_row, from_col, to_row, to_col), finished games are reset automatically.
+    """
+
+    def __init__(self, num_envs, num_workers=None, context=None, rows=6, columns=6, max_steps=100, bots=1, start_troops=2,
+                 observation_format="float32"):
+        self.num_envs = num_envs
+        self.row_count = rows
+        self.col_count = columns
+        num_workers = min(num_envs, num_workers or mp.cpu_count())
+        env_kwargs = dict(rows=rows, columns=columns, max_steps=max_steps, bots=bots, start_troops=start_troops, observation_format=observation_format)
+
+        self.single_action_space = gym.spaces.MultiDiscrete([rows, columns, rows, columns])
+        self.action_space = gym.spaces.MultiDiscrete(np.tile([rows, columns, rows, columns], (num_envs, 1)))
+        #"float32", "int8" or "packed", see observation.encode_observations
+        self.observation_format = observation_format
+        self.single_observation_space = format_space(observation_format, rows, columns)
+        self.observation_space = format_space(observation_format, rows, columns, num_envs)
+
+        self.buffers = SharedBuffers(num_envs, rows, columns, observation_format=observation_format)
+        self.closed = False
+        ctx = mp.get_context(context)
+        self.connections = []
+        self.processes = []
+        for envs in np.array_split(np.arange(num_envs), num_workers):
+            parent, child = ctx.Pipe()
+            process = ctx.Process(target=_worker, args=(child, self.buffers.memory.name, num_envs, [int(index) for index in envs], env_kwargs), daemon=True)
+            process.start()
+            child.close()
+            self.connections.append(parent)
+            self.processes.append(process)
+
+    def reset(self, seed=None, options=None):
+        self.buffers.reseed[:] = seed is not None
+        if seed is not None:
+            for index, child in enumerate(np.random.SeedSequence(seed).spawn(self.num_envs)):
+                self.buffers.seeds[index] = child.generate_state(4)
+        self._run(RESET)
+        return self.buffers.observations.copy(), {}
+
+    def step(self, actions):
+        self.buffers.actions[:] = np.asarray(actions, dtype=np.int64).reshape(self.num_envs, 4)
+        self._run(STEP)
+        terminated = self.buffers.terminated.copy()
+        truncated = self.buffers.truncated.copy()
+        info = {}
+        if terminated.any() or truncated.any():
+            done = terminated | truncated
+            done_shape = (self.num_envs,) + (1,) * (self.buffers.observations.ndim - 1)
+            info["final_observation"] = np.where(done.reshape(done_shape), self.buffers.final_observations, self.buffers.observations)
+            info["_final_observation"] = done
+        return self.buffers.observations.copy(), self.buffers.rewards.copy(), terminated, truncated, info
+
+    def _run(self, command):
+        for conn in self.connections:
+            conn.send_bytes(command)
+        errors = [conn.recv_bytes() for conn in self.connections]
+        for error in errors:
+            if error:
+                raise RuntimeError(f"Worker failed:\n{error.decode()}")
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for conn in self.connections:
+            try:
+                conn.send_bytes(CLOSE)
+            except (BrokenPipeError, OSError):
+                pass
+        for process in self.processes:
+            process.join()
+        for conn in self.connections:
+            conn.close()
+        self.buffers.close(unlink=True)
+
+    def __del__(self):
+        if not getattr(self, "closed", True):
+            self.close()
@@ -1,50 +1,15 @@
-import pygame
-from pygame.math import Vector2
-import random
-
 import numpy as np
 
 
-from options import TileType, CnnChannels, Rewards, \
-    DIRECTIONS_ODD, DIRECTIONS_EVEN, MARGIN, HEX_SIZE, worldToScreen, \
+from assets import render_cache
+from hex_geometry import neighbor_lists, neighbor_table, hex_distance, flat_index
+from kernels import batched_reachability
+from observation import ObservationBuilder
+from registry import EntityRegistry
+from options import TileType, Rewards, MARGIN, HEX_SIZE, worldToScreen, \
     draw_centered
 
 class Tile:
-    BASE_PLAINS_IMAGE = pygame.transform.rotate(pygame.image.load('./images/hexagon.png'), 90)
-    BASE_MOVE_OVERLAY_IMAGE = pygame.transform.rotate(pygame.image.load('./images/overlay_move.png'), 90)
-    BASE_ATTACK_OVERLAY_IMAGE = pygame.transform.rotate(pygame.image.load('./images/overlay_attack.png'), 90)
-    BASE_WATER_IMAGE = pygame.transform.rotate(pygame.image.load('./images/water.png'), 90)
-
-    BASE_FOREST_IMAGE = pygame.image.load('./images/forest.png')
-    BASE_HILLS_IMAGE = pygame.image.load('./images/hills.png')
-    BASE_MOUNTAIN_IMAGE = pygame.image.load('./images/mountain.png')
-
-    PLAINS_IMAGE = pygame.transform.scale(BASE_PLAINS_IMAGE, (HEX_SIZE, HEX_SIZE))
-    MOVE_OVERLAY_IMAGE = pygame.transform.scale(BASE_MOVE_OVERLAY_IMAGE, (HEX_SIZE, HEX_SIZE))
-    ATTACK_OVERLAY_IMAGE = pygame.transform.scale(BASE_ATTACK_OVERLAY_IMAGE, (HEX_SIZE, HEX_SIZE))
-    WATER_IMAGE = pygame.transform.scale(BASE_WATER_IMAGE, (HEX_SIZE, HEX_SIZE))
-
-    # Scale other images
-    FOREST_IMAGE = pygame.transform.scale(BASE_FOREST_IMAGE, (int(HEX_SIZE * 2/3), int(HEX_SIZE * 2/3)))
-    HILLS_IMAGE = pygame.transform.scale(BASE_HILLS_IMAGE, (int(HEX_SIZE * 2/3), int(HEX_SIZE * 2/3)))
-    MOUNTAIN_IMAGE = pygame.transform.scale(BASE_MOUNTAIN_IMAGE, (int(HEX_SIZE * 2/3), int(HEX_SIZE * 2/3)))
-
-    
-
-    @classmethod
-    def update_images(cls, scale):
-        new_scale = HEX_SIZE * scale.x
-        cls.PLAINS_IMAGE = pygame.transform.scale(cls.BASE_PLAINS_IMAGE, (new_scale, new_scale))
-        cls.MOVE_OVERLAY_IMAGE = pygame.transform.scale(cls.BASE_MOVE_OVERLAY_IMAGE, (new_scale, new_scale))
-        cls.ATTACK_OVERLAY_IMAGE = pygame.transform.scale(cls.BASE_ATTACK_OVERLAY_IMAGE, (new_scale, new_scale))
-        cls.WATER_IMAGE = pygame.transform.scale(cls.BASE_WATER_IMAGE, (new_scale, new_scale))
-
-        #overlay images are a little smaller so they fit in the tiles
-        new_scale *= 2/3
-        cls.FOREST_IMAGE = pygame.transform.scale(cls.BASE_FOREST_IMAGE, (int(new_scale), int(new_scale)))
-        cls.HILLS_IMAGE = pygame.transform.scale(cls.BASE_HILLS_IMAGE, (int(new_scale), int(new_scale)))
-        cls.MOUNTAIN_IMAGE = pygame.transform.scale(cls.BASE_MOUNTAIN_IMAGE, (int(new_scale), int(new_scale)))
-
     #These are quite random, need to adjust them
     PROBABILITY_MATRIX = {
         TileType.WATER:     [0.2, 0.4, 0.2, 0.2, 0.0],
@@ -55,46 +20,92 @@ class Tile:
     }
 
 
-    def __init__(self, type:TileType, move_cost=1, obstacle=False, draw=False, row=None, col=None, \
-                 owner=None, highlight_move=False, highlight_attack=False):
-        if draw:
-            self.row = row 
-            self.col = col
-            self.highlight_move = highlight_move
-            self.highlight_attack = highlight_attack
-        self.obstacle = obstacle
-        self.troop = None
-        self.building = None
-        self.type = type
-        self.move_cost = move_cost
-        self.owner = owner
-
-    def _get_type_images(self):
+    #Thin view of a single tile, the data itself lives in the Terrain arrays
+    def __init__(self, terrain, row, col):
+        self.terrain = terrain
+        self.row = row
+        self.col = col
+
+    @property
+    def type(self):
+        return TileType(self.terrain.tile_type[self.row, self.col])
+
+    @property
+    def move_cost(self):
+        return self.terrain.move_cost[self.row, self.col]
+
+    @property
+    def obstacle(self):
+        return self.terrain.obstacle[self.row, self.col]
+
+    @property
+    def owner(self):
+        owner = self.terrain.owner[self.row, self.col]
+        return None if owner < 0 else int(owner)
+
+    @property
+    def troop(self):
+        return self.terrain.get_troop(self.row, self.col)
+
+    @property
+    def building(self):
+        return self.terrain.get_building(self.row, self.col)
+
+    @property
+    def highlight_move(self):
+        return self.terrain.highlight_move[self.row, self.col]
+
+    @highlight_move.setter
+    def highlight_move(self, value):
+        self.terrain.highlight_move[self.row, self.col] = value
+
+    @property
+    def highlight_attack(self):
+        return self.terrain.highlight_attack[self.row, self.col]
+
+    @highlight_attack.setter
+    def highlight_attack(self, value):
+        self.terrain.highlight_attack[self.row, self.col] = value
+
+    def _get_type_images(self, assets):
         background = None
         foreground = None
         match self.type:
             case TileType.WATER:
-                background = Tile.WATER_IMAGE
+                background = assets.images['water.png']
             case TileType.PLAINS:
-                background = Tile.PLAINS_IMAGE
+                background = assets.images['hexagon.png']
             case TileType.FOREST:
-                background = Tile.PLAINS_IMAGE
-                foreground = Tile.FOREST_IMAGE
+                background = assets.images['hexagon.png']
+                foreground = assets.images['forest.png']
             case TileType.HILLS:
-                background = Tile.PLAINS_IMAGE
-                foreground = Tile.HILLS_IMAGE
+                background = assets.images['hexagon.png']
+                foreground = assets.images['hills.png']
             case TileType.MOUNTAIN:
-                background = Tile.PLAINS_IMAGE
-                foreground = Tile.MOUNTAIN_IMAGE
+                background = assets.images['hexagon.png']
+                foreground = assets.images['mountain.png']
         return background, foreground
 
     #Probably I can calculate HEX_SIZE * zoom offset whatever and only calcualte it once and use it everywhere, will it be faster?
     def draw(self, window, player_id, offset, scale):
-        self.update_images(scale)
+        self.draw_terrain(window, offset, scale)
+        self.draw_units(window, player_id, offset, scale)
+
+    def screen_rect(self, offset, scale):
+        #top left corner and size of the tile on the screen, everything drawn for a tile stays inside it
+        from pygame.math import Vector2
+        x = (HEX_SIZE * self.col + (HEX_SIZE / 2 * (self.row % 2))) + MARGIN
+        y = (HEX_SIZE * 0.75 * self.row) + MARGIN
+        return worldToScreen(Vector2(x, y), offset, scale), HEX_SIZE * scale.x
+
+    #part of the tile that doesn't change during an episode
+    def draw_terrain(self, window, offset, scale):
+        from pygame.math import Vector2
+        assets = render_cache.get(scale)
         x = (HEX_SIZE * self.col + (HEX_SIZE / 2 * (self.row % 2))) + HEX_SIZE / 2 + MARGIN 
         y = (HEX_SIZE * 0.75 * self.row) + HEX_SIZE / 2 + MARGIN
         
-        background, foreground = self._get_type_images()
+        background, foreground = self._get_type_images(assets)
         #top left corner of tile
         tile_pos = worldToScreen(Vector2(x - HEX_SIZE/2, y - HEX_SIZE/2), offset, scale)
         #middle of tile
@@ -106,11 +117,16 @@ class Tile:
         if foreground is not None:
             draw_centered(window, foreground, tile_mid_pos)
 
-        if self.highlight_move:
-            window.blit(Tile.MOVE_OVERLAY_IMAGE, tile_pos)
+    #highlights and entities
+    def draw_units(self, window, player_id, offset, scale):
+        if self.highlight_move or self.highlight_attack:
+            assets = render_cache.get(scale)
+            tile_pos, _ = self.screen_rect(offset, scale)
+            if self.highlight_move:
+                window.blit(assets.images['overlay_move.png'], tile_pos)
 
-        if self.highlight_attack:
-            window.blit(Tile.ATTACK_OVERLAY_IMAGE, tile_pos)
+            if self.highlight_attack:
+                window.blit(assets.images['overlay_attack.png'], tile_pos)
 
         # Draw Troop
         if self.troop:
@@ -121,77 +137,160 @@ class Tile:
             self.building.draw(window, player_id, offset, scale)
 
 
+def generate_tile_types(count, row_count, column_count, np_random):
+    """
+    Generates count maps at once as a (count, rows, columns) int8 array of TileType values.
+    Same distribution as Terrain.choose_tile_type: the first row is uniform and every other tile is drawn from
+    the summed PROBABILITY_MATRIX rows of its neighbors in the row above, so a whole row is drawn in one go.
+    """
+    types = list(TileType)
+    #extra all zero row for neighbors outside the board
+    matrix = np.array([Tile.PROBABILITY_MATRIX[tile_type] for tile_type in types] + [[0] * len(types)], dtype=float)
+    #cumulative probabilities for every pair of upper neighbors
+    cumulative = np.cumsum(matrix[:, None] + matrix[None, :], axis=2)
+    outside = len(types)
+
+    indices = np.empty((count, row_count, column_count + 2), dtype=np.intp)
+    #padding columns on both sides
+    indices[:, :, 0] = outside
+    indices[:, :, -1] = outside
+    indices[:, 0, 1:-1] = np_random.integers(len(types), size=(count, column_count))
+    for row in range(1, row_count):
+        above = indices[:, row - 1]
+        #even rows touch the tiles above and above left, odd rows above and above right
+        if row % 2 == 0:
+            table = cumulative[above[:, :-2], above[:, 1:-1]]
+        else:
+            table = cumulative[above[:, 1:-1], above[:, 2:]]
+        draw = np_random.random((count, column_count, 1)) * table[:, :, -1:]
+        indices[:, row, 1:-1] = (draw >= table).sum(axis=2)
+    values = np.array([tile_type.value for tile_type in types], dtype=np.int8)
+    return values[indices[:, :, 1:-1]]
+
+
 class Terrain:
-    def __init__(self, row_count, column_count, draw=False):
+    #Move cost and obstacle for every tile type
+    TILE_PROPERTIES = {
+        TileType.WATER:     (0, True),
+        TileType.PLAINS:    (1, False),
+        TileType.FOREST:    (1.5, False),
+        TileType.HILLS:     (1.5, False),
+        TileType.MOUNTAIN:  (0, True),
+    }
+    #TILE_PROPERTIES as lookup arrays by tile type value, built on first use
+    _property_tables = None
+
+    def __init__(self, row_count, column_count, draw=False, np_random=None, tile_type=None):
         self.row_count = row_count
         self.column_count = column_count
-        self.tiles = self.create_tiles(draw)
-        self.movement_costs = None
+        shape = (row_count, column_count)
+        self.tile_type = np.zeros(shape, dtype=np.int8)
+        self.move_cost = np.zeros(shape, dtype=np.float32)
+        self.obstacle = np.zeros(shape, dtype=bool)
+        self.owner = np.full(shape, -1, dtype=np.int16)
+        #ids into self.entities, -1 is empty
+        self.troop_ids = np.full(shape, -1, dtype=np.int32)
+        self.building_ids = np.full(shape, -1, dtype=np.int32)
+        #entities by id and what every player still has, entities is the registry's list
+        self.registry = EntityRegistry()
+        self.entities = self.registry.entities
+        #every random choice of the game goes through this generator, the env passes its own so reset(seed) works
+        self.np_random = np_random if np_random is not None else np.random.default_rng()
+        #bumped on every change of troop_ids or building_ids, cached reachability depends on it
+        self.version = 0
+        #notified about every changed tile, see ObservationBuilder
+        self.observers = []
+        #profiling.StepProfiler of the env, None unless profiling is on
+        self.profiler = None
+        self._masks_key = None
+        self._masks = None
+        if draw:
+            self.highlight_move = np.zeros(shape, dtype=bool)
+            self.highlight_attack = np.zeros(shape, dtype=bool)
+        self.create_tiles(tile_type)
 
     def __getitem__(self, index):
-        return self.tiles[index]
+        row, col = index
+        return Tile(self, row, col)
     
-    def create_tiles(self, draw):
-        tiles = []
-        for row in range(self.row_count):
-            rows = []
-            for col in range(self.column_count):
-                tile_type = self.choose_tile_type(row, col, tiles)
-                obstacle = False
-                move_cost = 1
-
-                if tile_type == TileType.MOUNTAIN:
-                    obstacle = True
-                    move_cost = 0
-                elif tile_type == TileType.WATER:
-                    obstacle = True
-                    move_cost = 0
-                elif tile_type == TileType.HILLS:
-                    obstacle = False
-                    move_cost = 1.5
-                elif tile_type == TileType.FOREST:
-                    obstacle = False
-                    move_cost = 1.5
-
-                if draw:
-                    tile = Tile(tile_type, move_cost, obstacle, True, row=row, col=col)
-                else:
-                    tile = Tile(tile_type, move_cost, obstacle)
-
-                rows.append(tile)
-            tiles.append(rows)
-        return np.array(tiles)
+    def create_tiles(self, tile_type=None):
+        #a new map unless one is given, e.g. from a batch of generate_tile_types
+        if tile_type is None:
+            tile_type = generate_tile_types(1, self.row_count, self.column_count, self.np_random)[0]
+        self.tile_type[:] = tile_type
+        self.move_cost[:], self.obstacle[:] = Terrain.tile_properties(self.tile_type)
+
+    @staticmethod
+    def tile_properties(tile_type):
+        #move cost and obstacle arrays for an array of tile types of any shape
+        if Terrain._property_tables is None:
+            move_costs = np.zeros(max(tile.value for tile in TileType) + 1, dtype=np.float32)
+            obstacles = np.zeros(len(move_costs), dtype=bool)
+            for tile, (move_cost, obstacle) in Terrain.TILE_PROPERTIES.items():
+                move_costs[tile.value] = move_cost
+                obstacles[tile.value] = obstacle
+            Terrain._property_tables = move_costs, obstacles
+        move_costs, obstacles = Terrain._property_tables
+        return move_costs[tile_type], obstacles[tile_type]
+
+    def add_entity(self, entity):
+        #the entity gets the next id and is added to its player's troops or buildings
+        self.registry.add(entity)
+        entity.add_to_tiles(self, entity.row, entity.col)
+
+    def set_troop(self, row, col, troop_id):
+        self.troop_ids[row, col] = troop_id
+        self._changed(row, col)
+
+    def set_building(self, row, col, building_id):
+        self.building_ids[row, col] = building_id
+        self._changed(row, col)
+
+    def add_observer(self, observer):
+        self.observers.append(observer)
+
+    def _changed(self, row, col):
+        self.version += 1
+        for observer in self.observers:
+            observer.mark_dirty(row, col)
+
+    def stats_changed(self, row, col):
+        #health or power of what stands on the tile changed, the board itself didn't so the version stays
+        for observer in self.observers:
+            observer.mark_stats(row, col)
+
+    def get_troop(self, row, col):
+        troop_id = self.troop_ids[row, col]
+        return self.entities[troop_id] if troop_id >= 0 else None
+
+    def get_building(self, row, col):
+        building_id = self.building_ids[row, col]
+        return self.entities[building_id] if building_id >= 0 else None
     
     def draw(self, window, player_id, offset, scale):
-        for row in self.tiles:
-            for tile in row:
-                tile.draw(window, player_id, offset, scale)
+        for row in range(self.row_count):
+            for col in range(self.column_count):
+                self[row, col].draw(window, player_id, offset, scale)
     
-    def choose_tile_type(self, row, col, tiles):
+    #choosing one tile at a time, create_tiles uses generate_tile_types which follows the same rules
+    def choose_tile_type(self, row, col):
         if row == 0 and col == 0:
             # Randomly choose an initial tile type for the first tile
-            return random.choice(list(TileType))
+            return list(TileType)[self.np_random.integers(len(TileType))]
 
         # Get neighboring tile types and calculate the probability for the next tile
-        neighboring_types = self.get_neighboring_tile_types(row, col, tiles)
+        neighboring_types = self.get_neighboring_tile_types(row, col)
         probabilities = self.calculate_combined_probabilities(neighboring_types)
 
         # Choose the next tile type based on the calculated probabilities
-        return random.choices(list(TileType), weights=probabilities, k=1)[0]
+        probabilities = np.asarray(probabilities, dtype=float)
+        return list(TileType)[self.np_random.choice(len(TileType), p=probabilities/probabilities.sum())]
     
-    def get_neighboring_tile_types(self, row, col, tiles):
-        neighbors = []
-
-        # Select the direction offsets based on the row
-        directions = DIRECTIONS_EVEN if row % 2 == 0 else DIRECTIONS_ODD
-
-        for dr, dc in directions:
-            nr, nc = row + dr, col + dc  # Calculate the neighbor's row and column
-            if 0 <= nr < self.row_count and 0 <= nc < self.column_count:
-                if nr < len(tiles) and nc < len(tiles[nr]):
-                    neighbors.append(tiles[nr][nc].type)
-
-        return neighbors
+    #only the rows above are generated when this is called
+    def get_neighboring_tile_types(self, row, col):
+        neighbors = neighbor_lists(self.row_count, self.column_count)[flat_index(row, col, self.column_count)]
+        tile_types = self.tile_type.reshape(-1)
+        return [TileType(tile_types[neighbor]) for neighbor in neighbors if neighbor < row * self.column_count]
     
     def calculate_combined_probabilities(self, neighboring_types):
         if not neighboring_types:
@@ -208,135 +307,132 @@ class Terrain:
 
 
     #Observations need to be redone and rethought, they make no sense now, especially the positions and the mask there
+    #Full rebuild, environments keep an ObservationBuilder around instead
     def get_obs(self, player): 
-        observation = np.full((self.row_count, self.column_count, len(CnnChannels)), -1, dtype=np.float32)
-
-        #For now let's assume that the player with id 0 is our player and all others are enemies
-
-        #Keep track of health and power, I need to normalize them afterwards
-        #Format [(value, (x, y)), (value2, (x2, y2))]
-        troop_powers = []
-        troop_healths = []
-        building_powers = []
-        building_healths = []
-
-        # Loop over each type of entity
-        for row in range(self.row_count):
-            for col in range(self.column_count):
-                # Add this feature map to the observation
-                building = self.tiles[row, col].building
-                troop = self.tiles[row, col].troop
-
-                #Update Friendly, Enemy, Health and Power channels for buildings
-                if building:
-                    observation[row, col, CnnChannels.IS_ENEMY_BUILDING.value] = building.player_id != player.id
-                    building_powers.append((building.power, (row, col)))
-                    building_healths.append((building.health, (row, col)))
-
-                #Update Friendly, Enemy, Health and Power channels for troops
-                if troop:
-                    observation[row, col, CnnChannels.IS_ENEMY_TROOP.value] = troop.player_id != player.id
-                    troop_powers.append((troop.power, (row, col)))
-                    troop_healths.append((troop.health, (row, col)))
-
-                    #Update UnitMoveChannel to show which unit to move
-                    if troop.player_id == player.id and troop.moves > 0:
-                        #mark reachable positions
-                        #this can be optimized by just passing all the troops once
-                        new_values = troop.get_reachable_pos(self.tiles)
-                        
-                        current_values = observation[:, :, CnnChannels.CAN_MOVE.value]
-
-                        # Only update current_values where it's -1 and new_values is either 0 or 1
-                        # or where current_values is 0 and new_values is 1
-                        mask = ((current_values == -1) & ((new_values > 0) | (new_values == 0) | (new_values == -2))) | ((current_values == 0) & (new_values == 1))
-                        current_values[mask] = new_values[mask]
-                        observation[:, :, CnnChannels.CAN_MOVE.value] = current_values
-
-
-        #normalize power and health between 0 and 1
-        #I don't need to do all of this, it's up to the guys who do reinforcment learning to do whatever
-        #they want with the observations, make it much more simple, don't need normalization.
-        #Don't need complicated stuff. Rethink all of these observations.
-        max_power = max([power for power, _ in troop_powers] + [power for power, _ in building_powers])
-        max_health = max([health for health, _ in troop_healths] + [health for health, _ in building_healths])
-        for power, (row, col) in troop_powers:
-            observation[row, col, CnnChannels.TROOP_POWER.value] = power/max_power
-        for health, (row, col) in troop_healths:
-            observation[row, col, CnnChannels.TROOP_HEALTH.value] = health/max_health
-        for power, (row, col) in building_powers:
-            observation[row, col, CnnChannels.BUILDING_POWER.value] = power/max_power
-        for health, (row, col) in building_healths:
-            observation[row, col, CnnChannels.BUILDING_HEALTH.value] = health/max_health
-
-        #I AM LAZY, NEEDT TO CHANGE CODE BUT LET'S SEE IF THIS EVEN WORKS
-        # Reorder dimensions to (Channels, Rows, Columns)
-        observation = np.transpose(observation, (2, 0, 1))
-
-        return observation
+        return ObservationBuilder(self, player).get()
                 
-    def action(self, action, troops):
-        reward = Rewards.DEFAULT.value
-        moves = None
-
+    def is_valid_action(self, action, player_id):
+        #the player's troop on the from tile can move, attack or fortify there, same check as action_masks
+        (from_row, from_col), (to_row, to_col) = action
+        from_troop = self.get_troop(from_row, from_col)
+        if from_troop is None or from_troop.player_id != player_id or from_troop.moves <= 0:
+            return False
+        moves = from_troop.get_reachable_pos(self)[to_row, to_col]
+        return moves > 0 or moves == -2
+
+    def action(self, action, player_id):
+        """
+        Applies a player's action and returns its reward. An invalid action is replaced by a random move of a random
+        troop and Rewards.INVALID is added to the reward of that move, same as in Civ6CombatVectorEnv.
+        """
         (from_row, from_col), (to_row, to_col) = action
 
-        from_troop = self.tiles[from_row, from_col].troop
-
-        #Check if there is a troop and he has moves
-        if from_troop is None or from_troop.moves <= 0:
-            reward = Rewards.INVALID.value
-            from_troop, to_row, to_col, moves = self._get_action(troops)
-        #check if the destination is valid for that troop
+        valid = self.is_valid_action(action, player_id)
+        if valid:
+            from_troop = self.get_troop(from_row, from_col)
+            moves = from_troop.get_reachable_pos(self)[to_row, to_col]
         else:
-            valid_actions = from_troop.get_reachable_pos(self.tiles)
-            moves = valid_actions[to_row, to_col]
-            if not (moves > 0 or moves == -2):
-                reward = Rewards.INVALID.value
-                from_troop, to_row, to_col, moves = self._get_action(troops)  
-        
-        to_troop = self.tiles[to_row, to_col].troop
-        to_building = self.tiles[to_row, to_col].building
+            from_troop, to_row, to_col, moves = self._get_action(player_id)
 
-        #fortify if the same tile it's standing on
-        if from_row == to_row and from_col == to_col:
+        to_troop = self.get_troop(to_row, to_col)
+        to_building = self.get_building(to_row, to_col)
+
+        #fortify if the same tile it's standing on, the random move replacing an invalid action never fortifies
+        if valid and from_row == to_row and from_col == to_col:
             reward = from_troop.fortify()
+            self.stats_changed(from_troop.row, from_troop.col)
 
-        #if nothing or friendly building just move
-        elif (to_troop is None and to_building is None) or \
+        #if nothing or friendly building just move, the random move can also pick the troop's own tile
+        elif (to_troop is None and to_building is None) or to_troop is from_troop or \
             (to_building and to_building.player_id == from_troop.player_id):
-            reward = from_troop.move(to_row, to_col, moves, self.tiles)
+            reward = from_troop.move(to_row, to_col, moves, self)
 
         #Attack
         else:
             target = to_building if to_building is not None else to_troop
-            reward = from_troop.attack(target, self.tiles)
-
-        return reward
+            if self.profiler is not None:
+                self.profiler.count("attacks")
+            reward = from_troop.attack(target, self)
+            #both sides took damage, tiles that changed hands were already reported
+            self.stats_changed(to_row, to_col)
+            self.stats_changed(from_troop.row, from_troop.col)
+
+        return reward if valid else reward + Rewards.INVALID.value
     
+    def action_masks(self, player_id):
+        """
+        Legal actions of a player as a (rows*cols, rows*cols) bool array, [from tile, to tile] is True if
+        the player's troop on the from tile can move, attack or fortify (to tile == from tile) there.
+        Reachability of all troops with moves is computed in one batched pass.
+        """
+        troop_ids = self.troop_ids.reshape(-1)
+        sources = [tile for tile in np.flatnonzero(troop_ids >= 0)
+                   if self.entities[troop_ids[tile]].player_id == player_id and self.entities[troop_ids[tile]].moves > 0]
+        troops = [self.entities[troop_ids[tile]] for tile in sources]
+        #like the reachability of a single troop, the masks only change with the board and the moves
+        key = (self.version, player_id, tuple(troop.moves for troop in troops))
+        if self._masks_key == key:
+            return self._masks
+        tiles = self.row_count * self.column_count
+        masks = np.zeros((tiles, tiles), dtype=bool)
+        if sources:
+            reachable = self.reachability(player_id, troops)
+            #same check as in action
+            masks[sources] = (reachable > 0) | (reachable == -2)
+        masks.flags.writeable = False
+        self._masks_key = key
+        self._masks = masks
+        return masks
+
+    def reachability(self, player_id, troops):
+        #Troop.get_reachable_pos of several troops of one player at once, (troops, rows*cols) flat tiles
+        sources = np.array([flat_index(troop.row, troop.col, self.column_count) for troop in troops], dtype=np.intp)
+        troop_ids = self.troop_ids.reshape(-1)
+        building_ids = self.building_ids.reshape(-1)
+        tiles = self.row_count * self.column_count
+
+        #owner of the troop and building on every tile plus the padding tile, -1 if empty
+        entity_player = np.array([entity.player_id for entity in self.entities] + [-1])
+        troop_owner = np.append(entity_player[troop_ids], -1)
+        building_owner = np.append(entity_player[building_ids], -1)
+        enemy_building = (building_owner >= 0) & (building_owner != player_id)
+        friendly = (troop_owner == player_id)
+        enemy = ((troop_owner >= 0) & (troop_owner != player_id)) | enemy_building
+        passable = np.append(~self.obstacle.reshape(-1), False) & (troop_owner < 0) & ~enemy_building
+        move_cost = np.append(self.move_cost.reshape(-1), 0)
+
+        batch = (len(troops), tiles + 1)
+        if self.profiler is not None:
+            self.profiler.count("batched_bfs")
+        reachable = batched_reachability(neighbor_table(self.row_count, self.column_count),
+                                         np.broadcast_to(move_cost, batch), np.broadcast_to(passable, batch),
+                                         np.broadcast_to(friendly, batch), np.broadcast_to(enemy, batch),
+                                         sources, [troop.moves for troop in troops],
+                                         [troop.max_moves for troop in troops], [troop.attack_range for troop in troops])
+        return reachable
+
     def _is_adjacent(self, row, col, target_row, target_col):
-        target_directions = DIRECTIONS_EVEN if target_row % 2 == 0 else DIRECTIONS_ODD
-        adjacent_cells = [(target_row + dx, target_col + dy) for dx, dy in target_directions
-                    if 0 <= target_row + dx < self.row_count and 0 <= target_col + dy < self.column_count]
-        return (row, col) in adjacent_cells
+        return hex_distance(self.row_count, self.column_count, flat_index(row, col, self.column_count),
+                            flat_index(target_row, target_col, self.column_count)) == 1
     
-    def _get_action(self, troops):
+    def _get_action(self, player_id):
+        #fallback for invalid actions, a random valid move
+        if self.profiler is not None:
+            self.profiler.count("invalid_actions")
 
-        #filter troops which have moves
-        filtered_troops = [troop for troop in troops if troop.moves > 0]
-
-        #choose a troop at random
-        troop = np.random.choice(filtered_troops)
+        #choose a troop with moves at random
+        movable = self.registry.movable_ids(player_id)
+        troop = self.entities[movable[self.np_random.integers(len(movable))]]
 
         #get all valid actions (2d array with 1 indicating valid action)
-        actions = troop.get_reachable_pos(self.tiles)
+        actions = troop.get_reachable_pos(self)
 
         # Find the indices where actions are valid
         valid_indices = np.where(actions >= 1)
 
         # Choose a random index from the valid indices
         # Note: valid_indices is a tuple of arrays, one for each dimension
-        random_index = np.random.choice(range(len(valid_indices[0])))
+        random_index = self.np_random.integers(len(valid_indices[0]))
 
         # Get the row and column of a random valid action
         target_row = valid_indices[0][random_index]
@@ -348,8 +444,5 @@ class Terrain:
         return troop, target_row, target_col, moves
 
     def _attack(self, attacker, defender):
-        return  attacker.attack(defender, self.tiles)
-    
-    def _cleanup(self, entities):
-        for entity in entities:
-            entity.remove_from_tiles(self.tiles)
+        return  attacker.attack(defender, self)
+
@@ -1,9 +1,42 @@
-from stable_baselines3.common.env_checker import check_env
+import os
+import json
+import math
+import tempfile
+
+import numpy as np
 
 from env import Civ6CombatEnv
+from vector_env import Civ6CombatVectorEnv
+from subproc_env import Civ6CombatSubprocVectorEnv
+from map_bank import MapBank
+from renderer import BoardRenderer
+from state import GameState
+from replay import EpisodeRecorder, read_replay
+from dataset import DatasetWriter, DatasetRecorder, DatasetReader
+from mcts import MCTSPlanner, ForwardModel
+from bots import MCTSBot, HeuristicBot, RandomBot, THREAT_DISTANCE
+from terrain import Terrain, Tile, generate_tile_types
+from entities import Player
+from hex_geometry import hex_distance, bfs_order, BFS_CACHE_SIZE
+from options import Rewards, TileType, FortifiedBonus
+from league import SelfPlayLeague, masked_sample
+from profiling import StepProfiler, PHASES, COUNTERS
+from kernels import DAMAGE_RANGE, combat_damage, resolve_combat
+from parallel_env import Civ6CombatParallelEnv
+from observation import ObservationBuilder, egocentric_windows, OUT_OF_BOARD, SUMMARY, encode_observations, decode_observations, STATS, STAT_LEVELS, PACKED_STAT_LEVELS, IS_ENEMY_TROOP
+
+
+def legal_action(env, np_random):
+    #a random legal action of the player, any action if there is none
+    legal = np.flatnonzero(env.action_masks().reshape(-1))
+    index = np_random.choice(legal) if len(legal) else np_random.integers((env.row_count * env.col_count) ** 2)
+    return env.decode_action(index)
 
 
 def stable_baselines_test():
+    #stable_baselines3 is only needed for this test
+    from stable_baselines3.common.env_checker import check_env
+
     env = Civ6CombatEnv(rows=6, columns=6, max_steps=10, render_mode=None)
     check_env(env)
     env = Civ6CombatEnv(rows=6, columns=6, max_steps=10, render_mode="human", fps=100)
@@ -28,6 +61,812 @@ def random_test():
             env.reset()
     env.close()
 
+def vector_test():
+    env = Civ6CombatVectorEnv(64, rows=7, columns=7, max_steps=100)
+    observation, _ = env.reset(seed=0)
+    assert observation.shape == (64, *env.single_observation_space.shape)
+    for i in range(1000):
+        observation, reward, terminated, truncated, info = env.step(env.action_space.sample())
+        assert observation.shape == (64, *env.single_observation_space.shape)
+        if i%100==0:
+            print(f"iteration {i}")
+    env.close()
+
+def vector_determinism_test():
+    #the same seed and actions give the same rollout
+    def rollout():
+        env = Civ6CombatVectorEnv(8, rows=7, columns=7, bots=2)
+        observations, _ = env.reset(seed=0)
+        actions = np.random.default_rng(0).integers(0, 7, size=(200, 8, 4))
+        rollout = [observations]
+        for action in actions:
+            observation, reward, terminated, truncated, _ = env.step(action)
+            rollout += [observation, reward, terminated, truncated]
+        return rollout
+
+    for first, second in zip(rollout(), rollout()):
+        assert np.array_equal(first, second)
+
+
+def reward_parity_test():
+    #both envs start from the same map bank position and get the same actions during the player's first turn,
+    #legal moves and an invalid action (a random move plus Rewards.INVALID) must give the same rewards, and so must
+    #the following turns of the player and the random bots
+    bot_rewards = []
+    for seed in range(5):
+        with tempfile.TemporaryDirectory() as path:
+            bank = MapBank.generate(path, 1, rows=12, columns=12, seed=seed)
+            env = Civ6CombatEnv(rows=12, columns=12, map_bank=bank)
+            vector_env = Civ6CombatVectorEnv(1, rows=12, columns=12, map_bank=bank)
+            env.reset(seed=seed)
+            vector_env.reset(seed=seed)
+            terrain = env.terrain
+            for step in range(3):
+                if step < 2:
+                    #a move onto an empty tile, the states stay the same in both envs
+                    from_tiles, to_tiles = np.nonzero(terrain.action_masks(env.player.id))
+                    empty = (terrain.troop_ids.reshape(-1)[to_tiles] < 0) & (terrain.building_ids.reshape(-1)[to_tiles] < 0)
+                    action = divmod(int(from_tiles[empty][0]), 12), divmod(int(to_tiles[empty][0]), 12)
+                else:
+                    #the player still has troops with moves after the random fallback, so the bots don't play yet
+                    assert len(terrain.registry.movable_ids(env.player.id)) >= 2
+                    empty = np.flatnonzero(terrain.troop_ids.reshape(-1) < 0)
+                    action = divmod(int(empty[0]), 12), divmod(int(empty[1]), 12)
+                _, reward, _, _, _ = env.step(action)
+                _, vector_reward, _, _, _ = vector_env.step(np.array([[*action[0], *action[1]]]))
+                assert reward == vector_reward[0], f"seed {seed} step {step}: {reward} != {vector_reward[0]}"
+                if step == 2:
+                    assert reward == Rewards.INVALID.value, reward
+
+            #then the same legal actions through the bots' turns, random bots pick the same units and targets in both envs
+            np_random = np.random.default_rng(seed)
+            play_turn = env.bot_policy.play_turn
+            def recorded_play_turn(env, bot):
+                bot_rewards.append(play_turn(env, bot))
+                return bot_rewards[-1]
+            env.bot_policy.play_turn = recorded_play_turn
+            for step in range(60):
+                action = legal_action(env, np_random)
+                _, reward, terminated, truncated, _ = env.step(action)
+                _, vector_reward, vector_terminated, _, _ = vector_env.step(np.array([[*action[0], *action[1]]]))
+                assert np.isclose(reward, vector_reward[0]), f"seed {seed} step {step}: {reward} != {vector_reward[0]}"
+                assert terminated == vector_terminated[0]
+                if terminated or truncated:
+                    break
+                terrain = env.terrain
+                entity_player = np.array([entity.player_id for entity in terrain.entities] + [-1])
+                troop_at = vector_env.troop_at[0, :-1]
+                assert np.array_equal(entity_player[terrain.troop_ids.reshape(-1)], np.where(troop_at >= 0, vector_env.unit_player[troop_at], -1)), \
+                    f"seed {seed} step {step}: the troops stand on different tiles"
+    assert any(bot_rewards), "The bots never attacked the player"
+
+
+def render_test():
+    #one frame in human mode, only the changed tiles are redrawn and it must look like a full redraw of the board
+    import pygame
+    env = Civ6CombatEnv(rows=6, columns=6, render_mode="human", fps=100)
+    env.reset(seed=0)
+    env.step(legal_action(env, np.random.default_rng(0)))
+    frame = pygame.surfarray.array3d(env.window)
+    assert len(np.unique(frame.reshape(-1, 3), axis=0)) > 1, "Nothing was drawn"
+    env.renderer = BoardRenderer(env.terrain, env.player.id)
+    env._render_frame()
+    assert np.array_equal(frame, pygame.surfarray.array3d(env.window)), "The redrawn tiles don't match a full redraw"
+    env.close()
+
+
+def action_masks_test():
+    #the masks allow exactly the actions Terrain.action takes as they are, any other action is punished
+    env = Civ6CombatEnv(rows=8, columns=8, bots=2)
+    env.reset(seed=0)
+    np_random = np.random.default_rng(0)
+    for step in range(50):
+        masks = env.action_masks().reshape(-1)
+        for index in range(len(masks)):
+            assert env.terrain.is_valid_action(env.decode_action(index), env.player.id) == masks[index], env.decode_action(index)
+        state = env.get_state()
+        illegal = np_random.choice(np.flatnonzero(~masks))
+        assert env.terrain.action(env.decode_action(illegal), env.player.id) == Rewards.INVALID.value
+        env.set_state(state)
+        _, _, terminated, truncated, _ = env.step(legal_action(env, np_random))
+        if terminated or truncated:
+            env.reset()
+
+
+def subproc_determinism_test():
+    #a seeded reset gives the same rollouts for any number of workers
+    def rollout(num_workers):
+        env = Civ6CombatSubprocVectorEnv(4, num_workers=num_workers, rows=7, columns=7)
+        observations, _ = env.reset(seed=0)
+        actions = np.random.default_rng(0).integers(0, 7, size=(100, 4, 4))
+        rollout = [observations]
+        for action in actions:
+            observation, reward, terminated, truncated, _ = env.step(action)
+            rollout += [observation, reward, terminated, truncated]
+        env.close()
+        return rollout
+
+    for first, second in zip(rollout(1), rollout(2)):
+        assert np.array_equal(first, second)
+
+
+def play(env, steps, np_random):
+    #observations, rewards and done flags of random legal actions, the env is reset when a game ends
+    rollout = []
+    for step in range(steps):
+        observation, reward, terminated, truncated, _ = env.step(legal_action(env, np_random))
+        rollout += [observation, reward, terminated, truncated]
+        if terminated or truncated:
+            observation, _ = env.reset()
+            rollout.append(observation)
+    return rollout
+
+
+def state_test():
+    #a restored state plays on exactly like the game it was taken from, also after a round trip through bytes
+    env = Civ6CombatEnv(rows=8, columns=8, bots=2)
+    env.reset(seed=0)
+    play(env, 20, np.random.default_rng(0))
+    state = env.get_state()
+    expected = play(env, 100, np.random.default_rng(1))
+    #observe=False builds the observation planes lazily on the first step, they must come out the same
+    for restored, observe in ((state, True), (GameState.from_bytes(state.to_bytes()), True), (state, False)):
+        env.set_state(restored, observe=observe)
+        for first, second in zip(play(env, 100, np.random.default_rng(1)), expected):
+            assert np.array_equal(first, second)
+
+
+def replay_test():
+    #every frame read back from a replay file is the state the env was in after that step
+    np_random = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as path:
+        env = EpisodeRecorder(Civ6CombatEnv(rows=8, columns=8, bots=2), os.path.join(path, "test.replay"))
+        env.reset(seed=0)
+        states = [env.unwrapped.get_state()]
+        rewards = []
+        for step in range(60):
+            _, reward, terminated, truncated, _ = env.step(legal_action(env.unwrapped, np_random))
+            states.append(env.unwrapped.get_state())
+            rewards.append(reward)
+            if terminated or truncated:
+                break
+        env.close()
+        episodes = read_replay(os.path.join(path, "test.replay"))
+
+    assert len(episodes) == 1 and len(episodes[0]) == len(states)
+    assert np.allclose(episodes[0].rewards, rewards)
+    for frame, state in enumerate(states):
+        replayed = episodes[0].state(frame)
+        assert np.array_equal(replayed.troop_ids, state.troop_ids) and np.array_equal(replayed.building_ids, state.building_ids)
+        assert replayed.entities.tobytes() == state.entities.tobytes(), f"Entities differ in frame {frame}"
+
+
+def dataset_test():
+    #transitions read back from the shards are the ones the env gave, across shard and episode boundaries
+    np_random = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as path:
+        env = DatasetRecorder(Civ6CombatEnv(rows=6, columns=6, max_steps=15), DatasetWriter(path, 6, 6, shard_size=16))
+        observation, _ = env.reset(seed=0)
+        transitions = []
+        for step in range(40):
+            masks = env.unwrapped.action_masks().copy()
+            action = legal_action(env.unwrapped, np_random)
+            next_observation, reward, terminated, truncated, _ = env.step(action)
+            transitions.append((observation, action, reward, terminated, truncated, masks, step == 0 or transitions[-1][3] or transitions[-1][4]))
+            observation = next_observation
+            if terminated or truncated:
+                observation, _ = env.reset()
+        env.close()
+
+        reader = DatasetReader(path)
+        assert len(reader) == 40 and reader.manifest["shards"] == [16, 16, 8]
+        batch = reader.get(np.arange(40)[::-1])
+        del reader
+    for i, (observation, action, reward, terminated, truncated, masks, episode_start) in enumerate(reversed(transitions)):
+        assert np.array_equal(batch["observations"][i], observation)
+        assert tuple(batch["actions"][i]) == (*action[0], *action[1])
+        assert batch["rewards"][i] == reward and batch["terminated"][i] == terminated and batch["truncated"][i] == truncated
+        assert batch["episode_starts"][i] == episode_start
+        assert np.array_equal(batch["action_masks"][i], masks)
+
+
+def observation_format_test():
+    #compact observations decode back to the float32 ones, exactly except for the rounding of health and power
+    rollouts = {}
+    for observation_format in ("float32", "int8", "packed"):
+        env = Civ6CombatEnv(rows=7, columns=7, bots=2, observation_format=observation_format)
+        observation, _ = env.reset(seed=0)
+        np_random = np.random.default_rng(0)
+        observations = [observation]
+        for step in range(100):
+            observation, _, terminated, truncated, _ = env.step(legal_action(env, np_random))
+            observations.append(observation)
+            if terminated or truncated:
+                observation, _ = env.reset()
+                observations.append(observation)
+        assert all(env.observation_space.contains(observation) for observation in observations), observation_format
+        rollouts[observation_format] = np.stack(observations)
+
+    observations = rollouts["float32"]
+    stats = np.zeros(observations.shape[1], dtype=bool)
+    stats[STATS] = True
+    for observation_format, levels in (("int8", STAT_LEVELS), ("packed", PACKED_STAT_LEVELS)):
+        assert np.array_equal(encode_observations(observations, observation_format), rollouts[observation_format])
+        decoded = decode_observations(rollouts[observation_format], observation_format, 7, 7)
+        assert decoded.dtype == np.float32 and decoded.shape == observations.shape
+        assert np.array_equal(decoded[:, ~stats], observations[:, ~stats])
+        assert np.abs(decoded[:, stats] - observations[:, stats]).max() <= 0.5 / levels + 1e-6
+
+
+def map_bank_test():
+    #tiles past what int16 holds are stored as they are, every stored city is on a tile its player owns
+    with tempfile.TemporaryDirectory() as path:
+        bank = MapBank.generate(path, 2, rows=256, columns=256, bots=3, seed=0)
+        cities = np.array(bank.cities)
+        owner = np.array(bank.owner).reshape(len(bank), -1)
+        del bank
+    assert cities.max() > np.iinfo(np.int16).max, "The test maps have no city past the int16 range"
+    for game in range(len(cities)):
+        assert np.array_equal(owner[game, cities[game]], np.arange(cities.shape[1]))
+
+
+def bfs_cache_test():
+    #the breadth first orders cached per start tile stay bounded however many resets place civs
+    env = Civ6CombatVectorEnv(4, rows=32, columns=32, bots=3)
+    for seed in range(20):
+        env.reset(seed=seed)
+    assert bfs_order.cache_info().currsize <= BFS_CACHE_SIZE, "bfs_order keeps an order for every start tile"
+
+
+def same_state(first, second):
+    #two GameStates describe the same game, random generator state included
+    return all(np.array_equal(getattr(first, name), getattr(second, name)) for name in ("tile_type", "owner", "troop_ids", "building_ids")) \
+        and first.entities.tobytes() == second.entities.tobytes() and first.rng_state == second.rng_state
+
+
+def empty_game(env, tile_type=None):
+    #replaces the env's game by a board without units, plains unless tile_type is given, tests place units with _create_*
+    rows, columns = env.row_count, env.col_count
+    if tile_type is None:
+        tile_type = np.full((rows, columns), TileType.PLAINS.value, dtype=np.int8)
+    env.terrain = Terrain(rows, columns, np_random=env.np_random, tile_type=tile_type)
+    env.player = Player("Hero", 0, env.terrain.registry)
+    env.bots = [Player(f"{i}", i + 1, env.terrain.registry) for i in range(env.bot_count)]
+    env.observation_builder = None
+    return env.terrain
+
+
+def bots_test():
+    #the heuristic bot attacks the weakest enemy in range, fortifies when threatened and otherwise advances on a city,
+    #the random bot only plays legal actions
+    env = Civ6CombatEnv(rows=9, columns=9, bot_policy="heuristic")
+    assert isinstance(env.bot_policy, HeuristicBot)
+    env.reset(seed=0)
+    terrain = empty_game(env)
+    player, bot = env.player, env.bots[0]
+    env._create_warrior(bot, 3, 3, 100, 100, 55, 3, 3)
+    env._create_warrior(player, 3, 3, 80, 100, 55, 2, 3)
+    env._create_warrior(player, 3, 3, 30, 100, 55, 3, 4)
+    #weaker but out of reach
+    env._create_warrior(player, 3, 3, 10, 100, 55, 8, 8)
+    assert hex_distance(9, 9, 3 * 9 + 3, 8 * 9 + 8) > 4
+    strong, weak, far = terrain.get_troop(2, 3), terrain.get_troop(3, 4), terrain.get_troop(8, 8)
+    env.bot_policy.play_turn(env, bot)
+    assert weak.health < 30 and strong.health == 80 and far.health == 10, (weak.health, strong.health, far.health)
+
+    #with one move an enemy two hexes away can't be attacked, so the bot fortifies instead of advancing
+    for enemy, threatened in (((1, 3), True), ((8, 0), False)):
+        terrain = empty_game(env)
+        env._create_center(player, 200, 200, 50, 8, 8)
+        env._create_warrior(bot, 1, 1, 100, 100, 55, 3, 3)
+        env._create_warrior(player, 3, 3, 100, 100, 55, *enemy)
+        distance = hex_distance(9, 9, 3 * 9 + 3, enemy[0] * 9 + enemy[1])
+        assert (distance <= THREAT_DISTANCE) == threatened and distance > 1
+        troop = terrain.get_troop(3, 3)
+        env.bot_policy.play_turn(env, bot)
+        if threatened:
+            assert terrain.get_troop(3, 3) is troop and troop.fortified == FortifiedBonus.FIRST
+        else:
+            assert terrain.get_troop(3, 3) is None and troop.fortified == FortifiedBonus.NONE
+            assert hex_distance(9, 9, troop.row * 9 + troop.col, 8 * 9 + 8) < hex_distance(9, 9, 3 * 9 + 3, 8 * 9 + 8)
+
+    np_random = np.random.default_rng(0)
+    env = Civ6CombatEnv(rows=7, columns=7, bots=2)
+    assert isinstance(env.bot_policy, RandomBot)
+    env.reset(seed=0)
+    bot_action = env.bot_action
+    def checked_bot_action(action, bot):
+        assert env.terrain.is_valid_action(action, bot.id), f"Bot {bot.id} played {action}"
+        return bot_action(action, bot)
+    env.bot_action = checked_bot_action
+    for step in range(300):
+        _, _, terminated, truncated, _ = env.step(legal_action(env, np_random))
+        if terminated or truncated:
+            env.reset()
+
+    try:
+        Civ6CombatEnv(bot_policy="heuristc")
+    except AssertionError:
+        pass
+    else:
+        raise AssertionError("An unknown bot policy name was accepted")
+
+
+def egocentric_test():
+    #windows are the matching slices of the board planes, -1 and OUT_OF_BOARD past the edges, cut or padded to max_windows
+    planes = np.random.default_rng(0).uniform(-1, 1, size=(7, 6, 8)).astype(np.float32)
+    centers = [(0, 0), (5, 7), (3, 4), (0, 7)]
+    windows = egocentric_windows(planes, centers, 5, 6)
+    assert windows.shape == (6, SUMMARY + 1, 5, 5)
+    for window, (row, col) in zip(windows, centers):
+        for i in range(5):
+            for j in range(5):
+                board_row, board_col = row - 2 + i, col - 2 + j
+                inside = 0 <= board_row < 6 and 0 <= board_col < 8
+                assert window[OUT_OF_BOARD, i, j] == (not inside), (row, col, i, j)
+                expected = planes[:, board_row, board_col] if inside else -1
+                assert np.array_equal(window[:OUT_OF_BOARD, i, j], np.broadcast_to(expected, (OUT_OF_BOARD,))), (row, col, i, j)
+    #unused windows are entirely out of the board
+    assert (windows[4:, :OUT_OF_BOARD] == -1).all() and (windows[4:, OUT_OF_BOARD] == 1).all()
+    #only the first count centers get a window
+    assert np.array_equal(egocentric_windows(planes, centers, 5, 2), windows[:2])
+
+    for max_windows in (2, 16):
+        env = Civ6CombatEnv(rows=7, columns=7, observation_mode="egocentric", window_size=5, max_windows=max_windows)
+        env.reset(seed=0)
+        observation, _, _, _, info = env.step(legal_action(env, np.random.default_rng(0)))
+        assert env.observation_space.contains(observation)
+        registry = env.terrain.registry
+        ids = np.concatenate([registry.troop_ids(env.player.id), registry.building_ids(env.player.id)])
+        expected = [(registry.entities[entity_id].row, registry.entities[entity_id].col) for entity_id in ids[:max_windows]]
+        centers = info["window_centers"]
+        assert [tuple(center) for center in centers[:len(expected)]] == expected and (centers[len(expected):] == -1).all()
+        assert np.array_equal(observation, egocentric_windows(env._observations().get(), expected, 5, max_windows))
+
+
+def registry_test():
+    #swap removes keep the ids dense, the alive and has_moves flags follow kills and Troop.moves
+    env = Civ6CombatEnv(rows=8, columns=8)
+    env.reset(seed=0)
+    terrain = empty_game(env)
+    registry = terrain.registry
+    player, bot = env.player, env.bots[0]
+    #more than the initial capacities of the registry and of a player's ids
+    for tile in range(40):
+        env._create_warrior(player, 3, 3, 100, 100, 55, *divmod(tile, 8))
+    env._create_center(player, 200, 200, 50, 7, 7)
+    env._create_warrior(bot, 3, 3, 100, 100, 55, 7, 6)
+    troops = registry.troops(player.id)
+    assert [troop.id for troop in troops] == list(range(40))
+
+    def check_dense(expected):
+        ids = registry._troops[player.id].view()
+        assert sorted(ids.tolist()) == expected and registry.troop_count(player.id) == len(expected)
+        for slot, entity_id in enumerate(ids.tolist()):
+            assert registry.slot[entity_id] == slot
+        assert np.array_equal(registry.troop_ids(player.id), expected)
+
+    remaining = list(range(40))
+    for removed in (17, 0, 38, 5):
+        registry.remove(troops[removed])
+        remaining.remove(removed)
+        assert registry.slot[removed] == -1
+        check_dense(remaining)
+    #removing twice does nothing
+    registry.remove(troops[17])
+    check_dense(remaining)
+
+    killed = [troops[30], troops[3], troops[12]]
+    for troop in killed:
+        troop.kill(terrain)
+    assert not registry.alive[[troop.id for troop in killed]].any()
+    assert registry.remove_dead(player.id) == sorted(killed, key=lambda troop: troop.id)
+    remaining = [entity_id for entity_id in remaining if entity_id not in (3, 12, 30)]
+    check_dense(remaining)
+    assert registry.remove_dead(player.id) == [] and registry.remove_dead(bot.id) == []
+    assert registry.building_count(player.id) == 1 and registry.troop_count(bot.id) == 1
+
+    def check_moves():
+        for troop in registry.troops(player.id) + registry.troops(bot.id):
+            assert registry.has_moves[troop.id] == (troop.moves > 0), troop.id
+        movable = [troop.id for troop in registry.troops(player.id) if troop.moves > 0]
+        assert registry.movable_ids(player.id).tolist() == movable
+        assert registry.turn_over(player.id) == (len(movable) == 0)
+
+    troops = registry.troops(player.id)
+    troops[0].fortify()
+    troops[1].moves = 1.5
+    troops[2].move(6, 7, 3, terrain)
+    check_moves()
+    for troop in troops:
+        troop.moves = 0
+    check_moves()
+    assert registry.turn_over(player.id) and not registry.turn_over(bot.id)
+    registry.reset_moves(player.id)
+    check_moves()
+    assert all(troop.moves == troop.max_moves for troop in troops) and not registry.turn_over(player.id)
+
+
+def tile_generation_test():
+    #seeded, the right shape and only tile types
+    maps = generate_tile_types(20000, 3, 6, np.random.default_rng(0))
+    assert maps.shape == (20000, 3, 6) and maps.dtype == np.int8
+    assert np.isin(maps, [tile_type.value for tile_type in TileType]).all()
+    assert np.array_equal(generate_tile_types(5, 3, 6, np.random.default_rng(0)), generate_tile_types(5, 3, 6, np.random.default_rng(0)))
+    assert not np.array_equal(generate_tile_types(5, 3, 6, np.random.default_rng(0)), generate_tile_types(5, 3, 6, np.random.default_rng(1)))
+
+    def frequencies(tiles):
+        return np.array([(tiles == tile_type.value).mean() for tile_type in TileType])
+
+    def expected(*neighbors):
+        probabilities = np.sum([Tile.PROBABILITY_MATRIX[TileType(neighbor)] for neighbor in neighbors], axis=0)
+        return probabilities / probabilities.sum()
+
+    #the first row is uniform
+    assert np.abs(frequencies(maps[:, 0]) - 1 / len(TileType)).max() < 0.01
+    #the other tiles follow their neighbors in the row above, above left and above on even rows and above and above right on odd rows
+    for row in (1, 2):
+        above = maps[:, row - 1]
+        for col in range(6):
+            if row % 2 == 0:
+                neighbors = [above[:, col - 1], above[:, col]] if col > 0 else [above[:, col]]
+            else:
+                neighbors = [above[:, col], above[:, col + 1]] if col < 5 else [above[:, col]]
+            for pair in {tuple(types) for types in np.stack(neighbors, axis=1)}:
+                given = np.all([neighbor == tile_type for neighbor, tile_type in zip(neighbors, pair)], axis=0)
+                if given.sum() >= 1000:
+                    assert np.abs(frequencies(maps[given, row, col]) - expected(*pair)).max() < 0.05, (row, col, pair)
+                #impossible tile types never show up, e.g. no water next to hills and mountains
+                assert frequencies(maps[given, row, col])[expected(*pair) == 0].sum() == 0, (row, col, pair)
+
+    #same distribution as the baseline one tile at a time generator
+    rows, cols, count = 4, 4, 3000
+    np_random = np.random.default_rng(1)
+    terrain = Terrain(rows, cols, np_random=np_random)
+    baseline = np.zeros((count, rows, cols), dtype=np.int8)
+    for i in range(count):
+        terrain.tile_type = np.zeros((rows, cols), dtype=np.int8)
+        for row in range(rows):
+            for col in range(cols):
+                terrain.tile_type[row, col] = terrain.choose_tile_type(row, col).value
+        baseline[i] = terrain.tile_type
+    batched = generate_tile_types(count, rows, cols, np.random.default_rng(2))
+    for row in range(rows):
+        assert np.abs(frequencies(baseline[:, row]) - frequencies(batched[:, row])).max() < 0.03, row
+    #and the same pairs of tiles on top of each other
+    for first in TileType:
+        for second in TileType:
+            pairs = [((generated[:, 1:] == second.value) & (generated[:, :-1] == first.value)).mean() for generated in (baseline, batched)]
+            assert abs(pairs[0] - pairs[1]) < 0.02, (first, second, pairs)
+
+
+def profiler_test():
+    #info only carries the profile when asked for
+    np_random = np.random.default_rng(0)
+    env = Civ6CombatEnv(rows=6, columns=6)
+    _, info = env.reset(seed=0)
+    assert env.profiler is None and "profile" not in info
+    _, _, _, _, info = env.step(legal_action(env, np_random))
+    assert "profile" not in info
+
+    #every phase is timed over a few rendered games and the counters add up to the totals
+    env = Civ6CombatEnv(rows=6, columns=6, max_steps=20, render_mode="human", fps=100, profile=True)
+    _, info = env.reset(seed=0)
+    totals = dict.fromkeys(COUNTERS, 0)
+    steps = 1
+    for _ in range(60):
+        assert set(info["profile"]["counters"]) == set(COUNTERS)
+        assert set(info["profile"]["timings"]) <= set(PHASES) and all(elapsed >= 0 for elapsed in info["profile"]["timings"].values())
+        for counter, amount in info["profile"]["counters"].items():
+            totals[counter] += amount
+        _, _, terminated, truncated, info = env.step(legal_action(env, np_random))
+        steps += 1
+        if terminated or truncated:
+            for counter, amount in info["profile"]["counters"].items():
+                totals[counter] += amount
+            _, info = env.reset()
+            steps += 1
+    for counter, amount in info["profile"]["counters"].items():
+        totals[counter] += amount
+    profiler = env.profiler
+    assert all(profiler.sample_counts[phase] > 0 for phase in PHASES), profiler.sample_counts
+    assert profiler.sample_counts["get_obs"] == steps and profiler.totals == totals
+    assert totals["attacks"] > 0 and totals["bfs"] + totals["batched_bfs"] > 0
+
+    #clear and export round trip through json
+    with tempfile.TemporaryDirectory() as path:
+        file = os.path.join(path, "profile.json")
+        data = profiler.export(file)
+        with open(file) as f:
+            assert json.load(f) == data
+        assert set(data["summary"]) == set(PHASES) and data["counters"] == totals
+        assert all(sum(counts) == min(profiler.sample_counts[phase], profiler.window) for phase, counts in data["histograms"]["counts"].items())
+        profiler.clear()
+        data = profiler.export(file)
+        with open(file) as f:
+            assert json.load(f) == data
+        assert data["summary"] == {} and data["histograms"]["counts"] == {} and data["counters"] == dict.fromkeys(COUNTERS, 0)
+
+    #the window is a ring buffer keeping the latest samples
+    profiler = StepProfiler(window=4)
+    for i in range(10):
+        profiler.start()
+        profiler.timings["action"] = (i + 1) * 1000
+        profiler.finish()
+    assert profiler.sample_counts["action"] == 10
+    assert sorted(profiler.window_samples("action")) == [7, 8, 9, 10]
+    assert profiler.summary()["action"]["max_us"] == 10 and profiler.summary()["action"]["count"] == 10
+
+
+def reachability_test():
+    #hand computed costs on mixed terrain, the batched search agrees with the single troop one and the cache follows the board
+    env = Civ6CombatEnv(rows=5, columns=5)
+    env.reset(seed=0)
+    tile_type = np.full((5, 5), TileType.MOUNTAIN.value, dtype=np.int8)
+    tile_type[0] = [TileType.PLAINS.value, TileType.FOREST.value, TileType.PLAINS.value, TileType.HILLS.value, TileType.PLAINS.value]
+    tile_type[1, 0] = TileType.WATER.value
+    player, bot = env.player, env.bots[0]
+
+    def reach(create, moves, friends=(), enemies=()):
+        terrain = empty_game(env, tile_type)
+        create(player, moves, 3, 100, 100, 55, 0, 0)
+        for row, col in friends:
+            env._create_warrior(player, 3, 3, 100, 100, 55, row, col)
+        for row, col in enemies:
+            env._create_warrior(bot, 3, 3, 100, 100, 55, row, col)
+        troop = terrain.get_troop(0, 0)
+        single = troop.get_reachable_pos(terrain)
+        batched = terrain.reachability(player.id, [troop])[0].reshape(5, 5)
+        assert np.array_equal(single, batched), (single, batched)
+        #obstacles are never reached, water and mountains cost nothing to enter but block
+        assert (single[1:] == -1).all()
+        return single[0].tolist()
+
+    warrior, archer = env._create_warrior, env._create_archer
+    #forest and hills cost 1.5, the full moves are shown on the troop's own tile
+    assert reach(warrior, 3) == [3, 1.5, 2.5, -1, -1]
+    assert reach(warrior, 2) == [3, 1.5, -1, -1, -1]
+    #friendly troops block, enemies can only be attacked within attack range hexes of the troop
+    assert reach(warrior, 3, friends=[(0, 2)]) == [3, 1.5, 0, -1, -1]
+    assert reach(warrior, 3, enemies=[(0, 1)]) == [3, -2, -1, -1, -1]
+    assert reach(warrior, 3, enemies=[(0, 2)]) == [3, 1.5, 0, -1, -1]
+    assert reach(archer, 3, enemies=[(0, 2)]) == [3, 1.5, -2, -1, -1]
+    assert reach(archer, 3, enemies=[(0, 3)]) == [3, 1.5, 2.5, 0, -1]
+
+    #cached until the board or the troop's moves change
+    terrain = empty_game(env, tile_type)
+    warrior(player, 3, 3, 100, 100, 55, 0, 0)
+    troop = terrain.get_troop(0, 0)
+    cached = troop.get_reachable_pos(terrain)
+    masks = terrain.action_masks(player.id)
+    assert troop.get_reachable_pos(terrain) is cached and terrain.action_masks(player.id) is masks
+    version = terrain.version
+    env._create_warrior(bot, 3, 3, 100, 100, 55, 0, 1)
+    assert terrain.version > version
+    assert troop.get_reachable_pos(terrain)[0, 1] == -2 and terrain.action_masks(player.id) is not masks
+    terrain.get_troop(0, 1).remove_from_tiles(terrain)
+    assert troop.get_reachable_pos(terrain)[0].tolist() == [3, 1.5, 2.5, -1, -1]
+    troop.moves = 2
+    assert troop.get_reachable_pos(terrain)[0].tolist() == [3, 1.5, -1, -1, -1]
+
+    #and on random boards during random games, for every player's troops with moves
+    np_random = np.random.default_rng(0)
+    env = Civ6CombatEnv(rows=9, columns=9, bots=2)
+    env.reset(seed=0)
+    for step in range(200):
+        terrain = env.terrain
+        for player in [env.player] + env.bots:
+            troops = terrain.registry.movable(player.id)
+            if troops:
+                single = np.stack([troop.get_reachable_pos(terrain).reshape(-1) for troop in troops])
+                assert np.array_equal(single, terrain.reachability(player.id, troops)), f"Step {step}, player {player.id}"
+        _, _, terminated, truncated, _ = env.step(legal_action(env, np_random))
+        if terminated or truncated:
+            env.reset()
+
+
+def combat_test():
+    #the damage table is the original Damage(HP)=30*e^{0.04*StrengthDifference} and resolve_combat fights like Troop.attack
+    differences = np.arange(-DAMAGE_RANGE, DAMAGE_RANGE + 1)
+    assert np.allclose(combat_damage(differences), [30 * math.exp(0.04 * difference) for difference in differences], rtol=1e-12, atol=0)
+    for difference in (-DAMAGE_RANGE, -37, 0, 1, DAMAGE_RANGE):
+        assert combat_damage(difference) == 30 * math.exp(0.04 * difference)
+    assert combat_damage(DAMAGE_RANGE + 50) == combat_damage(DAMAGE_RANGE) and combat_damage(-DAMAGE_RANGE - 1) == combat_damage(-DAMAGE_RANGE)
+
+    env = Civ6CombatEnv(rows=5, columns=5)
+    env.reset(seed=0)
+    #(attacker, attacker health, attacker power, defender, defender health, defender power)
+    fights = [("warrior", 100, 55, "warrior", 100, 55), ("warrior", 100, 60, "warrior", 20, 45),
+              ("archer", 100, 55, "warrior", 100, 55), ("archer", 100, 55, "warrior", 5, 40),
+              ("warrior", 100, 55, "city", 200, 50), ("warrior", 100, 80, "city", 10, 50), ("archer", 100, 55, "city", 10, 50),
+              #both die, the one with more health left survives with 1 health
+              ("warrior", 12, 55, "warrior", 3, 55), ("warrior", 3, 55, "warrior", 12, 55), ("warrior", 10, 55, "city", 3, 50)]
+    outcomes = set()
+    for attacker_kind, attacker_health, attacker_power, defender_kind, defender_health, defender_power in fights:
+        terrain = empty_game(env)
+        create = env._create_warrior if attacker_kind == "warrior" else env._create_archer
+        create(env.player, 3, 3, attacker_health, 100, attacker_power, 2, 2)
+        if defender_kind == "city":
+            env._create_center(env.bots[0], defender_health, 200, defender_power, 2, 3)
+            defender = terrain.get_building(2, 3)
+        else:
+            env._create_warrior(env.bots[0], 3, 3, defender_health, 100, defender_power, 2, 3)
+            defender = terrain.get_troop(2, 3)
+        attacker = terrain.get_troop(2, 2)
+
+        #the same random factor the attack is going to draw
+        generator = np.random.Generator(np.random.PCG64())
+        generator.bit_generator.state = terrain.np_random.bit_generator.state
+        rand = np.array([generator.uniform(0.8, 1.2)])
+        fight = (attacker_kind, attacker_health, defender_kind, defender_health)
+        attacker.attack(defender, terrain)
+        attack_health, defense_health, attack_loss, defense_loss, attacker_dies, defender_dies, advance = resolve_combat(
+            np.array([attacker_power]), np.array([defender_power]), np.array([attacker_health], dtype=float),
+            np.array([defender_health], dtype=float), np.array([attacker_kind == "archer"]), rand)
+
+        assert attacker_dies[0] == (attacker.health <= 0) and defender_dies[0] == (defender.health <= 0), fight
+        if not attacker_dies[0]:
+            assert np.isclose(attack_health[0], attacker.health), fight
+        if not defender_dies[0]:
+            assert np.isclose(defense_health[0], defender.health), fight
+        if attacker_kind == "warrior":
+            assert attack_loss[0] == attacker.hp_power_loss, fight
+        if defender_kind == "warrior":
+            assert defense_loss[0] == defender.hp_power_loss, fight
+        assert advance[0] == ((attacker.row, attacker.col) == (2, 3)), fight
+        revived = "attacker" if attack_health[0] == 1 else "defender" if defense_health[0] == 1 else None
+        outcomes.add((bool(attacker_dies[0]), bool(defender_dies[0]), bool(advance[0]), revived))
+    #kills with and without advancing, and both sides surviving a fight both would have died in
+    assert {(False, True, True, None), (False, True, False, None), (False, True, True, "attacker"), (True, False, False, "defender")} <= outcomes, outcomes
+
+
+def mcts_test():
+    #plans are legal actions, a seed always gives the same plan and searching never touches the env it plans for
+    env = Civ6CombatEnv(rows=7, columns=7, bots=1)
+    env.reset(seed=0)
+    np_random = np.random.default_rng(0)
+    for step in range(6):
+        state = env.get_state()
+        masks = env.action_masks()
+        for workers in (1, 2):
+            plans = []
+            for _ in range(2):
+                planner = MCTSPlanner(simulations=16, rollout_depth=6, batch_size=4, workers=workers, pool="thread", seed=step)
+                plans.append(planner.plan(env, env.player))
+                planner.close()
+            assert plans[0] == plans[1], f"Step {step}, {workers} workers: {plans[0]} != {plans[1]}"
+            (from_row, from_col), (to_row, to_col) = plans[0]
+            assert masks[from_row * 7 + from_col, to_row * 7 + to_col], f"Step {step}: illegal plan {plans[0]}"
+            assert same_state(state, env.get_state()), f"Step {step}: planning changed the env"
+        _, _, terminated, truncated, _ = env.step(legal_action(env, np_random))
+        if terminated or truncated:
+            env.reset()
+
+    #the forward model plays on copies, the env and its random generator stay as they were
+    state = env.get_state()
+    model = ForwardModel(7, 7, np.random.default_rng(0))
+    for _ in range(3):
+        model.load(state)
+        model.random_turn(0, 10)
+        model.random_turn(1, 10)
+    assert same_state(state, env.get_state())
+
+    #MCTSBot only plays legal actions for its bot
+    env = Civ6CombatEnv(rows=7, columns=7, bots=1, bot_policy=MCTSBot(MCTSPlanner(simulations=8, rollout_depth=4, seed=0)))
+    env.reset(seed=0)
+    bot_action = env.bot_action
+    def checked_bot_action(action, bot):
+        assert env.terrain.is_valid_action(action, bot.id), f"Bot {bot.id} played {action}"
+        return bot_action(action, bot)
+    env.bot_action = checked_bot_action
+    for step in range(20):
+        _, _, terminated, truncated, _ = env.step(legal_action(env, np_random))
+        if terminated or truncated:
+            env.reset()
+
+
+def league_test():
+    #masked actions and checkpoints with no weight are never picked, every decision round is one act call over all games
+    np_random = np.random.default_rng(0)
+    logits = np_random.normal(size=(500, 20))
+    mask = np_random.random((500, 20)) < 0.2
+    mask[np.arange(500), np_random.integers(20, size=500)] = True
+    #the masked actions are by far the most likely ones
+    logits[~mask] += 100
+    for deterministic in (False, True):
+        actions = masked_sample(logits, mask, np_random, deterministic)
+        assert mask[np.arange(500), actions].all(), "A masked action was sampled"
+
+    tiles = 10 * 10
+    league = SelfPlayLeague()
+    for _ in range(3):
+        league.add(lambda observations: np_random.normal(size=(len(observations), tiles * tiles)))
+    league.set_weight(1, 0)
+    checkpoints = league.sample(2000, np_random)
+    assert 1 not in checkpoints and {0, 2} <= set(checkpoints.tolist()), "sample doesn't follow the weights"
+
+    env = Civ6CombatVectorEnv(8, rows=10, columns=10, bots=2, bot_policy=league)
+    rounds = []
+    league_sim = env._league_sim
+    def recorded_league_sim(games, bot):
+        rounds.append((games, bot, []))
+        return league_sim(games, bot)
+    act = league.act
+    def recorded_act(observations, masks, checkpoints, np_random):
+        games, bot, calls = rounds[-1]
+        own = env.unit_player == bot
+        active = games[(env.unit_alive[games] & own & (env.unit_moves[games] > 0)).any(axis=1)]
+        assert len(observations) == len(active), f"{len(observations)} games in one call, {len(active)} have moves"
+        assert np.array_equal(checkpoints, env.opponents[active, bot - 1])
+        #the bot sees its own troops like player 0 does
+        for observation, game in zip(observations, active):
+            units = own & env.unit_alive[game]
+            assert (observation[IS_ENEMY_TROOP].reshape(-1)[env.unit_pos[game, units]] == 0).all()
+        actions = act(observations, masks, checkpoints, np_random)
+        assert masks[np.arange(len(actions)), actions].all(), "The league played a masked action"
+        calls.append(len(actions))
+        return actions
+    env._league_sim = recorded_league_sim
+    league.act = recorded_act
+
+    env.reset(seed=0)
+    assert not (env.opponents == 1).any()
+    for action in np_random.integers(0, 10, size=(100, 8, 4)):
+        env.step(action)
+    assert rounds and max(max(calls, default=0) for _, _, calls in rounds) > 1, "No round batched several games"
+
+
+def parallel_test():
+    #every live agent gets its results and its own view of the board, attacks are zero sum and eliminated agents leave
+    env = Civ6CombatParallelEnv(rows=8, columns=8, agents=3)
+    np_random = np.random.default_rng(0)
+    #actions are picked before anyone moves, so one can turn invalid during the step and get the invalid action penalty
+    invalid = []
+    def record_invalid(terrain):
+        action = terrain.action
+        def recorded_action(move, player_id):
+            invalid.append(not terrain.is_valid_action(move, player_id))
+            return action(move, player_id)
+        terrain.action = recorded_action
+
+    observations, _ = env.reset(seed=0)
+    record_invalid(env.env.terrain)
+    attacks = eliminations = 0
+    for step in range(1000):
+        agents = env.agents[:]
+        invalid.clear()
+        actions = {}
+        for agent in agents:
+            legal = np.flatnonzero(env.action_masks(agent).reshape(-1))
+            index = np_random.choice(legal) if len(legal) else 0
+            actions[agent] = env.env.decode_action(index)
+        observations, rewards, terminations, truncations, _ = env.step(actions)
+        for results in (observations, rewards, terminations, truncations):
+            assert set(results) == set(agents), f"Step {step}: results for {set(results)}, live agents {agents}"
+
+        players = env.players
+        for agent, observation in observations.items():
+            expected = ObservationBuilder(env.env.terrain, players[env.agent_ids[agent]]).get()
+            assert np.array_equal(observation, expected), f"Step {step}: {agent} doesn't see the board from its side"
+
+        registry = env.env.terrain.registry
+        for agent in agents:
+            player_id = env.agent_ids[agent]
+            lost = registry.building_count(player_id) == 0 or registry.troop_count(player_id) == 0
+            assert (agent in env.agents) == (not terminations[agent] and not truncations[agent]), f"Step {step}: {agent}"
+            assert not lost or agent not in env.agents, f"Step {step}: eliminated {agent} is still playing"
+        if not any(terminations.values()):
+            #without eliminations every reward other than the penalties is some attacker's gain or its target's loss
+            assert sum(rewards.values()) == sum(invalid) * Rewards.INVALID.value, f"Step {step}: {rewards}"
+            attacks += any(rewards.values()) and not any(invalid)
+        elif env.agents:
+            eliminations += 1
+        if not env.agents:
+            observations, _ = env.reset()
+            record_invalid(env.env.terrain)
+    assert attacks > 0 and eliminations > 0, (attacks, eliminations)
+
+
 #NEED A UNIT TEST FOR INTERACTABLE GAME MODE
 #AND UNIT TEST SHOULD SAY WHAT'S THE PROBLEM, NOT JUST RANDOMLY PLAY, but we doin this for now, better than nothing
 
@@ -41,6 +880,94 @@ def unitTest():
     print(f"Starting random test")
     random_test()
     print(f"Finished random test")
+
+    print(f"Starting render test")
+    render_test()
+    print(f"Finished render test")
+
+    print(f"Starting action masks test")
+    action_masks_test()
+    print(f"Finished action masks test")
+
+    print(f"Starting game state test")
+    state_test()
+    print(f"Finished game state test")
+
+    print(f"Starting bots test")
+    bots_test()
+    print(f"Finished bots test")
+
+    print(f"Starting registry test")
+    registry_test()
+    print(f"Finished registry test")
+
+    print(f"Starting tile generation test")
+    tile_generation_test()
+    print(f"Finished tile generation test")
+
+    print(f"Starting profiler test")
+    profiler_test()
+    print(f"Finished profiler test")
+
+    print(f"Starting reachability test")
+    reachability_test()
+    print(f"Finished reachability test")
+
+    print(f"Starting combat test")
+    combat_test()
+    print(f"Finished combat test")
+
+    print(f"Starting mcts test")
+    mcts_test()
+    print(f"Finished mcts test")
+
+    print(f"Starting replay test")
+    replay_test()
+    print(f"Finished replay test")
+
+    print(f"Starting dataset test")
+    dataset_test()
+    print(f"Finished dataset test")
+
+    print(f"Starting observation format test")
+    observation_format_test()
+    print(f"Finished observation format test")
+
+    print(f"Starting egocentric observation test")
+    egocentric_test()
+    print(f"Finished egocentric observation test")
+
+    print(f"Starting vector env test")
+    vector_test()
+    print(f"Finished vector env test")
+
+    print(f"Starting vector env determinism test")
+    vector_determinism_test()
+    print(f"Finished vector env determinism test")
+
+    print(f"Starting subprocess vector env determinism test")
+    subproc_determinism_test()
+    print(f"Finished subprocess vector env determinism test")
+
+    print(f"Starting bfs cache test")
+    bfs_cache_test()
+    print(f"Finished bfs cache test")
+
+    print(f"Starting league test")
+    league_test()
+    print(f"Finished league test")
+
+    print(f"Starting parallel env test")
+    parallel_test()
+    print(f"Finished parallel env test")
+
+    print(f"Starting map bank test")
+    map_bank_test()
+    print(f"Finished map bank test")
+
+    print(f"Starting reward parity test")
+    reward_parity_test()
+    print(f"Finished reward parity test")
    
     
 
@@ -0,0 +1,531 @@
+import numpy as np
+import gymnasium as gym
+
+from terrain import Terrain, generate_tile_types
+from map_bank import MapBank
+from bots import THREAT_DISTANCE
+from league import SelfPlayLeague
+from kernels import batched_reachability, masked_choice, heuristic_targets, resolve_combat
+from hex_geometry import neighbor_table, hex_distance, within_range, bfs_order
+from observation import format_space, encode_observations, enemy_plane
+from options import CnnChannels, FortifiedBonus, Rewards
+
+#Starting stats, same as Civ6CombatEnv._civ_generator
+TROOP_MOVES = 3
+TROOP_HEALTH = 100
+TROOP_POWER = 55
+CENTER_HEALTH = 200
+CENTER_POWER = 50
+OWNERSHIP_DISTANCE = 3
+
+WARRIOR = 0
+ARCHER = 1
+ATTACK_RANGE = np.array([1, 2], dtype=np.int8)
+
+FORTIFY_BONUS = np.array([bonus.value for bonus in FortifiedBonus], dtype=np.int32)
+
+
+class Civ6CombatVectorEnv:
+    """
+    Runs num_envs games of Civ6CombatEnv in one process with the whole state kept in stacked arrays.
+    Player 0 in every game is the learning player, players 1..bots are random bots, heuristic bots or
+    checkpoints of a SelfPlayLeague.
+    Actions are (num_envs, 4) arrays of (from_row, from_col, to_row, to_col), finished games are reset automatically.
+    """
+
+    metadata = {"render_modes": []}
+
+    def __init__(self, num_envs, rows=6, columns=6, max_steps=100, bots=1, start_troops=2, map_bank=None, bot_policy="random",
+                 observation_format="float32"):
+        self.num_envs = num_envs
+        self.row_count = rows
+        self.col_count = columns
+        self.bot_count = bots
+        self.start_troop_count = start_troops
+        self.max_steps = max_steps
+        #starting positions are sampled from the bank instead of generated, MapBank or its path
+        if isinstance(map_bank, str):
+            map_bank = MapBank(map_bank)
+        if map_bank is not None:
+            map_bank.check(rows, columns, bots, start_troops)
+        self.map_bank = map_bank
+        #"random" or "heuristic", same rules as bots.RandomBot and bots.HeuristicBot, or a league.SelfPlayLeague
+        assert isinstance(bot_policy, SelfPlayLeague) or bot_policy in ("random", "heuristic"), f"Invalid bot policy {bot_policy}"
+        self.bot_policy = bot_policy
+
+        self.tile_count = rows * columns
+        self.player_count = bots + 1
+        self.units_per_player = 2 * start_troops
+        self.unit_count = self.player_count * self.units_per_player
+        self.neighbors = neighbor_table(rows, columns)
+
+        self.single_action_space = gym.spaces.MultiDiscrete([rows, columns, rows, columns])
+        self.action_space = gym.spaces.MultiDiscrete(np.tile([rows, columns, rows, columns], (num_envs, 1)))
+        #"float32", "int8" or "packed", see observation.encode_observations
+        self.observation_format = observation_format
+        self.single_observation_space = format_space(observation_format, rows, columns)
+        self.observation_space = format_space(observation_format, rows, columns, num_envs)
+
+        #Per unit constants, units are laid out player by player, warriors first then archers
+        self.unit_player = np.repeat(np.arange(self.player_count, dtype=np.int16), self.units_per_player)
+        self.unit_kind = np.tile(np.repeat(np.array([WARRIOR, ARCHER], dtype=np.int8), start_troops), self.player_count)
+        self.unit_range = ATTACK_RANGE[self.unit_kind]
+        self.unit_max_moves = np.full(self.unit_count, TROOP_MOVES, dtype=np.float32)
+        self.unit_max_health = np.full(self.unit_count, TROOP_HEALTH, dtype=np.float32)
+
+        n, t, u, p = num_envs, self.tile_count, self.unit_count, self.player_count
+        #Terrain, static during an episode
+        self.tile_type = np.zeros((n, rows, columns), dtype=np.int8)
+        self.move_cost = np.zeros((n, rows, columns), dtype=np.float32)
+        self.obstacle = np.zeros((n, rows, columns), dtype=bool)
+        self.owner = np.full((n, rows, columns), -1, dtype=np.int16)
+        #Occupancy over flattened tiles plus one padding tile, troop_at holds unit indices, city_at player indices
+        self.troop_at = np.full((n, t + 1), -1, dtype=np.int32)
+        self.city_at = np.full((n, t + 1), -1, dtype=np.int32)
+        #Units
+        self.unit_pos = np.full((n, u), t, dtype=np.int32)
+        self.unit_health = np.zeros((n, u), dtype=np.float32)
+        self.unit_power = np.zeros((n, u), dtype=np.int32)
+        self.unit_hp_power_loss = np.zeros((n, u), dtype=np.int32)
+        self.unit_moves = np.zeros((n, u), dtype=np.float32)
+        self.unit_fortified = np.zeros((n, u), dtype=np.int8)
+        self.unit_alive = np.zeros((n, u), dtype=bool)
+        #City centers, one per player
+        self.city_pos = np.full((n, p), t, dtype=np.int32)
+        self.city_health = np.zeros((n, p), dtype=np.float32)
+        self.city_power = np.zeros((n, p), dtype=np.int32)
+        self.city_alive = np.zeros((n, p), dtype=bool)
+
+        self.curr_steps = np.zeros(n, dtype=np.int32)
+        #league checkpoint playing every bot, sampled when a game is reset
+        self.opponents = np.zeros((n, bots), dtype=np.int32)
+        self.np_random = np.random.default_rng()
+
+    def reset(self, seed=None, options=None):
+        if seed is not None:
+            self.np_random = np.random.default_rng(seed)
+        self._reset_games(np.arange(self.num_envs))
+        return encode_observations(self._get_obs(np.arange(self.num_envs)), self.observation_format), {}
+
+    def step(self, actions):
+        games = np.arange(self.num_envs)
+        actions = np.asarray(actions, dtype=np.int64).reshape(self.num_envs, 4)
+        from_tile = actions[:, 0] * self.col_count + actions[:, 1]
+        to_tile = actions[:, 2] * self.col_count + actions[:, 3]
+
+        reward = self._player_action(games, from_tile, to_tile)
+        reward += self._after_step(games)
+
+        self.curr_steps += 1
+        truncated = self.curr_steps >= self.max_steps
+        lost = ~(self.unit_alive & (self.unit_player == 0)).any(axis=1) | ~self.city_alive[:, 0] | truncated
+        won = ~self.city_alive[:, 1:].any(axis=1)
+        terminated = lost | won
+        reward -= lost * Rewards.WIN_GAME.value
+        reward += won * Rewards.WIN_GAME.value
+
+        observation = self._get_obs(games)
+        info = {}
+        if terminated.any():
+            done = np.flatnonzero(terminated)
+            info["final_observation"] = observation.copy()
+            info["_final_observation"] = terminated.copy()
+            self._reset_games(done)
+            observation[done] = self._get_obs(done)
+            info["final_observation"] = encode_observations(info["final_observation"], self.observation_format)
+        return encode_observations(observation, self.observation_format), reward, terminated, truncated, info
+
+    def close(self):
+        pass
+
+    def _player_action(self, games, from_tile, to_tile):
+        unit = self.troop_at[games, from_tile]
+        valid = (unit >= 0) & (self.unit_player[unit] == 0)
+        valid &= self.unit_moves[games, unit] > 0
+        cost = np.zeros(len(games), dtype=np.float32)
+
+        checked = np.flatnonzero(valid)
+        if len(checked):
+            reach = self._reachability(games[checked], unit[checked])
+            cost[checked] = reach[np.arange(len(checked)), to_tile[checked]]
+            valid[checked] = (cost[checked] > 0) | (cost[checked] == -2)
+
+        #invalid actions are punished and replaced by a random move of a random troop
+        reward = np.where(valid, 0, Rewards.INVALID.value).astype(np.float32)
+        fortify = valid & (from_tile == to_tile)
+        invalid = np.flatnonzero(~valid)
+        if len(invalid):
+            has_moves = self.unit_alive[games[invalid]] & (self.unit_player == 0) & (self.unit_moves[games[invalid]] > 0)
+            playable = has_moves.any(axis=1)
+            invalid = invalid[playable]
+            unit[invalid] = masked_choice(has_moves[playable], self.np_random)
+            reach = self._reachability(games[invalid], unit[invalid])
+            to_tile[invalid] = masked_choice(reach >= 1, self.np_random)
+            cost[invalid] = reach[np.arange(len(invalid)), to_tile[invalid]]
+            valid[invalid] = True
+
+        acting = np.flatnonzero(valid)
+        reward[acting] += self._apply(games[acting], unit[acting], to_tile[acting], cost[acting], fortify[acting])[0]
+        return reward
+
+    def _after_step(self, games):
+        reward = np.zeros(len(games), dtype=np.float32)
+        reward -= self._cleanup(games, 0)
+        for bot in range(1, self.player_count):
+            reward += self._cleanup(games, bot)
+
+        #bots play once the player has no moves left
+        hero = self.unit_player == 0
+        ai_turn = games[~(self.unit_alive[games] & hero & (self.unit_moves[games] > 0)).any(axis=1)]
+        if len(ai_turn):
+            self._reset_moves(ai_turn, 0)
+            ai_reward = np.zeros(len(ai_turn), dtype=np.float32)
+            for bot in range(1, self.player_count):
+                ai_reward -= self._ai_sim(ai_turn, bot)
+                self._reset_moves(ai_turn, bot)
+                for cleanup_bot in range(1, self.player_count):
+                    self._cleanup(ai_turn, cleanup_bot)
+            ai_reward -= self._cleanup(ai_turn, 0)
+            reward[np.searchsorted(games, ai_turn)] += ai_reward
+        return reward
+
+    def _ai_sim(self, games, bot):
+        if isinstance(self.bot_policy, SelfPlayLeague):
+            return self._league_sim(games, bot)
+        reward = np.zeros(len(games), dtype=np.float32)
+        own = self.unit_player == bot
+        #units take turns like the deque of bots.RandomBot, the next unit with moves after the last one that acted
+        last = np.full(len(games), -1)
+        while True:
+            has_moves = self.unit_alive[games] & own & (self.unit_moves[games] > 0)
+            active = np.flatnonzero(has_moves.any(axis=1))
+            if len(active) == 0:
+                return reward
+            turn_order = (np.arange(self.unit_count) - last[active, None] - 1) % self.unit_count
+            unit = np.where(has_moves[active], turn_order, self.unit_count).argmin(axis=1)
+            last[active] = unit
+            reach = self._reachability(games[active], unit)
+            if self.bot_policy == "heuristic":
+                target = self._heuristic_targets(games[active], unit, reach)
+            else:
+                target = masked_choice((reach > 0) | (reach == -2), self.np_random)
+            cost = reach[np.arange(len(active)), target]
+            fortify = target == self.unit_pos[games[active], unit]
+            curr_reward, hit_player = self._apply(games[active], unit, target, cost, fortify)
+            #We only care about rewards when the AI attacks the player
+            reward[active] += np.where(hit_player, curr_reward, 0)
+
+    def _league_sim(self, games, bot):
+        #every round the bot's checkpoints see the board from its side and pick one action in all games at once
+        reward = np.zeros(len(games), dtype=np.float32)
+        t = self.tile_count
+        own = slice(bot * self.units_per_player, (bot + 1) * self.units_per_player)
+        while True:
+            has_moves = self.unit_alive[games, own] & (self.unit_moves[games, own] > 0)
+            active = np.flatnonzero(has_moves.any(axis=1))
+            if len(active) == 0:
+                return reward
+            g, u = np.nonzero(has_moves[active])
+            units = own.start + u
+            pos = self.unit_pos[games[active[g]], units]
+            reach = self._reachability(games[active[g]], units)
+            #[game, from tile, to tile] like Civ6CombatEnv.action_masks, reach_row is the reach of the unit on a tile
+            masks = np.zeros((len(active), t, t), dtype=bool)
+            masks[g, pos] = (reach > 0) | (reach == -2)
+            reach_row = np.zeros((len(active), t), dtype=np.intp)
+            reach_row[g, pos] = np.arange(len(g))
+            #the observation's CAN_MOVE merges the same reach, it isn't searched again
+            unit_reach = np.full((len(active), self.units_per_player, t), -1, dtype=np.float32)
+            unit_reach[g, u] = reach
+
+            observations = self._get_obs(games[active], bot, unit_reach)
+            actions = self.bot_policy.act(observations, masks.reshape(len(active), -1), self.opponents[games[active], bot - 1], self.np_random)
+            from_tile, target = np.divmod(actions, t)
+            unit = self.troop_at[games[active], from_tile]
+            cost = reach[reach_row[np.arange(len(active)), from_tile], target]
+            curr_reward, hit_player = self._apply(games[active], unit, target, cost, target == from_tile)
+            #We only care about rewards when the AI attacks the player
+            reward[active] += np.where(hit_player, curr_reward, 0)
+
+    def _heuristic_targets(self, games, units, reach):
+        t = self.tile_count
+        player = self.unit_player[units][:, None]
+        troop_at = self.troop_at[games, :t]
+        city_at = self.city_at[games, :t]
+        troop_owner = np.where(troop_at >= 0, self.unit_player[troop_at], -1)
+        enemy_troop = (troop_owner >= 0) & (troop_owner != player)
+        enemy_city = (city_at >= 0) & (city_at != player)
+        #an attack hits the city if there is one, like in Civ6CombatEnv
+        enemy_health = np.full(enemy_troop.shape, np.inf)
+        rows_idx, tiles = np.nonzero(enemy_troop)
+        enemy_health[rows_idx, tiles] = self.unit_health[games[rows_idx], troop_at[rows_idx, tiles]]
+        rows_idx, tiles = np.nonzero(enemy_city)
+        enemy_health[rows_idx, tiles] = self.city_health[games[rows_idx], city_at[rows_idx, tiles]]
+
+        #hexes from every tile to the closest enemy city, over the few cities instead of all tile pairs
+        cities = self.city_pos[games]
+        enemy_cities = self.city_alive[games] & (np.arange(self.player_count) != player)
+        city_distance = hex_distance(self.row_count, self.col_count, np.arange(t)[None, :, None], np.minimum(cities, t - 1)[:, None, :])
+        city_distance = np.where(enemy_cities[:, None, :], city_distance, t).min(axis=2).astype(float)
+        source = self.unit_pos[games, units]
+        threatened = ((hex_distance(self.row_count, self.col_count, source[:, None], np.arange(t)) <= THREAT_DISTANCE) & enemy_troop).any(axis=1)
+        return heuristic_targets(reach, source, enemy_health, city_distance, threatened)
+
+    def _reachability(self, games, units):
+        troop_at = self.troop_at[games]
+        city_at = self.city_at[games]
+        player = self.unit_player[units][:, None]
+        troop_owner = np.where(troop_at >= 0, self.unit_player[troop_at], -1)
+        enemy_city = (city_at >= 0) & (city_at != player)
+        friendly = troop_owner == player
+        enemy = ((troop_owner >= 0) & (troop_owner != player)) | enemy_city
+        obstacle = np.pad(self.obstacle[games].reshape(len(games), -1), ((0, 0), (0, 1)), constant_values=True)
+        move_cost = np.pad(self.move_cost[games].reshape(len(games), -1), ((0, 0), (0, 1)))
+        passable = ~obstacle & (troop_at < 0) & ~enemy_city
+        return batched_reachability(self.neighbors, move_cost, passable, friendly, enemy,
+                                    self.unit_pos[games, units], self.unit_moves[games, units],
+                                    self.unit_max_moves[units], self.unit_range[units])
+
+    def _apply(self, games, units, targets, costs, fortify):
+        """
+        Applies one action per game, returns the rewards and whether the target belonged to player 0
+        """
+        reward = np.zeros(len(games), dtype=np.float32)
+        player = self.unit_player[units]
+        target_troop = self.troop_at[games, targets]
+        target_city = self.city_at[games, targets]
+        troop_owner = np.where(target_troop >= 0, self.unit_player[target_troop], -1)
+        hit_player = (troop_owner == 0) | (target_city == 0)
+        enemy_city = (target_city >= 0) & (target_city != player)
+        attack = ~fortify & (enemy_city | ((troop_owner >= 0) & (troop_owner != player)))
+        move = ~fortify & ~attack
+
+        self._fortify(games[fortify], units[fortify])
+        self._move(games[move], units[move], targets[move], costs[move])
+        reward[attack] = self._attack(games[attack], units[attack], targets[attack], enemy_city[attack])
+        return reward, hit_player
+
+    def _fortify(self, games, units):
+        full = self.unit_moves[games, units] == self.unit_max_moves[units]
+        g, u = games[full], units[full]
+        self.unit_health[g, u] = np.minimum(self.unit_health[g, u] + 10, self.unit_max_health[u])
+        level = self.unit_fortified[g, u]
+        new_level = np.minimum(level + 1, len(FORTIFY_BONUS) - 1)
+        self.unit_power[g, u] += FORTIFY_BONUS[new_level] - FORTIFY_BONUS[level]
+        self.unit_fortified[g, u] = new_level
+        self.unit_moves[games, units] = 0
+
+    def _move(self, games, units, targets, costs):
+        self._remove_fortify_bonus(games, units)
+        self.troop_at[games, self.unit_pos[games, units]] = -1
+        self.troop_at[games, targets] = units
+        self.unit_pos[games, units] = targets
+        self.unit_moves[games, units] -= costs
+
+    def _attack(self, games, units, targets, city_target):
+        self.unit_moves[games, units] = 0
+        self._remove_fortify_bonus(games, units)
+        defender = np.where(city_target, self.city_at[games, targets], self.troop_at[games, targets])
+        troop_target = ~city_target
+        attack_power = self.unit_power[games, units]
+        def_power = np.empty(len(games), dtype=np.int32)
+        def_power[city_target] = self.city_power[games[city_target], defender[city_target]]
+        def_power[troop_target] = self.unit_power[games[troop_target], defender[troop_target]]
+        def_health = np.empty(len(games), dtype=np.float32)
+        def_health[city_target] = self.city_health[games[city_target], defender[city_target]]
+        def_health[troop_target] = self.unit_health[games[troop_target], defender[troop_target]]
+        att_health = self.unit_health[games, units]
+        warrior = self.unit_kind[units] == WARRIOR
+
+        rand = self.np_random.uniform(0.8, 1.2, len(games))
+        att_health, def_health, att_loss, def_loss, attacker_dies, defender_dies, advance = resolve_combat(
+            attack_power, def_power, att_health, def_health, ~warrior, rand)
+        self.unit_health[games, units] = att_health
+        self.unit_health[games[troop_target], defender[troop_target]] = def_health[troop_target]
+        self.city_health[games[city_target], defender[city_target]] = def_health[city_target]
+        #only troops that took damage lose power, archers don't take damage when attacking
+        self._set_hp_power_loss(games[warrior], units[warrior], att_loss[warrior])
+        self._set_hp_power_loss(games[troop_target], defender[troop_target], def_loss[troop_target])
+
+        reward = np.full(len(games), Rewards.ATTACK.value, dtype=np.float32)
+        kill_value = np.where(city_target, Rewards.KILL_CITY.value, Rewards.KILL_TROOP.value)
+        reward += np.where(defender_dies, kill_value, 0)
+        reward -= np.where(attacker_dies, Rewards.KILL_TROOP.value, 0)
+
+        self._kill_units(games[defender_dies & troop_target], defender[defender_dies & troop_target])
+        self._kill_cities(games[defender_dies & city_target], defender[defender_dies & city_target])
+        self._kill_units(games[attacker_dies], units[attacker_dies])
+
+        #warriors advance into the tile of the killed defender
+        self._move(games[advance], units[advance], targets[advance], np.zeros(advance.sum(), dtype=np.float32))
+        return reward
+
+    def _remove_fortify_bonus(self, games, units):
+        self.unit_power[games, units] -= FORTIFY_BONUS[self.unit_fortified[games, units]]
+        self.unit_fortified[games, units] = 0
+
+    def _set_hp_power_loss(self, games, units, loss):
+        self.unit_power[games, units] += self.unit_hp_power_loss[games, units] - loss.astype(np.int32)
+        self.unit_hp_power_loss[games, units] = loss
+
+    def _kill_units(self, games, units):
+        self.troop_at[games, self.unit_pos[games, units]] = -1
+        self.unit_pos[games, units] = self.tile_count
+        self.unit_health[games, units] = 0
+        self.unit_alive[games, units] = False
+
+    def _kill_cities(self, games, players):
+        self.city_at[games, self.city_pos[games, players]] = -1
+        self.city_health[games, players] = 0
+        self.city_alive[games, players] = False
+
+    #if a civ lost its city all its troops die, returns the kill rewards
+    def _cleanup(self, games, player):
+        eliminated = games[~self.city_alive[games, player]]
+        doomed = self.unit_alive[eliminated] & (self.unit_player == player)
+        g, u = np.nonzero(doomed)
+        self._kill_units(eliminated[g], u)
+        reward = np.zeros(len(games), dtype=np.float32)
+        reward[np.searchsorted(games, eliminated)] = doomed.sum(axis=1) * Rewards.KILL_TROOP.value
+        return reward
+
+    def _reset_moves(self, games, player):
+        own = self.unit_alive[games] & (self.unit_player == player)
+        self.unit_moves[games] = np.where(own, self.unit_max_moves, self.unit_moves[games])
+
+    def _get_obs(self, games, player=0, unit_reach=None):
+        #player mirrors the observation to that player's side with observation.enemy_plane like ObservationBuilder.views,
+        #the bots of a league see the board like player 0
+        n, t = len(games), self.tile_count
+        observation = np.full((n, len(CnnChannels), t + 1), -1, dtype=np.float32)
+
+        alive = self.unit_alive[games]
+        city_alive = self.city_alive[games]
+        power = self.unit_power[games]
+        city_power = self.city_power[games]
+        max_power = np.maximum(np.where(alive, power, -np.inf).max(axis=1), np.where(city_alive, city_power, -np.inf).max(axis=1))
+        max_health = np.maximum(np.where(alive, self.unit_health[games], -np.inf).max(axis=1),
+                                np.where(city_alive, self.city_health[games], -np.inf).max(axis=1))
+
+        troop_at = self.troop_at[games]
+        observation[:, CnnChannels.IS_ENEMY_TROOP.value] = enemy_plane(np.where(troop_at >= 0, self.unit_player[troop_at], -1), player)
+        observation[:, CnnChannels.IS_ENEMY_BUILDING.value] = enemy_plane(self.city_at[games], player)
+
+        g, u = np.nonzero(alive)
+        pos = self.unit_pos[games[g], u]
+        observation[g, CnnChannels.TROOP_HEALTH.value, pos] = self.unit_health[games[g], u] / max_health[g]
+        observation[g, CnnChannels.TROOP_POWER.value, pos] = power[g, u] / max_power[g]
+
+        g, p = np.nonzero(city_alive)
+        pos = self.city_pos[games[g], p]
+        observation[g, CnnChannels.BUILDING_HEALTH.value, pos] = self.city_health[games[g], p] / max_health[g]
+        observation[g, CnnChannels.BUILDING_POWER.value, pos] = city_power[g, p] / max_power[g]
+
+        observation[:, CnnChannels.CAN_MOVE.value, :t] = self._can_move(games, player, unit_reach)
+        return observation[:, :, :t].reshape(n, len(CnnChannels), self.row_count, self.col_count)
+
+    def _can_move(self, games, player=0, reach=None):
+        #merges the reachable positions of every movable troop in tile order, like Terrain.get_obs
+        #reach (games, units_per_player, tiles) of the player's movable troops can be passed in if already known
+        hero = self.units_per_player
+        own = slice(player * hero, (player + 1) * hero)
+        n, t = len(games), self.tile_count
+        active = self.unit_alive[games, own] & (self.unit_moves[games, own] > 0)
+        if reach is None:
+            reach = np.full((n, hero, t), -1, dtype=np.float32)
+            g, u = np.nonzero(active)
+            if len(g):
+                reach[g, u] = self._reachability(games[g], own.start + u)
+        order = np.argsort(np.where(active, self.unit_pos[games, own], t), axis=1, kind="stable")
+        reach = np.take_along_axis(reach, order[:, :, None], axis=1)
+
+        current = np.full((n, t), -1, dtype=np.float32)
+        for k in range(hero):
+            new = reach[:, k]
+            mask = ((current == -1) & ((new > 0) | (new == 0) | (new == -2))) | ((current == 0) & (new == 1))
+            current[mask] = new[mask]
+        return current
+
+    def _reset_games(self, games):
+        self.troop_at[games] = -1
+        self.city_at[games] = -1
+        self.unit_alive[games] = False
+        self.unit_pos[games] = self.tile_count
+        self.city_alive[games] = False
+        self.city_pos[games] = self.tile_count
+        self.curr_steps[games] = 0
+        if isinstance(self.bot_policy, SelfPlayLeague):
+            self.opponents[games] = self.bot_policy.sample((len(games), self.bot_count), self.np_random)
+        if self.map_bank is not None:
+            self._load_positions(games, self.map_bank.sample(self.np_random, len(games)))
+            return
+        #all new maps are generated in one batch
+        self.tile_type[games] = generate_tile_types(len(games), self.row_count, self.col_count, self.np_random)
+        self.move_cost[games], self.obstacle[games] = Terrain.tile_properties(self.tile_type[games])
+        self.owner[games] = -1
+        for game in games:
+            for player in range(self.player_count):
+                self._civ_generator(game, player)
+
+    def _load_positions(self, games, map_index):
+        bank = self.map_bank
+        #sorted reads are faster on the memory map
+        order = np.argsort(map_index)
+        games, map_index = games[order], map_index[order]
+        self.tile_type[games] = bank.tile_type[map_index]
+        self.move_cost[games], self.obstacle[games] = Terrain.tile_properties(self.tile_type[games])
+        self.owner[games] = bank.owner[map_index]
+
+        cities = bank.cities[map_index].astype(np.int32)
+        self.city_pos[games] = cities
+        self.city_at[games[:, None], cities] = np.arange(self.player_count)
+        self.city_health[games] = CENTER_HEALTH
+        self.city_power[games] = CENTER_POWER
+        self.city_alive[games] = True
+
+        units = bank.units[map_index].reshape(len(games), self.unit_count).astype(np.int32)
+        placed = units >= 0
+        self.unit_pos[games] = np.where(placed, units, self.tile_count)
+        self.unit_alive[games] = placed
+        self.troop_at[games[:, None], self.unit_pos[games]] = np.where(placed, np.arange(self.unit_count), -1)
+        #units that weren't placed all wrote to the padding tile
+        self.troop_at[games, self.tile_count] = -1
+        self.unit_health[games] = TROOP_HEALTH
+        self.unit_power[games] = TROOP_POWER
+        self.unit_hp_power_loss[games] = 0
+        self.unit_moves[games] = TROOP_MOVES
+        self.unit_fortified[games] = 0
+
+    def _civ_generator(self, game, player):
+        #Generate a city in a random place
+        owner = self.owner[game].ravel()
+        obstacle = self.obstacle[game].ravel()
+        max_attempts = self.tile_count * 5
+        tile = self.np_random.integers(self.tile_count)
+        while (owner[tile] != -1 or obstacle[tile]) and max_attempts > 0:
+            tile = self.np_random.integers(self.tile_count)
+            max_attempts -= 1
+        if max_attempts == 0:
+            raise RuntimeError("Couldn't find space for a city, too many cities for the map size")
+        self.city_pos[game, player] = tile
+        self.city_at[game, tile] = player
+        self.city_health[game, player] = CENTER_HEALTH
+        self.city_power[game, player] = CENTER_POWER
+        self.city_alive[game, player] = True
+
+        owner[within_range(self.row_count, self.col_count, tile, OWNERSHIP_DISTANCE) & (owner == -1)] = player
+
+        #warriors then archers on the closest free tiles
+        order = bfs_order(self.row_count, self.col_count, tile)
+        free = order[(self.troop_at[game, order] < 0) & (self.city_at[game, order] < 0) & ~obstacle[order]]
+        first = player * self.units_per_player
+        placed = free[:self.units_per_player]
+        self.troop_at[game, placed] = np.arange(first, first + len(placed))
+        self.unit_pos[game, first:first + len(placed)] = placed
+        self.unit_alive[game, first:first + len(placed)] = True
+        units = slice(first, first + self.units_per_player)
+        self.unit_health[game, units] = TROOP_HEALTH
+        self.unit_power[game, units] = TROOP_POWER
+        self.unit_hp_power_loss[game, units] = 0
+        self.unit_moves[game, units] = TROOP_MOVES
+        self.unit_fortified[game, units] = 0